@@ -6,46 +6,42 @@ import pandas as pd
 import pysam
 
 import celescope.tools.utils as utils
-from celescope.tools.count import Count, get_opts_count
+from celescope.tools.count import Count, get_opts_count, is_name_sorted
+from celescope.tools.count_table import CountTable
 
 
 class Count_capture_rna(Count):
     
     def bam2table(self):
         """
-        read probe file
+        read probe file, write probe gene count file and return CountTable
         """
+        if not is_name_sorted(self.bam):
+            raise Exception(f'{self.bam} is not sorted by read name. Do not use `--skip_name_sort` in featureCounts.')
         probe_gene_count_dict = utils.genDict(dim=4, valType=int)
+        count_table = CountTable()
 
         samfile = pysam.AlignmentFile(self.bam, "rb")
-        with open(self.count_detail_file, 'wt') as fh1:
-            fh1.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
 
-            def keyfunc(x): return x.query_name.split('_', 1)[0]
-            for _, g in groupby(samfile, keyfunc):
-                gene_umi_dict = defaultdict(lambda: defaultdict(int))
-                for seg in g:
-                    (barcode, umi, probe) = seg.query_name.split('_')[:3]
-                    if probe != 'None':
-                        probe_gene_count_dict[probe]['total'][barcode][umi] += 1
-                        if seg.has_tag('XT'):
-                            geneID = seg.get_tag('XT')
-                            geneName = self.id_name[geneID]
-                            probe_gene_count_dict[probe][geneName][barcode][umi] += 1
-                        else:
-                            probe_gene_count_dict[probe]['None'][barcode][umi] += 1
-                    if not seg.has_tag('XT'):
-                        continue
-                    geneID = seg.get_tag('XT')
-                    gene_umi_dict[geneID][umi] += 1
-                for gene_id in gene_umi_dict:
-                    Count.correct_umi(gene_umi_dict[gene_id])
-
-                # output
-                for gene_id in gene_umi_dict:
-                    for umi in gene_umi_dict[gene_id]:
-                        fh1.write('%s\t%s\t%s\t%s\n' % (barcode, gene_id, umi,
-                                                        gene_umi_dict[gene_id][umi]))
+        def keyfunc(x): return x.query_name.split('_', 1)[0]
+        for _, g in groupby(samfile, keyfunc):
+            gene_umi_dict = defaultdict(lambda: defaultdict(int))
+            for seg in g:
+                (barcode, umi, probe) = seg.query_name.split('_')[:3]
+                if probe != 'None':
+                    probe_gene_count_dict[probe]['total'][barcode][umi] += 1
+                    if seg.has_tag('XT'):
+                        geneID = seg.get_tag('XT')
+                        geneName = self.id_name[geneID]
+                        probe_gene_count_dict[probe][geneName][barcode][umi] += 1
+                    else:
+                        probe_gene_count_dict[probe]['None'][barcode][umi] += 1
+                if not seg.has_tag('XT'):
+                    continue
+                geneID = seg.get_tag('XT')
+                gene_umi_dict[geneID][umi] += 1
+            count_table.add_barcode(barcode, gene_umi_dict)
+        samfile.close()
 
         # out probe
         row_list = []
@@ -71,45 +67,8 @@ class Count_capture_rna(Count):
         df_probe = df_probe.groupby(['probe']).apply(
             lambda x: x.sort_values('UMI_count', ascending=False)
         )
-        return df_probe
-
-
-    def run(self):
-        df_probe = self.bam2table()
         df_probe.to_csv(f'{self.outdir}/{self.sample}_probe_gene_count.tsv', sep='\t', index=False)
-
-        df = pd.read_table(self.count_detail_file, header=0)
-        # df_sum
-        df_sum = Count.get_df_sum(df)
-
-        # export all matrix
-        self.write_matrix_10X(df, self.raw_matrix_10X_dir)
-
-        # call cells
-        cell_bc, _threshold = self.cell_calling(df_sum)
-
-        # get cell stats
-        CB_describe = self.get_cell_stats(df_sum, cell_bc)
-
-        # export cell matrix
-        df_cell = df.loc[df['Barcode'].isin(cell_bc), :]
-        self.write_matrix_10X(df_cell, self.cell_matrix_10X_dir)
-        (CB_total_Genes, CB_reads_count, reads_mapped_to_transcriptome) = self.cell_summary(
-            df, cell_bc)
-
-        # downsampling
-        cell_bc = set(cell_bc)
-        saturation, res_dict = self.downsample(df_cell)
-
-        # summary
-        self.get_summary(saturation, CB_describe, CB_total_Genes,
-                         CB_reads_count, reads_mapped_to_transcriptome)
-
-        self.report_prepare()
-
-        self.add_content_item('metric', downsample_summary=res_dict)
-        self.clean_up()
-
+        return count_table.finish()
 
 
 @utils.add_log
@@ -8,7 +8,8 @@ class testHLA(unittest.TestCase):
         '''
         os.chdir('/SGRNJ01/RD_dir/pipeline_test/zhouyiqi/0910_panel/')
         self.sample = 'S20071508_D_TS'
-        count_detail_file = './/S20071508_D_TS/05.count_capture_rna/S20071508_D_TS_count_detail.txt'
+        # count_capture_rna is run with --output_count_detail
+        count_detail_file = './/S20071508_D_TS/05.count_capture_rna/S20071508_D_TS_count_detail.txt.gz'
         self.df = pd.read_table(count_detail_file, header=0)
         self.match_dir = '/SGRNJ02/RandD4/RD20051303_Panel/20200729/S20071508_D_ZL'
         self.sc_cell_barcodes, self.sc_cell_number = read_barcode_file(self.match_dir)
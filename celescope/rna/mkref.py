@@ -3,11 +3,12 @@ import subprocess
 
 import celescope.tools.utils as utils
 from celescope.tools.mkref import Mkref, parse_genomeDir
+from celescope.tools.region_metrics import RegionIndex
 from celescope.tools.mkref import get_opts_mkref as opts
 
 
 def parse_genomeDir_rna(genomeDir):
-    return parse_genomeDir(genomeDir, entrys = ('fasta', 'gtf', 'mt_gene_list'))    
+    return parse_genomeDir(genomeDir, entrys = ('fasta', 'gtf', 'mt_gene_list', 'region_index'))    
     
 
 class Mkref_rna(Mkref):
@@ -21,6 +22,13 @@ class Mkref_rna(Mkref):
 
     - Genome refFlat file
 
+    - Region index `{refFlat}.celescope_region_index.npz`. Exonic, intronic and intergenic segments of the refFlat 
+    file, which are used by `star` step to collect region metrics.
+
+    - Gene annotation cache `{gtf}.celescope_annotation.*`. Gene id, name, type, coordinates and exons of the gtf 
+    file in numpy arrays, which are loaded by later steps instead of parsing the gtf file again. The cache is 
+    found next to the gtf file, so it is not in the genome config file.
+
     - Genome config file
     ```
     $ cat celescope_genome.config
@@ -30,6 +38,7 @@ class Mkref_rna(Mkref):
     fasta = Homo_sapiens.GRCh38.dna.primary_assembly.fa
     gtf = Homo_sapiens.GRCh38.99.gtf
     refflat = Homo_sapiens_ensembl_99.refFlat
+    region_index = Homo_sapiens_ensembl_99.refFlat.celescope_region_index.npz
     ```
     """
     def __init__(self, genome_type, args):
@@ -40,6 +49,8 @@ class Mkref_rna(Mkref):
 
         # out file 
         self.refflat = f'{self.genome_name}.refFlat'
+        self.gene_annotation = utils.GeneAnnotation.get_prefix(self.gtf)
+        self.region_index = RegionIndex.get_file_name(self.refflat)
 
     @utils.add_log
     def build_star_index(self):
@@ -65,6 +76,7 @@ class Mkref_rna(Mkref):
         genome['fasta'] = self.fasta
         genome['gtf'] = self.gtf
         genome['refFlat'] = self.refflat
+        genome['region_index'] = self.region_index
         genome['mt_gene_list'] = self.mt_gene_list
         with open(self.config_file, 'w') as config_handle:
             config.write(config_handle)
@@ -80,10 +92,22 @@ class Mkref_rna(Mkref):
         Mkref_rna.build_refflat.logger.info(cmd)
         subprocess.check_call(cmd, shell=True)
     
+    @utils.add_log
+    def build_gene_annotation(self):
+        annotation = utils.GeneAnnotation.parse(self.gtf)
+        annotation.save(self.gene_annotation)
+
+    @utils.add_log
+    def build_region_index(self):
+        region_index = RegionIndex.build(self.refflat)
+        region_index.save(self.region_index)
+
     @utils.add_log
     def run(self):
         if not self.dry_run:
             self.build_refflat()
+            self.build_region_index()
+            self.build_gene_annotation()
             self.build_star_index()
         self.write_config()
 
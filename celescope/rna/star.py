@@ -4,6 +4,8 @@ import pandas as pd
 
 import celescope.tools.utils as utils
 from celescope.__init__ import ROOT_PATH
+from celescope.tools.region_metrics import (RegionIndex, get_region_metrics,
+                                            write_region_metrics)
 from celescope.tools.star_mixin import StarMixin, get_opts_star_mixin
 from celescope.tools.step import Step
 
@@ -12,7 +14,8 @@ class Star_rna(Step, StarMixin):
     """
     Features
     - Align R2 reads to the reference genome with STAR.
-    - Collect Metrics with Picard.
+    - Collect region metrics of aligned bases(exonic, intronic and intergenic) with 
+    `celescope.tools.region_metrics` in the same way as Picard CollectRnaSeqMetrics.
 
     Output
     - `{sample}_Aligned.sortedByCoord.out.bam` BAM file contains Uniquely Mapped Reads.
@@ -35,7 +38,8 @@ class Star_rna(Step, StarMixin):
     summing the counts in SJ.out.tab. The mismatch/indel error rates are calculated on a per base basis, 
     i.e. as total number of mismatches/indels in all unique mappers divided by the total number of mapped bases.
 
-    - `{sample}_region.log` Picard CollectRnaSeqMetrics results.
+    - `{sample}_region.log` Region metrics of aligned bases. PF_ALIGNED_BASES, CODING_BASES, UTR_BASES, 
+    INTRONIC_BASES and INTERGENIC_BASES are the same as Picard CollectRnaSeqMetrics results.
     """
 
     def __init__(self, args, step_name):
@@ -46,25 +50,25 @@ class Star_rna(Step, StarMixin):
 
         self.ribo_log = f'{self.outdir}/{self.sample}_ribo_log.txt'
         self.ribo_run_log = f'{self.outdir}/{self.sample}_ribo_run.log'
-        self.picard_region_log = f'{self.outdir}/{self.sample}_region.log'
+        self.region_log = f'{self.outdir}/{self.sample}_region.log'
         self.plot = None
         self.stats = pd.Series()
 
     def add_other_metrics(self):
         """
-        add picard region bases
+        add region bases
         add region plot
         if debug, add ribosomal RNA reads percent
         """
 
-        with open(self.picard_region_log, 'r') as picard_log:
+        with open(self.region_log, 'r') as region_log:
             region_dict = {}
-            for line in picard_log:
+            for line in region_log:
                 if not line:
                     break
                 if line.startswith('## METRICS CLASS'):
-                    header = picard_log.readline().strip().split('\t')
-                    data = picard_log.readline().strip().split('\t')
+                    header = region_log.readline().strip().split('\t')
+                    data = region_log.readline().strip().split('\t')
                     region_dict = dict(zip(header, data))
                     break
         
@@ -128,25 +132,15 @@ class Star_rna(Step, StarMixin):
         subprocess.check_call(cmd, shell=True)
 
     @utils.add_log
-    def picard(self):
-        cmd = [
-            'picard',
-            '-Xmx20G',
-            '-XX:ParallelGCThreads=4',
-            'CollectRnaSeqMetrics',
-            'I=%s' % (self.STAR_bam),
-            'O=%s' % (self.picard_region_log),
-            'REF_FLAT=%s' % (self.refflat),
-            'STRAND=NONE',
-            'VALIDATION_STRINGENCY=SILENT']
-        cmd_str = ' '.join(cmd)
-        Star_rna.picard.logger.info(cmd_str)
-        subprocess.check_call(cmd)
+    def region_metrics(self):
+        region_index = RegionIndex.from_refflat(self.refflat)
+        metrics = get_region_metrics(self.STAR_bam, region_index, self.thread)
+        write_region_metrics(metrics, self.region_log)
 
     @utils.add_log
     def run(self):
         self.run_star()
-        self.picard()
+        self.region_metrics()
         if self.debug:
             self.ribo()
         self.add_other_metrics()
@@ -3,10 +3,10 @@ map read2 to barcode_fasta
 """
 
 import pandas as pd
-import pysam
 
 import celescope.tools.utils as utils
 from celescope.tools.barcode import parse_pattern
+from celescope.tools.fastq import read_fastq_records
 from celescope.tools.step import Step, s_common
 
 
@@ -114,56 +114,54 @@ class Mapping_tag(Step):
         reads_unmapped_invalid_barcode = 0
         reads_mapped = 0
 
-        with pysam.FastxFile(self.fq) as infile:
-            for record in infile:
-                total_reads += 1
-                attr = str(record.name).strip("@").split("_")
-                barcode = str(attr[0])
-                umi = str(attr[1])
-                seq = record.sequence
-
-                if self.linker_length != 0:
-                    seq_linker = utils.seq_ranges(seq, self.pattern_dict['L'])
-                    if len(seq_linker) < self.linker_length:
+        for name, seq, _qual in read_fastq_records(self.fq):
+            total_reads += 1
+            attr = name.strip("@").split("_")
+            barcode = str(attr[0])
+            umi = str(attr[1])
+
+            if self.linker_length != 0:
+                seq_linker = utils.seq_ranges(seq, self.pattern_dict['L'])
+                if len(seq_linker) < self.linker_length:
+                    reads_unmapped_too_short += 1
+                    continue
+            if self.barcode_dict:
+                seq_barcode = utils.seq_ranges(seq, self.pattern_dict['C'])
+                if self.barcode_length != len(seq_barcode):
+                    miss_length = self.barcode_length - len(seq_barcode)
+                    if miss_length > 2:
                         reads_unmapped_too_short += 1
                         continue
-                if self.barcode_dict:
-                    seq_barcode = utils.seq_ranges(seq, self.pattern_dict['C'])
-                    if self.barcode_length != len(seq_barcode):
-                        miss_length = self.barcode_length - len(seq_barcode)
-                        if miss_length > 2:
-                            reads_unmapped_too_short += 1
-                            continue
-                        seq_barcode = seq_barcode + "A" * miss_length                    
+                    seq_barcode = seq_barcode + "A" * miss_length                    
                 
-                # check linker
-                if self.linker_length != 0:
-                    valid_linker = False
-                    for linker_name in self.linker_dict:
-                        if utils.hamming_correct(self.linker_dict[linker_name], seq_linker):
-                            valid_linker = True
-                            break
-                else:
-                    valid_linker = True
-                    
-                if not valid_linker:
-                    reads_unmapped_invalid_iinker += 1
-                    continue
-
-                # check barcode
-                valid_barcode = False
-                for barcode_name in self.barcode_dict:
-                    if utils.hamming_correct(self.barcode_dict[barcode_name], seq_barcode):
-                        self.res_dic[barcode][barcode_name][umi] += 1
-                        valid_barcode = True
+            # check linker
+            if self.linker_length != 0:
+                valid_linker = False
+                for linker_name in self.linker_dict:
+                    if utils.hamming_correct(self.linker_dict[linker_name], seq_linker):
+                        valid_linker = True
                         break
-
-                if not valid_barcode:
-                    reads_unmapped_invalid_barcode += 1
-                    continue
-
-                # mapped
-                reads_mapped += 1
+            else:
+                valid_linker = True
+                    
+            if not valid_linker:
+                reads_unmapped_invalid_iinker += 1
+                continue
+
+            # check barcode
+            valid_barcode = False
+            for barcode_name in self.barcode_dict:
+                if utils.hamming_correct(self.barcode_dict[barcode_name], seq_barcode):
+                    self.res_dic[barcode][barcode_name][umi] += 1
+                    valid_barcode = True
+                    break
+
+            if not valid_barcode:
+                reads_unmapped_invalid_barcode += 1
+                continue
+
+            # mapped
+            reads_mapped += 1
 
         # write dic to pandas df
         rows = []
@@ -4,6 +4,19 @@ from celescope.tools.multi import Multi
 
 class Multi_tcr_fl(Multi):
 
+    def step_args(self):
+        super().step_args()
+        # replace the file path option of split_fq, the file is in the barcode outdir of each sample
+        self.parser.add_argument(
+            '--barcode_count',
+            help=(
+                'Select top N cells from `{sample}_barcode_count.tsv` of step barcode instead of counting UMIs '
+                'in the clean fastq. UMI counts in this file are estimated, so the selected cells may differ '
+                'slightly near the cutoff.'
+            ),
+            action='store_true',
+        )
+
     def split_fq(self, sample):
         step = 'split_fq'
         fq = f'{self.outdir_dic[sample]["cutadapt"]}/{sample}_clean_2.fq{self.fq_suffix}'
@@ -18,6 +31,8 @@ class Multi_tcr_fl(Multi):
             f'--nCell {self.nCell} '
             f'--match_dir {self.col4_dict[sample]} '
         )
+        if self.args.barcode_count:
+            cmd += f'--barcode_count {self.outdir_dic[sample]["barcode"]}/{sample}_barcode_count.tsv '
         self.process_cmd(cmd, step, sample, m=5, x=1)
 
     def assemble(self, sample):
@@ -2,10 +2,10 @@ import os
 from collections import defaultdict
 
 import pandas as pd
-import pysam
 
 from celescope.tcr_fl.barcode_index import Barcode_index
-from celescope.tools.utils import add_log, genDict, read_barcode_file
+from celescope.tools.fastq import read_fastq_records
+from celescope.tools.utils import add_log, fastq_line, genDict, read_barcode_file
 
 
 @add_log
@@ -15,12 +15,11 @@ def get_nCell_barcodes(fq, nCell):
     '''
     count_dict = genDict(dim=2)
     barcode_dict = {}
-    with pysam.FastxFile(fq) as fh:
-        for entry in fh:
-            attr = entry.name.split('_')
-            barcode = attr[0]
-            umi = attr[1]
-            count_dict[barcode][umi] += 1
+    for name, _seq, _qual in read_fastq_records(fq):
+        attr = name.split('_')
+        barcode = attr[0]
+        umi = attr[1]
+        count_dict[barcode][umi] += 1
     for barcode in count_dict:
         barcode_dict[barcode] = len(count_dict[barcode])
     barcodes = pd.DataFrame.from_dict(barcode_dict, orient='index').sort_values(
@@ -29,29 +28,40 @@ def get_nCell_barcodes(fq, nCell):
 
 
 @add_log
-def split_run(fq, fq_outdir, barcodes=None, nCell=None):
+def get_nCell_barcodes_from_count(barcode_count_file, nCell):
+    '''
+    get top nCell's barcodes from the barcode count file of step barcode, without reading the fastq file
+    '''
+    df = pd.read_csv(barcode_count_file, sep='\t', dtype={'Barcode': str})
+    barcodes = pd.Index(df.sort_values('UMI', ascending=False, kind='mergesort')['Barcode'].iloc[0:nCell])
+    return barcodes
+
+
+@add_log
+def split_run(fq, fq_outdir, barcodes=None, nCell=None, barcode_count_file=None):
     '''
     split fastq 
     '''
     if not os.path.exists(fq_outdir):
         os.makedirs(fq_outdir)
     if nCell and nCell != 'None':
-        barcodes = get_nCell_barcodes(fq, nCell)
+        if barcode_count_file and barcode_count_file != 'None':
+            barcodes = get_nCell_barcodes_from_count(barcode_count_file, nCell)
+        else:
+            barcodes = get_nCell_barcodes(fq, nCell)
     bi = Barcode_index(barcodes)
     entry_dict = defaultdict(list)
-    with pysam.FastxFile(fq) as fh:
-        for entry in fh:
-            attr = entry.name.split('_')
-            barcode = attr[0]
-            if barcode in barcodes:
-                cell_index = bi.index_dict[barcode]
-                entry_dict[cell_index].append(entry)
+    for name, seq, qual in read_fastq_records(fq):
+        attr = name.split('_')
+        barcode = attr[0]
+        if barcode in barcodes:
+            cell_index = bi.index_dict[barcode]
+            entry_dict[cell_index].append(fastq_line(name, seq, qual))
                 
     # write to file
     for cell_index in entry_dict:
         with open(f'{fq_outdir}/{cell_index}.fq', 'w') as f:
-            for entry in entry_dict[cell_index]:
-                f.write(str(entry) + '\n')
+            f.write(''.join(entry_dict[cell_index]))
     return bi
 
 
@@ -69,7 +79,7 @@ def split_fq(args):
     fq_outdir = f'{args.outdir}/fastq'
     if nCell and nCell != 'None':
         nCell = int(nCell)
-    bi = split_run(args.fq, fq_outdir, barcodes, nCell) 
+    bi = split_run(args.fq, fq_outdir, barcodes, nCell, args.barcode_count)
     index_file = f'{outdir}/{sample}_index.tsv'
     bi.df_index.to_csv(index_file, sep='\t')
 
@@ -81,4 +91,10 @@ def get_opts_split_fq(parser, sub_program):
         parser.add_argument('--assay', help='assay', required=True)
     parser.add_argument(
         "--match_dir", help="match scRNA-Seq dir")
-    parser.add_argument("--nCell", help="select top N cell")
\ No newline at end of file
+    parser.add_argument("--nCell", help="select top N cell")
+    parser.add_argument(
+        "--barcode_count",
+        help="barcode count file of step barcode. If provided, top N cells are selected from this file "
+        "instead of counting UMIs in `--fq`. UMI counts in this file are estimated, so the selected cells may "
+        "differ slightly near the cutoff."
+    )
\ No newline at end of file
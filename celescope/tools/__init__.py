@@ -1,3 +1,5 @@
+import os
+
 # barcode
 __PATTERN_DICT__ = {'scopeV2.0.0': 'C8L16C8L16C8U8T18',
                     'scopeV2.0.1': 'C8L16C8L16C8L1U8T18',
@@ -12,8 +14,17 @@ __PATTERN_DICT__ = {'scopeV2.0.0': 'C8L16C8L16C8U8T18',
 
 # count
 MATRIX_FILE_NAME = 'matrix.mtx'
+# scipy.sparse csc_matrix saved by scipy.sparse.save_npz
+MATRIX_NPZ_FILE_NAME = 'matrix.npz'
 FEATURE_FILE_NAME = 'genes.tsv'
 BARCODE_FILE_NAME = 'barcodes.tsv'
 
 # mkref
 GENOME_CONFIG = 'celescope_genome.config'
+# gene annotation cache of gtf file: {gtf}{suffix}.genes.npy, {gtf}{suffix}.exons.npy, {gtf}{suffix}.json
+GENE_ANNOTATION_SUFFIX = '.celescope_annotation'
+# region index of refFlat file, see celescope.tools.region_metrics.RegionIndex
+REGION_INDEX_SUFFIX = '.celescope_region_index.npz'
+
+# cache
+CACHE_DIR = os.environ.get('CELESCOPE_CACHE_DIR', os.path.expanduser('~/.cache/celescope'))
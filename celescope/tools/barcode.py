@@ -1,20 +1,41 @@
 """barcode step."""
 
 import glob
+import hashlib
+import multiprocessing
 import os
 import re
 import sys
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import combinations, product
 
+import numpy as np
+import pandas as pd
 import pysam
 from xopen import xopen
 
 import celescope.tools.utils as utils
-from celescope.tools.__init__ import __PATTERN_DICT__
+from celescope.__init__ import __VERSION__
+from celescope.tools.__init__ import CACHE_DIR, __PATTERN_DICT__
+from celescope.tools.cutadapt import ADAPTER, AdapterTrimmer, Cutadapt, get_opts_cutadapt
+from celescope.tools.fastq import read_fastq_pairs
 from celescope.tools.step import Step, s_common
 
 MIN_T = 10
+# number of read pairs sent to a worker process at a time
+CHUNK_SIZE = 50000
+# {chemistry: read_filter} of the worker process, set by init_filter_worker
+WORKER_STATE = {}
+# mismatch index is packed 3 bits per base
+BASE_TRANS = str.maketrans('ACGTN', '01234')
+BASE_LUT = np.full(256, 255, dtype=np.uint8)
+BASE_LUT[np.frombuffer(b'ACGTN', dtype=np.uint8)] = np.arange(5, dtype=np.uint8)
+MISMATCH_INDEX_DIR = f'{CACHE_DIR}/mismatch_index'
+UNALIGNED_BAM_HEADER = {
+    'HD': {'VN': '1.6', 'SO': 'unsorted'},
+    'PG': [{'ID': 'celescope', 'PN': 'celescope', 'VN': __VERSION__}],
+}
 
 def seq_ranges(seq, pattern_dict):
     # get subseq with intervals in arr and concatenate
@@ -149,6 +170,208 @@ def get_all_mismatch(seq_list, n_mismatch=1):
     return correct_set, mismatch_dict
 
 
+class MismatchIndex():
+    """
+    Memory compact replacement of the mismatch_dict returned by get_all_mismatch.
+    Mismatch sequences are packed 3 bits per base(ACGTN) into uint64 and stored in a sorted array, 
+    values are the index of the original sequence in seq_list.
+    The arrays are cached as .npy files and loaded with mmap, so all fastq files and worker processes 
+    of a run share the same pages.
+    """
+    # 3 bits per base in uint64
+    MAX_LENGTH = 21
+    # max number of looked up sequences remembered by each process
+    MEMO_SIZE = 1000000
+
+    def __init__(self, seq_list, keys, values, cache_prefix=None):
+        self.seq_list = seq_list
+        self.length = len(seq_list[0])
+        self.keys = keys
+        self.values = values
+        self.cache_prefix = cache_prefix
+        self.memo = {}
+
+    @staticmethod
+    def encode(seq):
+        """
+        Raises:
+            ValueError if seq contains characters other than ACGTN
+        """
+        return int(seq.translate(BASE_TRANS), 8)
+
+    def get_index(self, seq):
+        """
+        Returns:
+            index of the original sequence in seq_list. -1 if not found.
+        """
+        if seq in self.memo:
+            return self.memo[seq]
+        index = -1
+        if len(seq) == self.length:
+            try:
+                code = np.uint64(self.encode(seq))
+            except ValueError:
+                code = None
+            if code is not None:
+                pos = np.searchsorted(self.keys, code)
+                if pos < len(self.keys) and self.keys[pos] == code:
+                    index = int(self.values[pos])
+        if len(self.memo) < self.MEMO_SIZE:
+            self.memo[seq] = index
+        return index
+
+    @staticmethod
+    def encode_array(seq_arr):
+        """
+        Args:
+            seq_arr: uint8 array of shape (n_seq, seq_length)
+        Returns:
+            codes: uint64 array
+            valid: bool array. False if the sequence contains characters other than ACGTN
+        """
+        digits = BASE_LUT[seq_arr]
+        valid = ~(digits == 255).any(axis=1)
+        powers = np.uint64(8) ** np.arange(seq_arr.shape[1] - 1, -1, -1, dtype=np.uint64)
+        codes = (digits.astype(np.uint64) * powers).sum(axis=1, dtype=np.uint64)
+        return codes, valid
+
+    @property
+    def seq_arr(self):
+        """
+        seq_list as uint8 array of shape (n_seq, length)
+        """
+        if 'seq_arr' not in self.__dict__:
+            self.__dict__['seq_arr'] = np.frombuffer(
+                ''.join(self.seq_list).encode(), dtype=np.uint8).reshape(-1, self.length)
+        return self.__dict__['seq_arr']
+
+    def get_index_array(self, seq_arr):
+        """
+        Vectorized get_index.
+        """
+        index = np.full(len(seq_arr), -1, dtype=np.int64)
+        if seq_arr.shape[1] != self.length or len(self.keys) == 0:
+            return index
+        codes, valid = self.encode_array(seq_arr)
+        pos = np.searchsorted(self.keys, codes)
+        pos[pos == len(self.keys)] = 0
+        found = valid & (self.keys[pos] == codes)
+        index[found] = self.values[pos[found]]
+        return index
+
+    def get_exact_array(self, seq_arr):
+        """
+        Returns:
+            bool array. True if the sequence is in seq_list
+        """
+        if seq_arr.shape[1] != self.length:
+            return np.zeros(len(seq_arr), dtype=bool)
+        if 'correct_keys' not in self.__dict__:
+            correct_keys, _valid = self.encode_array(self.seq_arr)
+            self.__dict__['correct_keys'] = np.unique(correct_keys)
+        correct_keys = self.__dict__['correct_keys']
+        codes, valid = self.encode_array(seq_arr)
+        pos = np.searchsorted(correct_keys, codes)
+        pos[pos == len(correct_keys)] = 0
+        return valid & (correct_keys[pos] == codes)
+
+    def __contains__(self, seq):
+        return self.get_index(seq) != -1
+
+    def __getitem__(self, seq):
+        index = self.get_index(seq)
+        if index == -1:
+            raise KeyError(seq)
+        return self.seq_list[index]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        # worker processes reload the cached arrays with mmap instead of receiving a pickled copy
+        if self.cache_prefix:
+            return {'seq_list': self.seq_list, 'cache_prefix': self.cache_prefix}
+        return {key: value for key, value in self.__dict__.items() if key in ('seq_list', 'length', 'keys', 'values')}
+
+    def __setstate__(self, state):
+        if 'keys' in state:
+            self.__dict__.update(state)
+            self.cache_prefix = None
+            self.memo = {}
+        else:
+            index = MismatchIndex.load(state['seq_list'], state['cache_prefix'])
+            self.__dict__.update(index.__dict__)
+
+    @classmethod
+    def build(cls, seq_list, n_mismatch):
+        seq_index = {seq: index for index, seq in enumerate(seq_list)}
+        _correct_set, mismatch_dict = get_all_mismatch(seq_list, n_mismatch=n_mismatch)
+        keys = np.fromiter((cls.encode(seq) for seq in mismatch_dict), dtype=np.uint64, count=len(mismatch_dict))
+        values = np.fromiter(
+            (seq_index[orig_seq] for orig_seq in mismatch_dict.values()), dtype=np.uint32, count=len(mismatch_dict))
+        order = np.argsort(keys)
+        return cls(seq_list, keys[order], values[order])
+
+    @staticmethod
+    def get_cache_prefix(seq_list, n_mismatch):
+        md5 = hashlib.md5(f'{n_mismatch}\n'.encode())
+        md5.update('\n'.join(seq_list).encode())
+        return f'{MISMATCH_INDEX_DIR}/{md5.hexdigest()}'
+
+    @classmethod
+    def load(cls, seq_list, cache_prefix):
+        keys = np.load(f'{cache_prefix}.keys.npy', mmap_mode='r')
+        values = np.load(f'{cache_prefix}.values.npy', mmap_mode='r')
+        return cls(seq_list, keys, values, cache_prefix=cache_prefix)
+
+    def save(self, cache_prefix):
+        """
+        write to temp files then rename, so samples running at the same time never read a partial file
+        """
+        cache_dir = os.path.dirname(cache_prefix)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        pid = os.getpid()
+        for suffix, arr in (('keys', self.keys), ('values', self.values)):
+            tmp_file = f'{cache_prefix}.{pid}.tmp.{suffix}.npy'
+            np.save(tmp_file, arr)
+            os.replace(tmp_file, f'{cache_prefix}.{suffix}.npy')
+        self.cache_prefix = cache_prefix
+
+
+@utils.add_log
+def get_mismatch_index(seq_list, n_mismatch=1):
+    '''
+    Same as get_all_mismatch, but the mismatch dict is a MismatchIndex which is built once and cached 
+    by the content of seq_list. Fall back to get_all_mismatch if the sequences can not be packed.
+
+    Return:
+    correct_set, MismatchIndex(or dict)
+    '''
+    seq_list = [seq.strip() for seq in seq_list if seq.strip() != '']
+    correct_set = set(seq_list)
+    length_set = set(len(seq) for seq in seq_list)
+    if len(length_set) != 1 or length_set.pop() > MismatchIndex.MAX_LENGTH:
+        return get_all_mismatch(seq_list, n_mismatch=n_mismatch)
+
+    cache_prefix = MismatchIndex.get_cache_prefix(seq_list, n_mismatch)
+    if os.path.exists(f'{cache_prefix}.values.npy'):
+        get_mismatch_index.logger.info(f'load mismatch index from {cache_prefix}')
+        return correct_set, MismatchIndex.load(seq_list, cache_prefix)
+
+    try:
+        mismatch_index = MismatchIndex.build(seq_list, n_mismatch)
+    except ValueError:
+        get_mismatch_index.logger.warning('sequences contain bases other than ACGTN, use mismatch dict.')
+        return get_all_mismatch(seq_list, n_mismatch=n_mismatch)
+    try:
+        mismatch_index.save(cache_prefix)
+        get_mismatch_index.logger.info(f'mismatch index saved to {cache_prefix}')
+    except OSError as error:
+        get_mismatch_index.logger.warning(f'can not write mismatch index cache: {error}')
+    return correct_set, mismatch_index
+
+
 def check_seq_mismatch(seq_list, correct_set_list, mismatch_dict_list):
     '''
     Return bool_valid, bool_corrected
@@ -174,18 +397,45 @@ class Chemistry():
     Auto detect chemistry from read 1
     """
 
-    def __init__(self, fq1):
+    def __init__(self, fq1, thread=1):
         self.fq1 = fq1
         self.fq1_list = fq1.split(',')
         self.nRead = 10000
+        self.thread = int(thread)
+
+        linker_4_file, _whitelist = get_scope_bc('scopeV2.2.1')
+        linker_4_list, _num = utils.read_one_col(linker_4_file)
+        self.linker_4_set = set(linker_4_list)
+        self.pattern_dict = parse_pattern('C8L16C8L16C8L1U12T18')
+
+    @staticmethod
+    def get_cache_key(fq1):
+        """
+        R1 path, size and mtime
+        """
+        fq1_stat = os.stat(fq1)
+        return f'{os.path.abspath(fq1)}:{fq1_stat.st_size}:{int(fq1_stat.st_mtime)}'
 
     @utils.add_log
-    def check_chemistry(self):
-        chemistry_list = []
-        for fastq1 in self.fq1_list:
-            print(fastq1)
-            chemistry = self.get_chemistry(fastq1)
-            chemistry_list.append(chemistry)
+    def check_chemistry(self, cache=None):
+        """
+        Args:
+            cache: {cache_key: chemistry}. R1 files found in cache are not read again.
+                New results are added to cache in place.
+        """
+        if cache is None:
+            cache = {}
+        key_dict = {fastq1: self.get_cache_key(fastq1) for fastq1 in self.fq1_list}
+        detect_list = [fastq1 for fastq1, key in key_dict.items() if key not in cache]
+        if len(detect_list) < len(key_dict):
+            Chemistry.check_chemistry.logger.info(
+                f'{len(key_dict) - len(detect_list)} fastq files found in chemistry cache.')
+        if detect_list:
+            with ThreadPoolExecutor(max_workers=max(1, self.thread)) as executor:
+                for fastq1, chemistry in zip(detect_list, executor.map(self.get_chemistry, detect_list)):
+                    cache[key_dict[fastq1]] = chemistry
+
+        chemistry_list = [cache[key_dict[fastq1]] for fastq1 in self.fq1_list]
         if len(set(chemistry_list)) != 1:
             Chemistry.check_chemistry.logger.warning('multiple chemistry found!' + str(chemistry_list))
         return chemistry_list
@@ -198,11 +448,9 @@ class Chemistry():
         'scopeV2.2.1': 'C8L16C8L16C8L1U12T18' with 4 types of linkers
         '''
         # init
-        linker_4_file, _whitelist = get_scope_bc('scopeV2.2.1')
-        linker_4_list, _num = utils.read_one_col(linker_4_file)
         linker_4_dict = defaultdict(int)
         linker_wrong_dict = defaultdict(int)
-        pattern_dict = parse_pattern('C8L16C8L16C8L1U12T18')
+        pattern_dict = self.pattern_dict
         T4_n = 0
         L57C_n = 0
 
@@ -217,7 +465,7 @@ class Chemistry():
                 if T4 == 'TTTT':
                     T4_n += 1
                 linker = seq_ranges(seq, pattern_dict=pattern_dict['L'])
-                if linker in linker_4_list:
+                if linker in self.linker_4_set:
                     linker_4_dict[linker] += 1
                 else:
                     linker_wrong_dict[linker] += 1
@@ -247,10 +495,486 @@ class Chemistry():
                     f'chemistry scopeV2.2.1 only has {valid_linker_type} linker types!')
             else:
                 chemistry = 'scopeV2.2.1'
-        Chemistry.get_chemistry.logger.info(f'chemistry: {chemistry}')
+        Chemistry.get_chemistry.logger.info(f'{fq1} chemistry: {chemistry}')
         return chemistry
 
 
+def read_pair_chunks(fq1_file, fq2_file, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of (header1, seq1, qual1, header2, seq2, qual2) with at most chunk_size read pairs.
+    """
+    chunk = []
+    for fields in read_fastq_pairs(fq1_file, fq2_file):
+        chunk.extend(zip(*fields))
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+    if chunk:
+        yield chunk
+
+
+def range_cols(ranges):
+    """
+    [[0, 2], [5, 7]] -> array([0, 1, 5, 6])
+    """
+    if not ranges:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+
+def qual_counter(qual_arr):
+    """
+    Counter of quality characters in a uint8 array
+    """
+    counts = np.bincount(qual_arr.ravel(), minlength=256)
+    return Counter({chr(qual): int(counts[qual]) for qual in np.flatnonzero(counts)})
+
+
+def get_fq_str(chunk, read_index_list):
+    """
+    Returns:
+        R1 fastq str, R2 fastq str of reads in read_index_list
+    """
+    fq1, fq2 = [], []
+    for read_index in read_index_list:
+        header1, seq1, qual1, header2, seq2, qual2 = chunk[read_index]
+        fq1.append('@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
+        fq2.append('@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
+    return ''.join(fq1), ''.join(fq2)
+
+
+def hash_seq_array(seq_arr):
+    """
+    Deterministic 64 bit hash of a bytes array(numpy 'S' dtype). FNV-1a over the bytes, followed by the
+    splitmix64 finalizer to spread the bits.
+    """
+    u8_arr = np.ascontiguousarray(seq_arr).view(np.uint8).reshape(len(seq_arr), -1)
+    hashes = np.full(len(seq_arr), 0xcbf29ce484222325, dtype=np.uint64)
+    for col in range(u8_arr.shape[1]):
+        hashes ^= u8_arr[:, col]
+        hashes *= np.uint64(0x100000001b3)
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+class BarcodeSketch():
+    """
+    Exact read count and HyperLogLog estimate of distinct UMIs of each barcode.
+    Each barcode keeps 2 ** P one-byte registers, so the memory does not grow with the number of UMIs.
+    The relative standard error of UMI counts is about 1.04 / sqrt(2 ** P). Small counts use linear counting
+    and are nearly exact.
+    """
+    P = 8
+    M = 1 << P
+    ALPHA = 0.7213 / (1 + 1.079 / M)
+
+    def __init__(self):
+        self.barcode_list = []
+        self.index_dict = {}
+        self.read_counts = np.zeros(0, dtype=np.int64)
+        self.registers = np.zeros((0, self.M), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.barcode_list)
+
+    @classmethod
+    def from_reads(cls, barcode_arr, umi_arr):
+        """
+        Args:
+            barcode_arr, umi_arr: numpy 'S' dtype arrays of valid reads
+        """
+        sketch = cls()
+        if len(barcode_arr) == 0:
+            return sketch
+        barcodes, inverse = np.unique(barcode_arr, return_inverse=True)
+        hashes = hash_seq_array(umi_arr)
+        # the first P bits select the register, the rank is the position of the lowest set bit of the rest
+        register_index = (hashes >> np.uint64(64 - cls.P)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - cls.P)) - 1)
+        lowest_bit = rest & (~rest + np.uint64(1))
+        with np.errstate(divide='ignore'):
+            rank = np.where(rest == 0, 64 - cls.P + 1, np.log2(lowest_bit.astype(np.float64)) + 1)
+        registers = np.zeros((len(barcodes), cls.M), dtype=np.uint8)
+        np.maximum.at(registers, (inverse, register_index), rank.astype(np.uint8))
+
+        sketch.barcode_list = barcodes.tolist()
+        sketch.index_dict = {barcode: i for i, barcode in enumerate(sketch.barcode_list)}
+        sketch.read_counts = np.bincount(inverse, minlength=len(barcodes)).astype(np.int64)
+        sketch.registers = registers
+        return sketch
+
+    def update(self, other):
+        n_before = len(self)
+        rows = [self.index_dict.setdefault(barcode, len(self.index_dict)) for barcode in other.barcode_list]
+        self.barcode_list.extend(other.barcode_list[i] for i, row in enumerate(rows) if row >= n_before)
+        n_barcode = len(self)
+        if n_barcode > len(self.read_counts):
+            capacity = max(n_barcode, 2 * len(self.read_counts))
+            read_counts = np.zeros(capacity, dtype=np.int64)
+            read_counts[:n_before] = self.read_counts[:n_before]
+            registers = np.zeros((capacity, self.M), dtype=np.uint8)
+            registers[:n_before] = self.registers[:n_before]
+            self.read_counts, self.registers = read_counts, registers
+        rows = np.array(rows, dtype=np.intp)
+        self.read_counts[rows] += other.read_counts[:len(other)]
+        self.registers[rows] = np.maximum(self.registers[rows], other.registers[:len(other)])
+
+    def get_umi_counts(self):
+        registers = self.registers[:len(self)]
+        estimate = self.ALPHA * self.M * self.M / np.power(2.0, -registers.astype(np.float64)).sum(axis=1)
+        n_zero = (registers == 0).sum(axis=1)
+        small = (estimate <= 2.5 * self.M) & (n_zero > 0)
+        estimate[small] = self.M * np.log(self.M / n_zero[small])
+        return np.rint(estimate).astype(np.int64)
+
+    def to_df(self):
+        """
+        Returns:
+            DataFrame with columns Barcode, readcount, UMI. Sorted by UMI in descending order.
+        """
+        df = pd.DataFrame({
+            'Barcode': [barcode.decode() for barcode in self.barcode_list],
+            'readcount': self.read_counts[:len(self)],
+            'UMI': self.get_umi_counts(),
+        })
+        df = df.sort_values(['UMI', 'readcount', 'Barcode'], ascending=[False, False, True])
+        return df
+
+
+class ChunkResult():
+    """
+    Output of ReadFilter.filter_chunk. metrics keys are the counter attribute names of Barcode.
+    """
+
+    def __init__(self):
+        self.out_fq2 = ''
+        # (read name, R2 seq, R2 qual, raw barcode, barcode, UMI) if output_bam
+        self.out_bam_records = []
+        self.nopolyT_fq1 = ''
+        self.nopolyT_fq2 = ''
+        self.noLinker_fq1 = ''
+        self.noLinker_fq2 = ''
+        self.metrics = Counter()
+        self.barcode_qual_Counter = Counter()
+        self.umi_qual_Counter = Counter()
+        self.trim_metrics = Counter()
+        self.sketch = BarcodeSketch()
+
+
+class ReadFilter():
+    """
+    Filter and demultiplex read pairs of one chemistry. It only holds picklable data, so it can be
+    shared with worker processes.
+    """
+
+    def __init__(
+        self, pattern_dict, lowQual, lowNum, allowNoPolyT, allowNoLinker, output_nopolyT, output_noLinker,
+        barcode_correct_set_list=None, barcode_mismatch_dict_list=None,
+        linker_correct_set_list=None, linker_mismatch_dict_list=None, batch=False, trimmer=None,
+        output_bam=False,
+    ):
+        self.pattern_dict = pattern_dict
+        self.lowQual = lowQual
+        self.lowNum = lowNum
+        self.allowNoPolyT = allowNoPolyT
+        self.allowNoLinker = allowNoLinker
+        self.output_nopolyT = output_nopolyT
+        self.output_noLinker = output_noLinker
+        self.barcode_correct_set_list = barcode_correct_set_list
+        self.barcode_mismatch_dict_list = barcode_mismatch_dict_list
+        self.linker_correct_set_list = linker_correct_set_list
+        self.linker_mismatch_dict_list = linker_mismatch_dict_list
+        # AdapterTrimmer. If not None, valid R2 reads are trimmed before output.
+        self.trimmer = trimmer
+        self.output_bam = output_bam
+
+        self.bool_T = 'T' in pattern_dict
+        self.bool_L = 'L' in pattern_dict
+        self.bool_whitelist = barcode_correct_set_list is not None
+        self.C_len = sum([item[1] - item[0] for item in pattern_dict['C']])
+
+        # batch filter
+        self.pattern_length = max(item[1] for ranges in pattern_dict.values() for item in ranges)
+        self.T_cols = range_cols(pattern_dict['T'])
+        self.C_cols = range_cols(pattern_dict['C'])
+        self.U_cols = range_cols(pattern_dict['U'])
+        self.CU_cols = range_cols(pattern_dict['C'] + pattern_dict['U'])
+        mismatch_dict_list = []
+        if self.bool_whitelist:
+            mismatch_dict_list += barcode_mismatch_dict_list
+        if self.bool_L and (not allowNoLinker):
+            mismatch_dict_list += linker_mismatch_dict_list
+        self.batch = batch and all(isinstance(item, MismatchIndex) for item in mismatch_dict_list)
+
+    def filter_chunk(self, chunk, offset):
+        """
+        Args:
+            chunk: list of (header1, seq1, qual1, header2, seq2, qual2)
+            offset: number of read pairs before this chunk. Used to make read IDs globally unique.
+        Returns:
+            ChunkResult
+        """
+        if self.batch and all(
+            len(read[1]) >= self.pattern_length and len(read[2]) >= self.pattern_length for read in chunk
+        ):
+            return self.filter_chunk_batch(chunk, offset)
+        return self.filter_chunk_by_read(chunk, offset)
+
+    @staticmethod
+    def correct_segments_batch(seq_arr, ranges, mismatch_index_list):
+        """
+        Vectorized check_seq_mismatch.
+        Returns:
+            bool_valid, bool_corrected: bool arrays
+            corrected_arr: uint8 array of corrected sequences
+        """
+        n_read = len(seq_arr)
+        bool_valid = np.ones(n_read, dtype=bool)
+        bool_corrected = np.zeros(n_read, dtype=bool)
+        corrected_list = []
+        for (start, end), mismatch_index in zip(ranges, mismatch_index_list):
+            seg_arr = seq_arr[:, start:end]
+            if end - start != mismatch_index.length:
+                bool_valid[:] = False
+                corrected_list.append(seg_arr)
+                continue
+            exact = mismatch_index.get_exact_array(seg_arr)
+            index = mismatch_index.get_index_array(seg_arr)
+            bool_valid &= exact | (index != -1)
+            bool_corrected |= ~exact
+            corrected_list.append(
+                np.where(exact[:, None], seg_arr, mismatch_index.seq_arr[np.maximum(index, 0)]))
+        return bool_valid, bool_corrected, np.hstack(corrected_list)
+
+    def filter_chunk_batch(self, chunk, offset):
+        """
+        Same as filter_chunk_by_read, but R1 reads are converted to fixed width uint8 arrays and 
+        filtered with numpy. All R1 reads must be at least pattern_length long.
+        """
+        width = self.pattern_length
+        n_read = len(chunk)
+        res = ChunkResult()
+        metrics = res.metrics
+        metrics['total_num'] += n_read
+        seq_arr = np.frombuffer(
+            ''.join(read[1][:width] for read in chunk).encode(), dtype=np.uint8).reshape(n_read, width)
+        qual_arr = np.frombuffer(
+            ''.join(read[2][:width] for read in chunk).encode(), dtype=np.uint8).reshape(n_read, width)
+        remain = np.ones(n_read, dtype=bool)
+
+        # polyT filter
+        no_polyT = np.zeros(n_read, dtype=bool)
+        if self.bool_T and (not self.allowNoPolyT):
+            no_polyT = (seq_arr[:, self.T_cols] == ord('T')).sum(axis=1) < MIN_T
+            remain &= ~no_polyT
+        metrics['no_polyT_num'] += int(no_polyT.sum())
+
+        # lowQual filter
+        if self.lowQual > 0:
+            n_low = ((qual_arr[:, self.CU_cols].astype(np.int16) - 33) < self.lowQual).sum(axis=1)
+            low = remain & (n_low > self.lowNum)
+            metrics['lowQual_num'] += int(low.sum())
+            remain &= ~low
+
+        # linker filter
+        no_linker = np.zeros(n_read, dtype=bool)
+        if self.bool_L and (not self.allowNoLinker):
+            bool_valid, bool_corrected, _ = self.correct_segments_batch(
+                seq_arr, self.pattern_dict['L'], self.linker_mismatch_dict_list)
+            no_linker = remain & ~bool_valid
+            metrics['no_linker_num'] += int(no_linker.sum())
+            metrics['linker_corrected_num'] += int((remain & bool_valid & bool_corrected).sum())
+            remain &= bool_valid
+
+        # barcode filter
+        if self.bool_whitelist:
+            bool_valid, bool_corrected, cb_arr = self.correct_segments_batch(
+                seq_arr, self.pattern_dict['C'], self.barcode_mismatch_dict_list)
+            metrics['no_barcode_num'] += int((remain & ~bool_valid).sum())
+            metrics['barcode_corrected_num'] += int((remain & bool_valid & bool_corrected).sum())
+            remain &= bool_valid
+        else:
+            cb_arr = seq_arr[:, self.C_cols]
+
+        clean_index = np.flatnonzero(remain)
+        metrics['clean_num'] += len(clean_index)
+        clean_qual_arr = qual_arr[clean_index]
+        res.barcode_qual_Counter = qual_counter(clean_qual_arr[:, self.C_cols])
+        res.umi_qual_Counter = qual_counter(clean_qual_arr[:, self.U_cols])
+
+        C_len = self.C_len
+        U_len = len(self.U_cols)
+        res.sketch = BarcodeSketch.from_reads(
+            np.ascontiguousarray(cb_arr[clean_index]).view(f'S{C_len}').ravel(),
+            np.ascontiguousarray(seq_arr[clean_index][:, self.U_cols]).view(f'S{U_len}').ravel(),
+        )
+        cb_str = cb_arr[clean_index].tobytes().decode()
+        umi_str = seq_arr[clean_index][:, self.U_cols].tobytes().decode()
+        if self.output_bam:
+            raw_cb_str = seq_arr[clean_index][:, self.C_cols].tobytes().decode()
+        out_fq2 = []
+        for i, read_index in enumerate(clean_index.tolist()):
+            read = chunk[read_index]
+            seq2, qual2 = read[4], read[5]
+            if self.trimmer:
+                seq2, qual2 = self.trimmer.trim(seq2, qual2, res.trim_metrics)
+                if seq2 is None:
+                    continue
+            cb = cb_str[i * C_len: (i + 1) * C_len]
+            umi = umi_str[i * U_len: (i + 1) * U_len]
+            if self.output_bam:
+                res.out_bam_records.append((
+                    f'{cb}_{umi}_{offset + read_index + 1}', seq2, qual2,
+                    raw_cb_str[i * C_len: (i + 1) * C_len], cb, umi))
+            else:
+                out_fq2.append(f'@{cb}_{umi}_{offset + read_index + 1}\n{seq2}\n+\n{qual2}\n')
+        res.out_fq2 = ''.join(out_fq2)
+
+        if self.output_nopolyT:
+            res.nopolyT_fq1, res.nopolyT_fq2 = get_fq_str(chunk, np.flatnonzero(no_polyT))
+        if self.output_noLinker:
+            res.noLinker_fq1, res.noLinker_fq2 = get_fq_str(chunk, np.flatnonzero(no_linker))
+        return res
+
+    def filter_chunk_by_read(self, chunk, offset):
+        """
+        Args:
+            chunk: list of (header1, seq1, qual1, header2, seq2, qual2)
+            offset: number of read pairs before this chunk. Used to make read IDs globally unique.
+        Returns:
+            ChunkResult
+        """
+        pattern_dict = self.pattern_dict
+        res = ChunkResult()
+        metrics = res.metrics
+        out_fq2 = []
+        nopolyT_fq1, nopolyT_fq2 = [], []
+        noLinker_fq1, noLinker_fq2 = [], []
+        barcode_quals = []
+        umi_quals = []
+        cb_list = []
+        umi_list = []
+
+        for read_index, (header1, seq1, qual1, header2, seq2, qual2) in enumerate(chunk, start=offset + 1):
+            # polyT filter
+            if self.bool_T and (not self.allowNoPolyT):
+                polyT = seq_ranges(seq1, pattern_dict['T'])
+                if polyT.count('T') < MIN_T:
+                    metrics['no_polyT_num'] += 1
+                    if self.output_nopolyT:
+                        nopolyT_fq1.append('@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
+                        nopolyT_fq2.append('@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
+                    continue
+
+            # lowQual filter
+            C_U_quals_ascii = seq_ranges(
+                qual1, pattern_dict['C'] + pattern_dict['U'])
+            if self.lowQual > 0 and low_qual(C_U_quals_ascii, self.lowQual, self.lowNum):
+                metrics['lowQual_num'] += 1
+                continue
+
+            # linker filter
+            if self.bool_L and (not self.allowNoLinker):
+                seq_list = get_seq_list(seq1, pattern_dict, 'L')
+                bool_valid, bool_corrected, _ = check_seq_mismatch(
+                    seq_list, self.linker_correct_set_list, self.linker_mismatch_dict_list)
+                if not bool_valid:
+                    metrics['no_linker_num'] += 1
+                    if self.output_noLinker:
+                        noLinker_fq1.append('@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
+                        noLinker_fq2.append('@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
+                    continue
+                elif bool_corrected:
+                    metrics['linker_corrected_num'] += 1
+
+            # barcode filter
+            seq_list = get_seq_list(seq1, pattern_dict, 'C')
+            if self.bool_whitelist:
+                bool_valid, bool_corrected, corrected_seq = check_seq_mismatch(
+                    seq_list, self.barcode_correct_set_list, self.barcode_mismatch_dict_list)
+
+                if not bool_valid:
+                    metrics['no_barcode_num'] += 1
+                    continue
+                elif bool_corrected:
+                    metrics['barcode_corrected_num'] += 1
+                cb = corrected_seq
+            else:
+                cb = "".join(seq_list)
+
+            umi = seq_ranges(seq1, pattern_dict['U'])
+
+            metrics['clean_num'] += 1
+            barcode_quals.append(C_U_quals_ascii[:self.C_len])
+            umi_quals.append(C_U_quals_ascii[self.C_len:])
+            cb_list.append(cb)
+            umi_list.append(umi)
+
+            if self.trimmer:
+                seq2, qual2 = self.trimmer.trim(seq2, qual2, res.trim_metrics)
+                if seq2 is None:
+                    continue
+            if self.output_bam:
+                raw_cb = seq_ranges(seq1, pattern_dict['C'])
+                res.out_bam_records.append((f'{cb}_{umi}_{read_index}', seq2, qual2, raw_cb, cb, umi))
+            else:
+                out_fq2.append(f'@{cb}_{umi}_{read_index}\n{seq2}\n+\n{qual2}\n')
+
+        metrics['total_num'] += len(chunk)
+        res.barcode_qual_Counter.update(''.join(barcode_quals))
+        res.umi_qual_Counter.update(''.join(umi_quals))
+        res.sketch = BarcodeSketch.from_reads(
+            np.array(cb_list, dtype=bytes), np.array(umi_list, dtype=bytes))
+        res.out_fq2 = ''.join(out_fq2)
+        res.nopolyT_fq1 = ''.join(nopolyT_fq1)
+        res.nopolyT_fq2 = ''.join(nopolyT_fq2)
+        res.noLinker_fq1 = ''.join(noLinker_fq1)
+        res.noLinker_fq2 = ''.join(noLinker_fq2)
+        return res
+
+
+def write_bam_records(bam, records):
+    """
+    write ChunkResult.out_bam_records to an unaligned BAM
+    """
+    for name, seq, qual, raw_cb, cb, umi in records:
+        segment = pysam.AlignedSegment(bam.header)
+        segment.query_name = name
+        segment.flag = 4
+        segment.query_sequence = seq
+        segment.query_qualities = pysam.qualitystring_to_array(qual)
+        segment.set_tags([('CR', raw_cb, 'Z'), ('CB', cb, 'Z'), ('UR', umi, 'Z'), ('UB', umi, 'Z')])
+        bam.write(segment)
+
+
+def write_chunk_result(chunk_result, fh3, fh_nopolyT, fh_noLinker, output_bam):
+    """
+    write reads of one filtered chunk
+    """
+    if output_bam:
+        write_bam_records(fh3, chunk_result.out_bam_records)
+    else:
+        fh3.write(chunk_result.out_fq2)
+    if fh_nopolyT:
+        fh_nopolyT[0].write(chunk_result.nopolyT_fq1)
+        fh_nopolyT[1].write(chunk_result.nopolyT_fq2)
+    if fh_noLinker:
+        fh_noLinker[0].write(chunk_result.noLinker_fq1)
+        fh_noLinker[1].write(chunk_result.noLinker_fq2)
+
+
+def init_filter_worker(read_filter_dict):
+    WORKER_STATE['read_filter_dict'] = read_filter_dict
+
+
+def filter_chunk_worker(chemistry, chunk, offset):
+    return WORKER_STATE['read_filter_dict'][chemistry].filter_chunk(chunk, offset)
+
+
 class Barcode(Step):
     """
     Features
@@ -261,11 +985,28 @@ class Barcode(Step):
         - Reads without correct barcode: the mismatch between barcodes and all barcodes in the whitelist is greater than 1.  
         - Reads without polyT: the number of T bases in the defined polyT region is less than 10.
         - Low quality reads: low sequencing quality in barcode and UMI regions.
+    - Read pairs are split into chunks and filtered by `--thread` worker processes. 
+    The output is the same as a single process run.
+    - If there are multiple lanes(fastq files), chunks of all lanes are filtered by the same worker processes 
+    in the input order, so all workers are busy even if there are fewer lanes than `--thread`.
+    - If `--fused_cutadapt` is used, adapters in valid R2 reads are trimmed in the barcode step. 
+    The output is the same as step cutadapt, so step cutadapt is not needed.
 
     Output
 
     - `01.barcode/{sample}_2.fq(.gz)` Demultiplexed R2 reads. Barcode and UMI are contained in the read name. The format of 
     the read name is `{barcode}_{UMI}_{read ID}`.
+    - `01.barcode/{sample}_clean_2.fq(.gz)` Only with `--fused_cutadapt`. Demultiplexed R2 reads without adapters. 
+    It replaces `{sample}_2.fq(.gz)`.
+    - `01.barcode/{sample}_2.bam` or `01.barcode/{sample}_clean_2.bam` Only with `--output_bam`. Unaligned BAM
+    which replaces the R2 fastq file. The read name is the same as the fastq file. BAM file contains tags as following:
+        - CR raw cell barcode
+        - CB corrected cell barcode
+        - UR raw UMI
+        - UB UMI
+    - `01.barcode/{sample}_barcode_count.tsv` Read count and UMI count of each barcode, sorted by UMI count. 
+    UMI counts are estimated by HyperLogLog(about 6.5% relative standard error for large counts), 
+    which are good enough to rank barcodes without reading the demultiplexed reads again.
     """
 
     def __init__(self, args, step_name):
@@ -277,8 +1018,11 @@ class Barcode(Step):
         if self.fq_number != len(self.fq2_list):
             raise Exception('fastq1 and fastq2 do not have same file number!')
         if args.chemistry == 'auto':
-            ch = Chemistry(args.fq1)
-            self.chemistry_list = ch.check_chemistry()
+            # reuse the chemistry detected in step sample
+            chemistry_cache = self.content_dict['data'].get('chemistry_cache', {})
+            ch = Chemistry(args.fq1, thread=self.thread)
+            self.chemistry_list = ch.check_chemistry(cache=chemistry_cache)
+            self.add_data_item(chemistry_cache=chemistry_cache)
         else:
             self.chemistry_list = [args.chemistry] * self.fq_number
         self.barcode_corrected_num = 0
@@ -291,6 +1035,7 @@ class Barcode(Step):
         self.no_barcode_num = 0
         self.barcode_qual_Counter = Counter()
         self.umi_qual_Counter = Counter()
+        self.sketch = BarcodeSketch()
         self.pattern = args.pattern
         self.linker = args.linker
         self.whitelist = args.whitelist
@@ -300,13 +1045,36 @@ class Barcode(Step):
         self.allowNoLinker = args.allowNoLinker
         self.nopolyT = args.nopolyT # true == output nopolyT reads
         self.noLinker = args.noLinker
+        self.chunk_size = CHUNK_SIZE
+        self.batch_filter = args.batch_filter
+        self.fused_cutadapt = args.fused_cutadapt
+        self.output_bam = args.output_bam
+        self.trimmer = None
+        self.trim_metrics = Counter()
+        if self.fused_cutadapt:
+            adapter_args = Cutadapt.read_adapter_fasta(args.adapter_fasta) + ADAPTER
+            self.trimmer = AdapterTrimmer(
+                adapter_args,
+                minimum_length=args.minimum_length,
+                nextseq_trim=args.nextseq_trim,
+                overlap=args.overlap,
+                insert=args.insert,
+            )
 
         # out file
         if args.gzip:
             suffix = ".gz"
         else:
             suffix = ""
-        self.out_fq2 = f'{self.outdir}/{self.sample}_2.fq{suffix}'
+        out_prefix = f'{self.outdir}/{self.sample}_2'
+        if self.fused_cutadapt:
+            out_prefix = f'{self.outdir}/{self.sample}_clean_2'
+            self.cutadapt_stat_file = f'{self.outdir}/cutadapt_stat.txt'
+        if self.output_bam:
+            self.out_fq2 = f'{out_prefix}.bam'
+        else:
+            self.out_fq2 = f'{out_prefix}.fq{suffix}'
+        self.barcode_count_file = f'{self.outdir}/{self.sample}_barcode_count.tsv'
         if self.nopolyT:
             self.nopolyT_1 = f'{self.outdir}/noPolyT_1.fq'
             self.nopolyT_2 = f'{self.outdir}/noPolyT_2.fq'
@@ -315,6 +1083,99 @@ class Barcode(Step):
             self.noLinker_2 = f'{self.outdir}/noLinker_2.fq'
 
 
+    @utils.add_log
+    def get_read_filter(self, chemistry):
+        """
+        get linker_mismatch_dict and barcode_mismatch_dict of this chemistry and
+        return a ReadFilter
+        """
+        lowNum = int(self.lowNum)
+        Barcode.get_read_filter.logger.info(f'lowQual score: {self.lowQual}')
+        lowQual = int(self.lowQual)
+        if chemistry == 'scopeV1':
+            lowNum = min(0, lowNum)
+            lowQual = max(10, lowQual)
+            Barcode.get_read_filter.logger.info(f'scopeV1: lowNum={lowNum}, lowQual={lowQual} ')
+        # get linker and whitelist
+        bc_pattern = __PATTERN_DICT__[chemistry]
+        if (bc_pattern):
+            (linker, whitelist) = get_scope_bc(chemistry)
+        else:
+            bc_pattern = self.pattern
+            linker = self.linker
+            whitelist = self.whitelist
+        if not bc_pattern:
+            raise Exception("invalid bc_pattern!")
+
+        # parse pattern to dict, C8L10C8L10C8U8
+        # defaultdict(<type 'list'>, {'C': [[0, 8], [18, 26], [36, 44]], 'U':
+        # [[44, 52]], 'L': [[8, 18], [26, 36]]})
+        pattern_dict = parse_pattern(bc_pattern)
+
+        bool_whitelist = (whitelist is not None) and whitelist != "None"
+        barcode_correct_set_list = None
+        barcode_mismatch_dict_list = None
+        linker_correct_set_list = None
+        linker_mismatch_dict_list = None
+
+        if bool_whitelist:
+            seq_list, _ = utils.read_one_col(whitelist)
+            barcode_correct_set, barcode_mismatch_dict = get_mismatch_index(seq_list, n_mismatch=1)
+            barcode_correct_set_list = [barcode_correct_set] * 3
+            barcode_mismatch_dict_list = [barcode_mismatch_dict] * 3
+        if 'L' in pattern_dict:
+            seq_list, _ = utils.read_one_col(linker)
+            check_seq(linker, pattern_dict, "L")
+            linker_correct_set_list = []
+            linker_mismatch_dict_list = []
+            start = 0
+            for item in pattern_dict['L']:
+                end = start + item[1] - item[0]
+                linker_seq_list = [seq[start:end] for seq in seq_list]
+                linker_correct_set, linker_mismatch_dict = get_mismatch_index(linker_seq_list, n_mismatch=2)
+                linker_correct_set_list.append(linker_correct_set)
+                linker_mismatch_dict_list.append(linker_mismatch_dict)
+                start = end
+
+        return ReadFilter(
+            pattern_dict=pattern_dict,
+            lowQual=lowQual,
+            lowNum=lowNum,
+            allowNoPolyT=self.allowNoPolyT,
+            allowNoLinker=self.allowNoLinker,
+            output_nopolyT=self.nopolyT,
+            output_noLinker=self.noLinker,
+            barcode_correct_set_list=barcode_correct_set_list,
+            barcode_mismatch_dict_list=barcode_mismatch_dict_list,
+            linker_correct_set_list=linker_correct_set_list,
+            linker_mismatch_dict_list=linker_mismatch_dict_list,
+            batch=self.batch_filter,
+            trimmer=self.trimmer,
+            output_bam=self.output_bam,
+        )
+
+    def add_chunk_result(self, chunk_result, fh3, fh_nopolyT, fh_noLinker):
+        """
+        write one filtered chunk and merge its counters
+        """
+        write_chunk_result(chunk_result, fh3, fh_nopolyT, fh_noLinker, self.output_bam)
+        for attr, value in chunk_result.metrics.items():
+            setattr(self, attr, getattr(self, attr) + value)
+        self.barcode_qual_Counter.update(chunk_result.barcode_qual_Counter)
+        self.umi_qual_Counter.update(chunk_result.umi_qual_Counter)
+        self.trim_metrics.update(chunk_result.trim_metrics)
+        self.sketch.update(chunk_result.sketch)
+
+    @utils.add_log
+    def iter_chunks(self):
+        """
+        Yield (chemistry, chunk) of all lanes in the input order.
+        """
+        for i in range(self.fq_number):
+            for chunk in read_pair_chunks(self.fq1_list[i], self.fq2_list[i], self.chunk_size):
+                yield self.chemistry_list[i], chunk
+            Barcode.iter_chunks.logger.info(self.fq1_list[i] + ' finished reading.')
+
     @utils.add_log
     def run(self):
         """
@@ -327,140 +1188,61 @@ class Barcode(Step):
         for every sample
             get chemistry
             get linker_mismatch_dict and barcode_mismatch_dict
-            for every read in read1
-                filter
-                write valid R2 read to file
+            split read pairs into chunks
+        filter chunks of all lanes with `thread` worker processes
+        write valid R2 read to file in the input order
         """
 
-        fh3 = xopen(self.out_fq2, 'w')
-
+        if self.output_bam:
+            fh3 = pysam.AlignmentFile(self.out_fq2, 'wb', header=UNALIGNED_BAM_HEADER, threads=int(self.thread))
+        else:
+            fh3 = utils.open_fastq_writer(
+                self.out_fq2,
+                compress_level=self.args.compress_level,
+                threads=self.args.compress_threads,
+                bgzf=self.args.bgzf,
+            )
+
+        fh_nopolyT = None
         if self.nopolyT:
-            fh1_without_polyT = xopen(self.nopolyT_1, 'w')
-            fh2_without_polyT = xopen(self.nopolyT_2, 'w')
+            fh_nopolyT = (xopen(self.nopolyT_1, 'w'), xopen(self.nopolyT_2, 'w'))
 
+        fh_noLinker = None
         if self.noLinker:
-            fh1_without_linker = xopen(self.noLinker_1, 'w')
-            fh2_without_linker = xopen(self.noLinker_2, 'w')
+            fh_noLinker = (xopen(self.noLinker_1, 'w'), xopen(self.noLinker_2, 'w'))
 
-        for i in range(self.fq_number):
-
-            chemistry = self.chemistry_list[i]
-            lowNum = int(self.lowNum)
-            Barcode.run.logger.info(f'lowQual score: {self.lowQual}')
-            lowQual = int(self.lowQual)
-            if chemistry == 'scopeV1':
-                lowNum = min(0, lowNum)
-                lowQual = max(10, lowQual)
-                Barcode.run.logger.info(f'scopeV1: lowNum={lowNum}, lowQual={lowQual} ')
-            # get linker and whitelist
-            bc_pattern = __PATTERN_DICT__[chemistry]
-            if (bc_pattern):
-                (linker, whitelist) = get_scope_bc(chemistry)
-            else:
-                bc_pattern = self.pattern
-                linker = self.linker
-                whitelist = self.whitelist
-            if not bc_pattern:
-                raise Exception("invalid bc_pattern!")
-
-            # parse pattern to dict, C8L10C8L10C8U8
-            # defaultdict(<type 'list'>, {'C': [[0, 8], [18, 26], [36, 44]], 'U':
-            # [[44, 52]], 'L': [[8, 18], [26, 36]]})
-            pattern_dict = parse_pattern(bc_pattern)
-
-            bool_T = True if 'T' in pattern_dict else False
-            bool_L = True if 'L' in pattern_dict else False
-            bool_whitelist = (whitelist is not None) and whitelist != "None"
-            C_len = sum([item[1] - item[0] for item in pattern_dict['C']])
-
-            if bool_whitelist:
-                seq_list, _ = utils.read_one_col(whitelist)
-                barcode_correct_set, barcode_mismatch_dict = get_all_mismatch(seq_list, n_mismatch=1)
-                barcode_correct_set_list = [barcode_correct_set] * 3
-                barcode_mismatch_dict_list = [barcode_mismatch_dict] * 3
-            if bool_L:
-                seq_list, _ = utils.read_one_col(linker)
-                check_seq(linker, pattern_dict, "L")
-                linker_correct_set_list = []
-                linker_mismatch_dict_list = []
-                start = 0
-                for item in pattern_dict['L']:
-                    end = start + item[1] - item[0]
-                    linker_seq_list = [seq[start:end] for seq in seq_list]
-                    linker_correct_set, linker_mismatch_dict = get_all_mismatch(linker_seq_list, n_mismatch=2)
-                    linker_correct_set_list.append(linker_correct_set)
-                    linker_mismatch_dict_list.append(linker_mismatch_dict)
-                    start = end
-
-            fq1 = pysam.FastxFile(self.fq1_list[i], persist=False)
-            fq2 = pysam.FastxFile(self.fq2_list[i], persist=False)
-
-            for entry1 in fq1:
-                entry2 = next(fq2)
-                header1, seq1, qual1 = entry1.name, entry1.sequence, entry1.quality
-                header2, seq2, qual2 = entry2.name, entry2.sequence, entry2.quality
-                self.total_num += 1
-
-                # polyT filter
-                if bool_T and (not self.allowNoPolyT):
-                    polyT = seq_ranges(seq1, pattern_dict['T'])
-                    if polyT.count('T') < MIN_T:
-                        self.no_polyT_num += 1
-                        if self.nopolyT:
-                            fh1_without_polyT.write(
-                                '@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
-                            fh2_without_polyT.write(
-                                '@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
-                        continue
-
-                # lowQual filter                
-                C_U_quals_ascii = seq_ranges(
-                    qual1, pattern_dict['C'] + pattern_dict['U'])
-                # C_U_quals_ord = [ord(q) - 33 for q in C_U_quals_ascii]
-                if lowQual > 0 and low_qual(C_U_quals_ascii, lowQual, lowNum):
-                    self.lowQual_num += 1
-                    continue
-
-                # linker filter
-                if bool_L and (not self.allowNoLinker):
-                    seq_list = get_seq_list(seq1, pattern_dict, 'L')
-                    bool_valid, bool_corrected, _ = check_seq_mismatch(
-                        seq_list, linker_correct_set_list, linker_mismatch_dict_list)
-                    if not bool_valid:
-                        self.no_linker_num += 1
-                        if self.noLinker:
-                            fh1_without_linker.write(
-                                '@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
-                            fh2_without_linker.write(
-                                '@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
-                        continue
-                    elif bool_corrected:
-                        self.linker_corrected_num += 1
-                
-                # barcode filter
-                seq_list = get_seq_list(seq1, pattern_dict, 'C')
-                if bool_whitelist:
-                    bool_valid, bool_corrected, corrected_seq = check_seq_mismatch(
-                        seq_list, barcode_correct_set_list, barcode_mismatch_dict_list)
-
-                    if not bool_valid:
-                        self.no_barcode_num += 1
-                        continue
-                    elif bool_corrected:
-                        self.barcode_corrected_num += 1
-                    cb = corrected_seq
-                else:
-                    cb = "".join(seq_list)
+        n_worker = int(self.thread)
+        Barcode.run.logger.info(f'worker processes: {n_worker}')
 
-                umi = seq_ranges(seq1, pattern_dict['U'])
+        # fastq files with the same chemistry share the same read_filter and mismatch index
+        read_filter_dict = {}
+        for chemistry in self.chemistry_list:
+            if chemistry not in read_filter_dict:
+                read_filter_dict[chemistry] = self.get_read_filter(chemistry)
 
-                self.clean_num += 1
-                self.barcode_qual_Counter.update(C_U_quals_ascii[:C_len])
-                self.umi_qual_Counter.update(C_U_quals_ascii[C_len:])
+        if n_worker <= 1:
+            for chemistry, chunk in self.iter_chunks():
+                chunk_result = read_filter_dict[chemistry].filter_chunk(chunk, self.total_num)
+                self.add_chunk_result(chunk_result, fh3, fh_nopolyT, fh_noLinker)
+        else:
+            with multiprocessing.Pool(
+                n_worker, initializer=init_filter_worker, initargs=(read_filter_dict,)
+            ) as pool:
+                # keep a bounded number of chunks in flight and write results in input order.
+                # chunks of all lanes share the pool, read IDs are numbered as reads are read.
+                pending = deque()
+                offset = self.total_num
+                for chemistry, chunk in self.iter_chunks():
+                    pending.append(pool.apply_async(filter_chunk_worker, (chemistry, chunk, offset)))
+                    offset += len(chunk)
+                    if len(pending) >= n_worker * 2:
+                        self.add_chunk_result(pending.popleft().get(), fh3, fh_nopolyT, fh_noLinker)
+                while pending:
+                    self.add_chunk_result(pending.popleft().get(), fh3, fh_nopolyT, fh_noLinker)
 
-                fh3.write(f'@{cb}_{umi}_{self.total_num}\n{seq2}\n+\n{qual2}\n')
-            Barcode.run.logger.info(self.fq1_list[i] + ' finished.')
         fh3.close()
+        for fh in (fh_nopolyT or ()) + (fh_noLinker or ()):
+            fh.close()
 
         # logging
         Barcode.run.logger.info(
@@ -479,6 +1261,8 @@ class Barcode(Step):
             raise Exception(
                 'no valid reads found! please check the --chemistry parameter.')
 
+        self.sketch.to_df().to_csv(self.barcode_count_file, sep='\t', index=False)
+
         # stat
         BarcodesQ30 = sum([self.barcode_qual_Counter[k] for k in self.barcode_qual_Counter if k >= ord2chr(
             30)]) / float(sum(self.barcode_qual_Counter.values())) * 100
@@ -498,7 +1282,13 @@ class Barcode(Step):
                                     UMIsQ30)
             stat_info = re.sub(r'^\s+', r'', stat_info, flags=re.M)
             fh.write(stat_info)
-        
+
+        if self.fused_cutadapt:
+            # same summary as step cutadapt
+            AdapterTrimmer.write_stat(self.trim_metrics, self.cutadapt_stat_file)
+            self.stat_to_metric(self.cutadapt_stat_file, 'cutadapt')
+            self.stat_to_data(self.cutadapt_stat_file, 'cutadapt')
+
         self.clean_up()
 
 
@@ -575,6 +1365,25 @@ lowQual will be regarded as low-quality bases.',
         help="Output gzipped fastq files.", 
         action='store_true'
     )
+    parser.add_argument(
+        '--batch_filter',
+        help="Filter R1 reads in batches with numpy instead of one read at a time. The output is the same.",
+        action='store_true'
+    )
+    parser.add_argument(
+        '--fused_cutadapt',
+        help="""Trim adapters in valid R2 reads while writing them and output `{sample}_clean_2.fq(.gz)`. 
+Step cutadapt is not needed.""",
+        action='store_true'
+    )
+    parser.add_argument(
+        '--output_bam',
+        help="""Output R2 reads to an unaligned BAM file with `CB`/`UB`/`CR`/`UR` tags instead of a fastq file. 
+The BAM file can be used as the STAR input. Only supported in `multi_rna`, use it with `--fused_cutadapt`.""",
+        action='store_true'
+    )
+    # trimming arguments used by `--fused_cutadapt` and compression arguments of output fastq
+    get_opts_cutadapt(parser, sub_program=False)
     if sub_program:
         parser.add_argument('--fq1', help='R1 fastq file. Multiple files are separated by comma.', required=True)
         parser.add_argument('--fq2', help='R2 fastq file. Multiple files are separated by comma.', required=True)
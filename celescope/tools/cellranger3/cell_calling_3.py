@@ -1,16 +1,11 @@
-import os
 import random
 from collections import namedtuple
 
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
-import scipy.io
 
 import celescope.tools.cellranger3.sgt as cr_sgt  # # modified sgt.py
 import celescope.tools.cellranger3.stats as cr_stats  # # modified stats.py
-from celescope.tools.__init__ import (BARCODE_FILE_NAME, FEATURE_FILE_NAME,
-                                      MATRIX_FILE_NAME)
 
 # Set random seed
 random.seed(0)
@@ -96,11 +91,13 @@ def est_background_profile_sgt(matrix, use_bcs):
 def find_nonambient_barcodes(raw_mat, recovered_cells,
                              min_umi_frac_of_median=MIN_UMI_FRAC_OF_MEDIAN,
                              min_umis_nonambient=MIN_UMIS,
-                             max_adj_pvalue=MAX_ADJ_PVALUE,):
+                             max_adj_pvalue=MAX_ADJ_PVALUE, thread=1, umis_per_bc=None):
     """ Call barcodes as being sufficiently distinct from the ambient profile
     Args:
       raw_mat: raw matrix of UMI counts
       recovered_cells: expected number of recovered cells
+      thread: number of processes to simulate ambient log-likelihoods
+      umis_per_bc: UMI counts of raw_mat columns. Computed from raw_mat if None.
     Returns:
     TBD
     """
@@ -113,7 +110,8 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
                                       ])
     
     # Estimate an ambient RNA profile
-    umis_per_bc = np.squeeze(np.asarray(raw_mat.sum(axis=0)))
+    if umis_per_bc is None:
+        umis_per_bc = np.squeeze(np.asarray(raw_mat.sum(axis=0)))
     # get the index of sorted umis_per_bc (ascending, bc_order[0] is the index of the smallest element in umis_per_bc)
     bc_order = np.argsort(umis_per_bc)
 
@@ -193,14 +191,15 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         obs_loglk = cr_stats.eval_multinomial_loglikelihoods(eval_mat, ambient_profile_p)
 
         # Simulate log likelihoods
+        # Simulations stop early for barcodes whose p-values are certainly above max_adj_pvalue
         distinct_ns, sim_loglk = cr_stats.simulate_multinomial_loglikelihoods(ambient_profile_p, umis_per_bc[eval_bcs], 
-                                                                              num_sims=10000, verbose=True)
+                                                                              num_sims=10000, verbose=True, thread=thread,
+                                                                              obs_loglk=obs_loglk, max_pvalue=max_adj_pvalue)
 
         # Compute p-values
         pvalues = cr_stats.compute_ambient_pvalues(umis_per_bc[eval_bcs], obs_loglk, distinct_ns, sim_loglk)
 
         pvalues_adj = adjust_pvalue_bh(pvalues)
-        max_adj_pvalue = 0.01
         is_nonambient = pvalues_adj <= max_adj_pvalue
 
         print('Number of non-ambient barcodes from SGT:', len(eval_bcs[is_nonambient]))
@@ -220,25 +219,24 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         )
 
 
-def cell_calling_3(all_matrix_10X_dir, expected_cell_num):
-
-    raw_mat_path = os.path.join(all_matrix_10X_dir, MATRIX_FILE_NAME)
-    raw_mat = scipy.io.mmread(raw_mat_path) # scipy.sparse.coo.coo_matrix
-
-    raw_features_path = os.path.join(all_matrix_10X_dir, FEATURE_FILE_NAME)
-    raw_features_df = pd.read_csv(raw_features_path, sep='\t', error_bad_lines=False, names=['id','name','type'])
-    raw_features_df['id'].tolist()
-    raw_features_df['name'].tolist()
-    raw_features_df['type'].tolist()
-
-    raw_barcodes_path = os.path.join(all_matrix_10X_dir, BARCODE_FILE_NAME)
-    raw_barcodes_df = pd.read_csv(raw_barcodes_path, sep='\t', error_bad_lines=False, names=['barcode'])
-    raw_barcodes = np.array(raw_barcodes_df['barcode'].tolist())
+def cell_calling_3(raw_mat, raw_barcodes, expected_cell_num, thread=1, umis_per_bc=None):
+    """
+    Args:
+      raw_mat: gene x barcode csc_matrix of UMI counts of all barcodes
+      raw_barcodes: barcodes of raw_mat columns
+      expected_cell_num: expected number of recovered cells
+      thread: number of processes to simulate ambient log-likelihoods
+      umis_per_bc: UMI counts of raw_mat columns. Computed from raw_mat if None.
+    Returns:
+      cell_bc: cell barcodes
+      initial_cell_num: number of cells called by the first round(ordmag)
+    """
+    raw_barcodes = np.array(raw_barcodes)
 
     ### Run cell calling
     filtered_bc_indices, round_1_filtered_metrics, _non_ambient_barcode_result = find_nonambient_barcodes(
-        raw_mat=raw_mat,recovered_cells=expected_cell_num)
+        raw_mat=raw_mat, recovered_cells=expected_cell_num, thread=thread, umis_per_bc=umis_per_bc)
     
     cell_bc = raw_barcodes[filtered_bc_indices]
     initial_cell_num = round_1_filtered_metrics['filtered_bcs']
-    return cell_bc, initial_cell_num
\ No newline at end of file
+    return cell_bc, initial_cell_num
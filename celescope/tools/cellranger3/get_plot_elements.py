@@ -36,6 +36,8 @@ CHARTS_PLOTLY_MOVABLE_CONFIG = {
     'showLink': False
 }
 BC_RANK_PLOT_LINE_WIDTH = 3
+# Maximum number of log-spaced points of the barcode rank plot
+BC_RANK_PLOT_MAX_POINTS = 2000
 # Gradient scheme used in the barcode rank plot
 BC_PLOT_COLORS = ['#dddddd', '#d1d8dc', '#c6d3dc', '#bacfdb', '#aecada', '#a3c5d9', '#97c0d9', '#8cbbd8', '#80b7d7',
                       '#74b2d7', '#6aadd6', '#66abd4', '#62a8d2', '#5ea5d1', '#59a2cf', '#559fce', '#519ccc', '#4d99ca',
@@ -84,12 +86,13 @@ def BC_PLOT_CMAP(density):
     return BC_PLOT_COLORS[ind]
 
 
-def get_plot_segment(start_index, end_index, sorted_bc, cell_barcodes, legend=False):
+def get_plot_segment(start_index, end_index, cell_cumsum, legend=False):
     """
     Helper function to build a plot segment.
+    - cell_cumsum: number of cells in sorted barcodes [0, i) at index i
     """
     assert end_index > start_index
-    num_cells = sum([1 for i in range(start_index, end_index) if sorted_bc[i] in cell_barcodes])
+    num_cells = cell_cumsum[end_index] - cell_cumsum[start_index]
     density = float(num_cells)/float(end_index-start_index)
     return BarcodeRankPlotSegment(start=start_index, end=end_index, cell_density=density, legend=legend)
 
@@ -111,17 +114,31 @@ def segment_log_plot_by_length(y_data, x_start, x_end):
     log_max_x = np.log(len(y_data))
     log_max_y = np.log(max(y_data))
 
-    this_segment_len = 0.0
-    segment_idx = [x_start]
-
-    for i in range(x_start, x_end):
-        last_i = max(x_start, i-1)
+    i = np.arange(x_start, x_end)
+    last_i = np.maximum(x_start, i - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
         dx = (np.log(i) - np.log(last_i)) / log_max_x
         dy = (np.log(y_data[i]) - np.log(y_data[last_i])) / log_max_y
-        this_segment_len += np.linalg.norm([dx, dy])
-        if this_segment_len >= SEGMENT_NORMALIZED_MAX_LEN and i > (segment_idx[-1] + MIN_X_SPAN):
-            segment_idx.append(i+1)
-            this_segment_len = 0.0
+    step_len = np.hypot(dx, dy)
+    # log(0) at x_start 0
+    step_len[np.isnan(step_len)] = 0
+    cum_len = np.cumsum(step_len)
+
+    segment_idx = [x_start]
+    segment_start_len = 0.0
+    j = 0
+    while True:
+        # first i with this_segment_len >= SEGMENT_NORMALIZED_MAX_LEN and i > (segment_idx[-1] + MIN_X_SPAN)
+        j = max(
+            j,
+            np.searchsorted(cum_len, segment_start_len + SEGMENT_NORMALIZED_MAX_LEN, side='left'),
+            segment_idx[-1] + MIN_X_SPAN + 1 - x_start,
+        )
+        if j >= len(cum_len):
+            break
+        segment_idx.append(int(x_start + j + 1))
+        segment_start_len = cum_len[j]
+        j += 1
 
     if segment_idx[-1] != x_end:
         segment_idx.append(x_end)
@@ -130,20 +147,37 @@ def segment_log_plot_by_length(y_data, x_start, x_end):
 
 
 def convert_numpy_array_to_line_chart(array, ntype):
+    """
+    Keep the first and the last index, and the two ends of each run of equal counts.
+    """
     array = np.sort(array)[::-1]
+    if len(array) == 0:
+        return []
 
-    rows = []
-    previous_count = None
-    for (index,), count in np.ndenumerate(array):
-        if index == 0 or index == len(array)-1:
-            rows.append([index, ntype(count)])
-        elif previous_count != count:
-            previous_index = rows[-1][0]
-            if previous_index != index - 1:
-                rows.append([index - 1, ntype(previous_count)])
-            rows.append([index, ntype(count)])
-        previous_count = count
-    return rows
+    is_change = np.zeros(len(array), dtype=bool)
+    is_change[1:] = array[1:] != array[:-1]
+    is_row = is_change.copy()
+    is_row[[0, -1]] = True
+    # the end of the previous run
+    is_row[:-2] |= is_change[1:-1]
+    index = np.flatnonzero(is_row)
+    return [[i, ntype(count)] for i, count in zip(index.tolist(), array[index].tolist())]
+
+
+def get_log_decimation_mask(x, max_x, max_points):
+    """
+    Split [1, max_x] into max_points bins of the same width in log scale, and keep the first x in each bin.
+    The first and the last x are always kept.
+    Args:
+        x: ascending positive numbers
+    """
+    x = np.asarray(x, dtype=float)
+    keep = np.ones(len(x), dtype=bool)
+    if max_x > 1:
+        bins = np.floor(np.log(x) / np.log(max_x) * max_points)
+        keep[1:] = bins[1:] != bins[:-1]
+    keep[-1:] = True
+    return keep
 
 
 @add_log
@@ -153,25 +187,19 @@ def counter_barcode_rank_plot_data(count_data_path):
     :param count_data_path:
     :return: sorted_counts, plot_segments, cell_nums
     """
-    count_data = pd.read_csv(count_data_path, index_col=0, sep='\t')
-    cell_bc = np.array(count_data[count_data['mark'] == 'CB'].index)
-    sorted_bc = np.array(count_data.index)
-    sorted_counts = np.array(count_data['UMI'])
-    cell_nums = len(cell_bc)
-    total_bc = len(sorted_bc)
+    count_data = pd.read_csv(count_data_path, index_col=0, sep='\t', usecols=['Barcode', 'UMI', 'mark'])
+    is_cell = (count_data['mark'] == 'CB').values
+    sorted_counts = count_data['UMI'].values
+    cell_nums = int(is_cell.sum())
+    total_bc = len(is_cell)
+    cell_cumsum = np.concatenate(([0], np.cumsum(is_cell)))
     # find the first barcode which is not a cell
-    first_non_cell = total_bc
-    for i, bc in enumerate(sorted_bc):
-        if bc not in cell_bc:
-            first_non_cell = i
-            break
+    non_cell_index = np.flatnonzero(~is_cell)
+    first_non_cell = int(non_cell_index[0]) if len(non_cell_index) else total_bc
 
     # find the last barcode which is a cell
-    last_cell = 0
-    for i in reversed(range(total_bc)):
-        if sorted_bc[i] in cell_bc:
-            last_cell = i
-            break
+    cell_index = np.flatnonzero(is_cell)
+    last_cell = int(cell_index[-1]) if len(cell_index) else 0
 
     ranges = [0, first_non_cell, last_cell+1, total_bc]
     plot_segments = []
@@ -181,7 +209,7 @@ def counter_barcode_rank_plot_data(count_data_path):
     mixed_segments = segment_log_plot_by_length(sorted_counts, ranges[1], ranges[2])
     for i in range(len(mixed_segments) - 1):
         plot_segments.append(
-            get_plot_segment(mixed_segments[i], mixed_segments[i + 1], sorted_bc, cell_bc, legend=False))
+            get_plot_segment(mixed_segments[i], mixed_segments[i + 1], cell_cumsum, legend=False))
 
     return sorted_counts, plot_segments, cell_nums
 
@@ -213,7 +241,7 @@ def _plot_barcode_rank(chart, counts, num_cells):
     return chart
 
 
-def build_plot_data_dict(plot_segment, counts):
+def build_plot_data_dict(plot_segment, counts, max_points=None):
     """
     Construct the data for a plot segment by appropriately slicing the
     counts
@@ -221,6 +249,7 @@ def build_plot_data_dict(plot_segment, counts):
     - plot_segment: BarcodeRankPlotSegment containing [start, end)
         of the segment, the cell density and legend visibility option
     - counts: Reverse sorted UMI counts for all barcodes.
+    - max_points: If not None, points are decimated to at most max_points log-spaced bins of all barcodes.
     """
 
     start = max(0, plot_segment.start - 1)  # -1 for continuity between two charts
@@ -251,6 +280,9 @@ def build_plot_data_dict(plot_segment, counts):
         "showlegend": plot_segment.legend,
     }
     offset = 1 + start  # it's a log-log plot, hence the 1
+    if max_points is not None and plot_rows:
+        keep = get_log_decimation_mask([index + offset for index, _count in plot_rows], len(counts), max_points)
+        plot_rows = [row for row, is_kept in zip(plot_rows, keep) if is_kept]
     for index, count in plot_rows:
         data_dict["x"].append(index + offset)
         data_dict["y"].append(count)
@@ -279,17 +311,22 @@ def _plot_counter_barcode_rank(chart, counts, plot_segments):
 
 
 @add_log
-def get_plot_data(plot_segments, counts):
+def get_plot_data(plot_segments, counts, max_points=None):
     plot_data = []
     for segment in plot_segments:
-        plot_data.append(build_plot_data_dict(segment, counts))
+        plot_data.append(build_plot_data_dict(segment, counts, max_points))
 
     return plot_data
 
 
-def plot_barcode_rank(count_file_path):
+def plot_barcode_rank(count_file_path, max_points=BC_RANK_PLOT_MAX_POINTS):
+    """
+    Args:
+        max_points: points of all segments are decimated to at most max_points log-spaced bins.
+            Each segment keeps its first and last point. None to plot all points.
+    """
     sorted_counts, plot_segments, _cell_nums = counter_barcode_rank_plot_data(count_file_path)
-    plot_data = get_plot_data(plot_segments, sorted_counts)
+    plot_data = get_plot_data(plot_segments, sorted_counts, max_points)
 
     plotly_data = [go.Scatter(x=dat['x'], y=dat['y'], name=dat['name'], mode=dat['mode'], showlegend=dat['showlegend'],
                               marker={'color': dat['line']['color']}, line=dat['line'], text=dat['text']) for dat in
@@ -3,11 +3,18 @@
 # Copyright (c) 2015 10X Genomics, Inc. All rights reserved.
 #
 
-import sys
+import multiprocessing
 
 import numpy as np
+import scipy.sparse as sp_sparse
+import scipy.special as sp_special
 import scipy.stats as sp_stats
 
+# Number of simulations vectorized in one process
+SIMS_PER_BATCH = 250
+# Number of simulations between two early stop checks
+SIMS_PER_ROUND = 2000
+
 # import cellranger.constants as cr_constants
 # import tenkit.constants as tk_constants
 # import tenkit.seq as tk_seq
@@ -337,104 +344,243 @@ def est_background_profile_bottom(matrix, bottom_frac):
     return (nz_feat, bg_profile_p)
 
 
-def eval_multinomial_loglikelihoods(matrix, profile_p, max_mem_gb=0.1):
+def eval_multinomial_loglikelihoods(matrix, profile_p):
     """Compute the multinomial log PMF for many barcodes
+       Same as sp_stats.multinomial.logpmf on each dense column, but only nonzero entries are evaluated:
+       log_pmf = gammaln(n+1) - sum(gammaln(x+1)) + sum(x*log(p))
     Args:
       matrix (scipy.sparse.csc_matrix): Matrix of UMI counts (feature x barcode)
       profile_p (np.ndarray(float)): Multinomial probability vector
-      max_mem_gb (float): Try to bound memory usage.
     Returns:
       log_likelihoods (np.ndarray(float)): Log-likelihood for each barcode
     """
-    gb_per_bc = float(matrix.shape[0] * matrix.dtype.itemsize) / (1024**3)
-    bcs_per_chunk = max(1, int(round(max_mem_gb/gb_per_bc)))
+    matrix = sp_sparse.csc_matrix(matrix)
+    matrix.eliminate_zeros()
     num_bcs = matrix.shape[1]
 
-    loglk = np.zeros(num_bcs)
+    counts = matrix.data.astype(float)
+    bc_index = np.repeat(np.arange(num_bcs), np.diff(matrix.indptr))
+    with np.errstate(divide='ignore'):
+        log_profile_p = np.log(profile_p)
+    n = np.bincount(bc_index, weights=counts, minlength=num_bcs)
+    loglk = np.bincount(
+        bc_index,
+        weights=counts * log_profile_p[matrix.indices] - sp_special.gammaln(counts + 1),
+        minlength=num_bcs,
+    )
+    loglk += sp_special.gammaln(n + 1)
+    return loglk
+
 
-    for chunk_start in range(0, num_bcs, bcs_per_chunk):
-        chunk = slice(chunk_start, chunk_start+bcs_per_chunk)
-        matrix_chunk = matrix[:,chunk].transpose().toarray()
-        n = matrix_chunk.sum(1)
-        loglk[chunk] = sp_stats.multinomial.logpmf(matrix_chunk, n, p=profile_p)
+def add_multinomial_counts(counts, loglk, cells, cell_counts, log_profile_p, log_factorial):
+    """Add counts to (simulation, feature) cells of a count matrix and update the log-likelihood sums
+       sum(x*log(p)) - sum(gammaln(x+1)) of the changed simulations in place.
+    Args:
+      counts (np.ndarray(int)): num_sims x num_features count matrix
+      loglk (np.ndarray(float)): Log-likelihood sums of each simulation
+      cells (np.ndarray(int)): Unique flat indices of counts
+      cell_counts (np.ndarray(int)): Counts added to each cell
+      log_profile_p (np.ndarray(float)): Log probability of each feature
+      log_factorial (np.ndarray(float)): gammaln(x+1) of x up to the largest count
+    """
+    num_features = counts.shape[1]
+    flat_counts = counts.reshape(-1)
+    old_counts = flat_counts[cells]
+    new_counts = old_counts + cell_counts
+    flat_counts[cells] = new_counts
+    sims = cells // num_features
+    features = cells - sims * num_features
+    delta = cell_counts * log_profile_p[features] - log_factorial[new_counts] + log_factorial[old_counts]
+    loglk += np.bincount(sims, weights=delta, minlength=len(loglk))
+
+
+def get_alias_table(profile_p):
+    """Walker's alias table to draw features in constant time
+    Args:
+      profile_p (np.ndarray(float)): Probability of observing each feature.
+    Returns:
+      (alias_prob (np.ndarray(float)), alias_index (np.ndarray(int))):
+      feature i is drawn with probability alias_prob[i], otherwise alias_index[i] is drawn.
+    """
+    num_features = len(profile_p)
+    alias_prob = np.asarray(profile_p, dtype=float) * num_features / np.sum(profile_p)
+    alias_index = np.arange(num_features)
+    small = np.flatnonzero(alias_prob < 1).tolist()
+    large = np.flatnonzero(alias_prob >= 1).tolist()
+    while small and large:
+        small_idx = small.pop()
+        large_idx = large[-1]
+        alias_index[small_idx] = large_idx
+        alias_prob[large_idx] -= 1 - alias_prob[small_idx]
+        if alias_prob[large_idx] < 1:
+            small.append(large.pop())
+    # remaining features are only off by rounding errors
+    alias_prob[small + large] = 1
+    return alias_prob, alias_index
+
+
+def draw_features(rng, alias_table, size):
+    alias_prob, alias_index = alias_table
+    uniform = rng.random_sample(size) * len(alias_prob)
+    features = uniform.astype(np.int64)
+    # the fractional part is another uniform sample
+    return np.where(uniform - features < alias_prob[features], features, alias_index[features])
+
+
+def simulate_loglk_batch(profile_p, alias_table, distinct_n, num_sims, jump, seed):
+    """Simulate multinomial log-likelihoods for a batch of simulations, vectorized across simulations.
+       Every simulation draws distinct_n[0] features, then adds draws up to each following N.
+    Args:
+      profile_p (np.ndarray(float)): Probability of observing each feature.
+      alias_table (tuple): Alias table of profile_p from get_alias_table.
+      distinct_n (np.ndarray(int)): Ascending distinct N values.
+      num_sims (int): Number of simulations in this batch.
+      jump (int): Draw a multinomial count matrix if the gap between two distinct Ns exceeds this.
+        Otherwise draw each feature from the alias table.
+      seed (int): Seed of the random generator of this batch.
+    Returns:
+      log_likelihoods (np.ndarray(float)): len(distinct_n) x num_sims matrix
+    """
+    rng = np.random.RandomState(seed)
+    num_features = len(profile_p)
+    with np.errstate(divide='ignore'):
+        log_profile_p = np.log(profile_p)
+    sim_offsets = np.arange(num_sims, dtype=np.int64)[:, None] * num_features
+
+    log_factorial = sp_special.gammaln(np.arange(distinct_n[-1] + 1) + 1)
+    counts = np.zeros((num_sims, num_features), dtype=np.int32)
+    curr_loglk = np.zeros(num_sims)
+    loglk = np.zeros((len(distinct_n), num_sims))
+    prev_n = 0
+    for i, n in enumerate(distinct_n):
+        step = n - prev_n
+        if step >= jump:
+            step_counts = rng.multinomial(step, profile_p, size=num_sims)
+            cells = np.flatnonzero(step_counts)
+            cell_counts = step_counts.reshape(-1)[cells]
+        else:
+            features = draw_features(rng, alias_table, (num_sims, step))
+            cells, cell_counts = np.unique(features + sim_offsets, return_counts=True)
+        add_multinomial_counts(counts, curr_loglk, cells, cell_counts, log_profile_p, log_factorial)
+        curr_loglk += log_factorial[n] - log_factorial[prev_n]
+        loglk[i] = curr_loglk
+        prev_n = n
     return loglk
 
 
+def simulate_loglk_batch_worker(args):
+    return simulate_loglk_batch(*args)
+
+
 def simulate_multinomial_loglikelihoods(profile_p, umis_per_bc,
-                                        num_sims=1000, jump=1000,
-                                        n_sample_feature_block=1000000, verbose=False):
+                                        num_sims=1000, jump=1000, verbose=False, thread=1,
+                                        obs_loglk=None, max_pvalue=None):
     """Simulate draws from a multinomial distribution for various values of N.
        Uses the approximation from Lun et al. ( https://www.biorxiv.org/content/biorxiv/early/2018/04/04/234872.full.pdf )
+       Simulations are split into batches of SIMS_PER_BATCH with seeds drawn from np.random, and batches are run by
+       `thread` processes. The result does not depend on `thread`.
+       If obs_loglk and max_pvalue are given, simulations are run in rounds of SIMS_PER_ROUND. After each round,
+       barcodes whose p-value can not be lower than max_pvalue any more are dropped, and the following rounds only
+       simulate the range of N of the remaining barcodes.
     Args:
       profile_p (np.ndarray(float)): Probability of observing each feature.
       umis_per_bc (np.ndarray(int)): UMI counts per barcode (multinomial N).
       num_sims (int): Number of simulations per distinct N value.
       jump (int): Vectorize the sampling if the gap between two distinct Ns exceeds this.
-      n_sample_feature_block (int): Vectorize this many feature samplings at a time.
+      thread (int): Number of processes.
+      obs_loglk (np.ndarray(float)): Observed log-likelihoods of each barcode.
+      max_pvalue (float): Stop simulating barcodes with p-values above this.
     Returns:
       (distinct_ns (np.ndarray(int)), log_likelihoods (np.ndarray(float)):
       distinct_ns is an array containing the distinct N values that were simulated.
       log_likelihoods is a len(distinct_ns) x num_sims matrix containing the
-        simulated log likelihoods.
+        simulated log likelihoods. Skipped simulations are nan.
     """
     distinct_n = np.flatnonzero(np.bincount(umis_per_bc))
 
-    loglk = np.zeros((len(distinct_n), num_sims), dtype=float)
+    loglk = np.full((len(distinct_n), num_sims), np.nan)
     num_all_n = np.max(distinct_n) - np.min(distinct_n)
     if verbose:
         print('Number of distinct N supplied: %d' % len(distinct_n))
         print('Range of N: %d' % num_all_n)
         print('Number of features: %d' % len(profile_p))
 
-    sampled_features = np.random.choice(len(profile_p), size=n_sample_feature_block, p=profile_p, replace=True)
-    k = 0
-
-    log_profile_p = np.log(profile_p)
-
-    for sim_idx in range(num_sims):
-        if verbose and sim_idx % 100 == 99:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        curr_counts = np.ravel(sp_stats.multinomial.rvs(distinct_n[0], profile_p, size=1))
-
-        curr_loglk = sp_stats.multinomial.logpmf(curr_counts, distinct_n[0], p=profile_p)
-
-        loglk[0, sim_idx] = curr_loglk
-
-        for i in range(1, len(distinct_n)):
-            step = distinct_n[i] - distinct_n[i-1]
-            if step >= jump:
-                # Instead of iterating for each n, sample the intermediate ns all at once
-                curr_counts += np.ravel(sp_stats.multinomial.rvs(step, profile_p, size=1))
-                curr_loglk = sp_stats.multinomial.logpmf(curr_counts, distinct_n[i], p=profile_p)
-                assert not np.isnan(curr_loglk)
-            else:
-                # Iteratively sample between the two distinct values of n
-                for n in range(distinct_n[i-1]+1, distinct_n[i]+1):
-                    j = sampled_features[k]
-                    k += 1
-                    if k >= n_sample_feature_block:
-                        # Amortize this operation
-                        sampled_features = np.random.choice(len(profile_p), size=n_sample_feature_block, p=profile_p, replace=True)
-                        k = 0
-                    curr_counts[j] += 1
-                    curr_loglk += log_profile_p[j] + np.log(float(n)/curr_counts[j])
-
-            loglk[i, sim_idx] = curr_loglk
-
-    if verbose:
-        sys.stdout.write('\n')
+    alias_table = get_alias_table(profile_p)
+    batch_seeds = np.random.randint(np.iinfo(np.int32).max, size=(num_sims - 1) // SIMS_PER_BATCH + 1)
+    sim_n_idx = np.searchsorted(distinct_n, umis_per_bc)
+    is_undecided = np.ones(len(umis_per_bc), dtype=bool)
+    early_stop = obs_loglk is not None and max_pvalue is not None
+    if early_stop:
+        num_lower_loglk = np.zeros(len(umis_per_bc), dtype=int)
+        # the final p-value is at least (1 + num_lower_loglk) / (1 + num_sims)
+        max_num_lower_loglk = max_pvalue * (1 + num_sims) - 1
+        sims_per_round = SIMS_PER_ROUND
+    else:
+        sims_per_round = num_sims
+
+    pool = multiprocessing.Pool(thread) if thread > 1 else None
+    try:
+        for round_start in range(0, num_sims, sims_per_round):
+            round_stop = min(round_start + sims_per_round, num_sims)
+            n_idx = sim_n_idx[is_undecided]
+            n_slice = slice(n_idx.min(), n_idx.max() + 1)
+            batches = [
+                (batch_start, min(batch_start + SIMS_PER_BATCH, round_stop))
+                for batch_start in range(round_start, round_stop, SIMS_PER_BATCH)
+            ]
+            batch_args = [
+                (profile_p, alias_table, distinct_n[n_slice], stop - start, jump, batch_seeds[start // SIMS_PER_BATCH])
+                for start, stop in batches
+            ]
+            batch_results = pool.imap(simulate_loglk_batch_worker, batch_args) if pool else \
+                map(simulate_loglk_batch_worker, batch_args)
+            for (start, stop), batch_loglk in zip(batches, batch_results):
+                loglk[n_slice, start:stop] = batch_loglk
+
+            if early_stop:
+                num_lower_loglk[is_undecided] += count_lower_loglk(
+                    sim_n_idx[is_undecided], obs_loglk[is_undecided], loglk[:, round_start:round_stop])
+                is_undecided &= num_lower_loglk <= max_num_lower_loglk
+                if verbose:
+                    print('Simulations: %d, undecided barcodes: %d' % (round_stop, np.sum(is_undecided)))
+                if not np.any(is_undecided):
+                    break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
     return distinct_n, loglk
 
 
+def count_lower_loglk(sim_n_idx, obs_loglk, sim_loglk):
+    """Count simulated log-likelihoods lower than the observed one by binary search in the sorted simulations
+    Args:
+      sim_n_idx (nd.array(int)): Row of sim_loglk of each barcode
+      obs_loglk (nd.array(float)): Observed log-likelihoods of each barcode
+      sim_loglk (nd.array(float)): Simulated log-likelihoods. nan is skipped.
+    Returns:
+      num_lower_loglk (nd.array(int))
+    """
+    num_lower_loglk = np.zeros(len(sim_n_idx), dtype=int)
+    bc_order = np.argsort(sim_n_idx, kind='mergesort')
+    used_n_idx, bc_starts = np.unique(sim_n_idx[bc_order], return_index=True)
+    for n_idx, bcs in zip(used_n_idx, np.split(bc_order, bc_starts[1:])):
+        # nan is sorted to the end
+        num_lower_loglk[bcs] = np.searchsorted(np.sort(sim_loglk[n_idx, :]), obs_loglk[bcs], side='left')
+    # nan is not greater than any simulated log-likelihood
+    num_lower_loglk[np.isnan(obs_loglk)] = 0
+    return num_lower_loglk
+
+
 def compute_ambient_pvalues(umis_per_bc, obs_loglk, sim_n, sim_loglk):
     """Compute p-values for observed multinomial log-likelihoods
     Args:
       umis_per_bc (nd.array(int)): UMI counts per barcode
       obs_loglk (nd.array(float)): Observed log-likelihoods of each barcode deriving from an ambient profile
       sim_n (nd.array(int)): Multinomial N for simulated log-likelihoods
-      sim_loglk (nd.array(float)): Simulated log-likelihoods of shape (len(sim_n), num_simulations)
+      sim_loglk (nd.array(float)): Simulated log-likelihoods of shape (len(sim_n), num_simulations).
+        Skipped simulations are nan.
     Returns:
       pvalues (nd.array(float)): p-values
     """
@@ -443,13 +589,8 @@ def compute_ambient_pvalues(umis_per_bc, obs_loglk, sim_n, sim_loglk):
 
     # Find the index of the simulated N for each barcode
     sim_n_idx = np.searchsorted(sim_n, umis_per_bc)
-    num_sims = sim_loglk.shape[1]
-
-    num_barcodes = len(umis_per_bc)
-
-    pvalues = np.zeros(num_barcodes)
+    num_sims = np.sum(~np.isnan(sim_loglk), axis=1)
 
-    for i in range(num_barcodes):
-        num_lower_loglk = np.sum(sim_loglk[sim_n_idx[i],:] < obs_loglk[i])
-        pvalues[i] = float(1 + num_lower_loglk) / (1 + num_sims)
-    return pvalues
\ No newline at end of file
+    num_lower_loglk = count_lower_loglk(sim_n_idx, obs_loglk, sim_loglk)
+    pvalues = (1 + num_lower_loglk) / (1.0 + num_sims[sim_n_idx])
+    return pvalues
@@ -3,10 +3,10 @@ from collections import defaultdict
 from itertools import groupby
 
 import numpy as np
-import pysam
 from xopen import xopen
 
 import celescope.tools.utils as utils
+from celescope.tools.fastq import read_fastq_records
 from celescope.tools.step import Step, s_common
 
 
@@ -78,24 +78,23 @@ def sorted_dumb_consensus(fq, outfile, threshold):
     out_h = xopen(outfile, 'w')
 
     def keyfunc(read):
-        attr = read.name.split('_')
+        attr = read[0].split('_')
         return (attr[0], attr[1])
 
-    with pysam.FastxFile(fq) as fh:
-        for (barcode, umi), g in groupby(fh, key=keyfunc):
-            read_list = []
-            for read in g:
-                read_list.append([read.sequence, read.quality])
-            consensus_seq, consensus_qual, ambiguous_base_n, con_len = dumb_consensus(
-                read_list, threshold=threshold, ambiguous="N")
-            n_umi += 1
-            prefix = "_".join([barcode, umi])
-            read_name = f'{prefix}_{n_umi}'
-            out_h.write(utils.fastq_line(read_name, consensus_seq, consensus_qual))
-            if n_umi % 10000 == 0:
-                sorted_dumb_consensus.logger.info(f'{n_umi} UMI done.')
-            total_ambiguous_base_n += ambiguous_base_n
-            length_list.append(con_len)
+    for (barcode, umi), g in groupby(read_fastq_records(fq), key=keyfunc):
+        read_list = []
+        for _name, seq, qual in g:
+            read_list.append([seq, qual])
+        consensus_seq, consensus_qual, ambiguous_base_n, con_len = dumb_consensus(
+            read_list, threshold=threshold, ambiguous="N")
+        n_umi += 1
+        prefix = "_".join([barcode, umi])
+        read_name = f'{prefix}_{n_umi}'
+        out_h.write(utils.fastq_line(read_name, consensus_seq, consensus_qual))
+        if n_umi % 10000 == 0:
+            sorted_dumb_consensus.logger.info(f'{n_umi} UMI done.')
+        total_ambiguous_base_n += ambiguous_base_n
+        length_list.append(con_len)
     
     out_h.close()
     return n_umi, total_ambiguous_base_n, length_list
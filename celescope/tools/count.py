@@ -2,31 +2,123 @@
 count step
 """
 
+import multiprocessing
 import os
 import random
 import subprocess
 import sys
+import tempfile
 from collections import defaultdict
 from itertools import groupby
 
 import numpy as np
 import pandas as pd
 import pysam
-from scipy.io import mmwrite
-from scipy.sparse import coo_matrix
 
 import celescope.tools.utils as utils
-from celescope.tools.__init__ import (BARCODE_FILE_NAME, FEATURE_FILE_NAME,
-                                      MATRIX_FILE_NAME)
 from celescope.tools.cellranger3 import get_plot_elements
 from celescope.tools.cellranger3.cell_calling_3 import cell_calling_3
+from celescope.tools.count_table import CountTable, ReadAggregator
 from celescope.tools.step import Step, s_common
 
 TOOLS_DIR = os.path.dirname(__file__)
+# bam2table splits the bam into thread * CHUNKS_PER_THREAD chunks
+CHUNKS_PER_THREAD = 4
+CHUNK_CHECK_INTERVAL = 1000
 random.seed(0)
 np.random.seed(0)
 
 
+def get_bam_chunks(bam, n_chunk):
+    """
+    Split name sorted bam into about n_chunk chunks of similar compressed size. A barcode is not split.
+    The bam is read once without parsing tags. Compressed file offset is checked every CHUNK_CHECK_INTERVAL reads.
+
+    Returns:
+        list of (start, stop_barcode). start is the virtual offset of the first read of the chunk.
+        stop_barcode is the first barcode of the next chunk, None for the last chunk.
+    """
+    chunk_size = os.path.getsize(bam) / n_chunk
+    chunks = []
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        start = samfile.tell()
+        next_split = chunk_size
+        last_barcode = None
+        for read_index, seg in enumerate(samfile):
+            if last_barcode is not None:
+                barcode = seg.query_name.split('_', 1)[0]
+                if barcode != last_barcode:
+                    chunks.append((start, barcode))
+                    start = offset
+                    next_split = (start >> 16) + chunk_size
+                    last_barcode = None
+                    continue
+                offset = samfile.tell()
+            elif read_index % CHUNK_CHECK_INTERVAL == 0:
+                offset = samfile.tell()
+                # the high 48 bits of a virtual offset is the compressed offset
+                if (offset >> 16) >= next_split:
+                    last_barcode = seg.query_name.split('_', 1)[0]
+    chunks.append((start, None))
+    return chunks
+
+
+def bam2table(bam, start=None, stop_barcode=None):
+    """
+    Read UMIs of barcodes in name sorted bam to a CountTable which is not finished.
+
+    Args:
+        start: virtual offset to start from. Start from the first read if None.
+        stop_barcode: stop before this barcode. Read to the end if None.
+    """
+    count_table = CountTable()
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        if start is not None:
+            samfile.seek(start)
+
+        def keyfunc(x):
+            return x.query_name.split('_', 1)[0]
+        for barcode, g in groupby(samfile, keyfunc):
+            if barcode == stop_barcode:
+                break
+            gene_umi_dict = defaultdict(lambda: defaultdict(int))
+            for seg in g:
+                umi = seg.query_name.split('_')[1]
+                if not seg.has_tag('XT'):
+                    continue
+                gene_id = seg.get_tag('XT')
+                gene_umi_dict[gene_id][umi] += 1
+            count_table.add_barcode(barcode, gene_umi_dict)
+    return count_table
+
+
+def bam2table_worker(args):
+    return bam2table(*args)
+
+
+def is_name_sorted(bam):
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        return samfile.header.to_dict().get('HD', {}).get('SO') == 'queryname'
+
+
+def unsorted_bam2table(bam, max_memory, tmp_dir):
+    """
+    Read UMIs from bam in any order, e.g. the coordinate sorted featureCounts bam.
+    Read name must be {barcode}_{umi}_{read_id}.
+
+    Returns:
+        finished CountTable, the same as bam2table on the name sorted bam.
+    """
+    aggregator = ReadAggregator(max_memory, tmp_dir)
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        for seg in samfile:
+            if not seg.has_tag('XT'):
+                continue
+            barcode, umi, read_id = seg.query_name.split('_', 3)[:3]
+            aggregator.add_read(barcode, seg.get_tag('XT'), umi, int(read_id))
+    return aggregator.to_count_table()
+
+
 class Count(Step):
     """
     Features
@@ -36,18 +128,22 @@ class Count(Step):
 
     Output
     - `{sample}_all_matrix` The expression matrix of all detected barcodes. 
-        Can be read in by calling the `Seurat::Read10X` function.
+        Can be read in by calling the `Seurat::Read10X` function. 
+        `matrix.mtx` is not written with `--skip_all_matrix_mtx`.
 
     - `{sample}_matrix_10X` The expression matrix of the barcode that is identified to be the cell. 
     Can be read in by calling the `Seurat::Read10X` function.
 
+    - `matrix.npz` in both matrix directories. The same matrix as `matrix.mtx`, saved as a binary 
+    `scipy.sparse.csc_matrix`. Can be read in by calling `scipy.sparse.load_npz`.
+
     - `{sample}_matrix.tsv.gz` The expression matrix of the barcode that is identified to be the cell, separated by tabs. 
     CeleScope >=1.2.0 does not output this file.
 
-    - `{sample}_count_detail.txt.gz` 4 columns: 
+    - `{sample}_count_detail.txt.gz` Only with `--output_count_detail`. 4 columns: 
         - barcode  
         - gene ID  
-        - UMI count  
+        - UMI  
         - read_count  
 
     - `{sample}_counts.txt` 6 columns:
@@ -81,39 +177,48 @@ class Count(Step):
         else:
             self.gtf_file = args.gtf
         self.id_name = utils.get_id_name_dict(self.gtf_file)
+        self.output_count_detail = args.output_count_detail
+        self.max_memory = args.max_memory
+        self.downsample_points = int(args.downsample_points)
+        # rescue.R reads all_matrix with Seurat::Read10X
+        self.write_all_matrix_mtx = (not args.skip_all_matrix_mtx) or self.cell_calling_method == 'inflection'
 
         # output files
-        self.count_detail_file = f'{self.outdir}/{self.sample}_count_detail.txt'
+        self.count_detail_file = f'{self.outdir}/{self.sample}_count_detail.txt.gz'
         self.marked_count_file = f'{self.outdir}/{self.sample}_counts.txt'
         self.raw_matrix_10X_dir = f'{self.outdir}/{self.sample}_all_matrix'
         self.cell_matrix_10X_dir = f'{self.outdir}/{self.sample}_matrix_10X'
         self.downsample_file = f'{self.outdir}/{self.sample}_downsample.txt'
 
     def run(self):
-        self.bam2table()
-        df = pd.read_table(self.count_detail_file, header=0)
+        count_table = self.bam2table()
+        self.correct_table_umi(count_table)
+        if self.output_count_detail:
+            self.write_count_detail(count_table)
 
         # df_sum
-        df_sum = Count.get_df_sum(df)
+        df_sum = count_table.get_df_sum()
 
         # export all matrix
-        self.write_matrix_10X(df, self.raw_matrix_10X_dir)
+        raw_matrix = count_table.get_matrix()
+        self.write_matrix_10X(
+            count_table, self.raw_matrix_10X_dir, write_mtx=self.write_all_matrix_mtx, matrix=raw_matrix)
 
         # call cells
-        cell_bc, _threshold = self.cell_calling(df_sum)
+        cell_bc, _threshold = self.cell_calling(df_sum, raw_matrix)
+        del raw_matrix
 
         # get cell stats
         CB_describe = self.get_cell_stats(df_sum, cell_bc)
 
         # export cell matrix
-        df_cell = df.loc[df['Barcode'].isin(cell_bc), :]
-        self.write_matrix_10X(df_cell, self.cell_matrix_10X_dir)
+        cell_table = count_table.filter_barcodes(cell_bc)
+        self.write_matrix_10X(cell_table, self.cell_matrix_10X_dir)
         (CB_total_Genes, CB_reads_count, reads_mapped_to_transcriptome) = self.cell_summary(
-            df, cell_bc)
+            count_table, cell_table)
 
         # downsampling
-        cell_bc = set(cell_bc)
-        saturation, res_dict = self.downsample(df_cell)
+        saturation, res_dict = self.downsample(cell_table)
 
         # summary
         self.get_summary(saturation, CB_describe, CB_total_Genes,
@@ -137,6 +242,7 @@ class Count(Step):
     def correct_umi(umi_dict, percent=0.1):
         """
         Correct umi_dict in place.
+        The count step corrects all barcodes and genes at once with CountTable.correct_umi, which gives the same result.
 
         Args:
             umi_dict: {umi_seq: umi_count}
@@ -179,35 +285,43 @@ class Count(Step):
     @utils.add_log
     def bam2table(self):
         """
-        bam to detail table
-        must be used on name_sorted bam
+        bam to CountTable, UMIs are not corrected
+        If the bam is not sorted by read name, reads are aggregated by ReadAggregator.
         """
-        samfile = pysam.AlignmentFile(self.bam, "rb")
-        with open(self.count_detail_file, 'wt') as fh1:
-            fh1.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
-
-            def keyfunc(x): 
-                return x.query_name.split('_', 1)[0]
-            for _, g in groupby(samfile, keyfunc):
-                gene_umi_dict = defaultdict(lambda: defaultdict(int))
-                for seg in g:
-                    (barcode, umi) = seg.query_name.split('_')[:2]
-                    if not seg.has_tag('XT'):
-                        continue
-                    gene_id = seg.get_tag('XT')
-                    gene_umi_dict[gene_id][umi] += 1
-                for gene_id in gene_umi_dict:
-                    Count.correct_umi(gene_umi_dict[gene_id])
-
-                # output
-                for gene_id in gene_umi_dict:
-                    for umi in gene_umi_dict[gene_id]:
-                        fh1.write('%s\t%s\t%s\t%s\n' % (barcode, gene_id, umi,
-                                                        gene_umi_dict[gene_id][umi]))
-        samfile.close()
+        if not is_name_sorted(self.bam):
+            Count.bam2table.logger.info(f'{self.bam} is not sorted by read name.')
+            with tempfile.TemporaryDirectory(dir=self.outdir) as tmp_dir:
+                return unsorted_bam2table(self.bam, float(self.max_memory) * 1024 ** 3, tmp_dir)
+
+        thread = int(self.thread)
+        if thread <= 1:
+            return bam2table(self.bam).finish()
+
+        chunks = get_bam_chunks(self.bam, thread * CHUNKS_PER_THREAD)
+        Count.bam2table.logger.info(f'{len(chunks)} chunks')
+        count_table = CountTable()
+        with multiprocessing.Pool(min(thread, len(chunks))) as pool:
+            # merge chunks in the bam order
+            for chunk_table in pool.imap(bam2table_worker, [(self.bam, *chunk) for chunk in chunks]):
+                count_table.add_table(chunk_table)
+        return count_table.finish()
+
+    @utils.add_log
+    def correct_table_umi(self, count_table):
+        n_corrected_umi, n_corrected_read = count_table.correct_umi()
+        Count.correct_table_umi.logger.info(
+            f'corrected UMI: {n_corrected_umi}, corrected read: {n_corrected_read}')
 
     @utils.add_log
-    def cell_calling(self, df_sum):
+    def write_count_detail(self, count_table):
+        count_table.write_detail(self.count_detail_file)
+
+    @utils.add_log
+    def cell_calling(self, df_sum, raw_matrix):
+        """
+        Args:
+            raw_matrix: (gene_ids, barcodes, mtx) of all barcodes returned by CountTable.get_matrix
+        """
         cell_calling_method = self.cell_calling_method
 
         if (self.force_cell_num is not None) and (self.force_cell_num != 'None'):
@@ -215,7 +329,7 @@ class Count(Step):
         elif cell_calling_method == 'auto':
             cell_bc, UMI_threshold = self.auto_cell(df_sum)
         elif cell_calling_method == 'cellranger3':
-            cell_bc, UMI_threshold = self.cellranger3_cell(df_sum)
+            cell_bc, UMI_threshold = self.cellranger3_cell(df_sum, raw_matrix)
         elif cell_calling_method == 'inflection':
             _cell_bc, UMI_threshold = self.auto_cell(df_sum)
             cell_bc, UMI_threshold = self.inflection_cell(df_sum, UMI_threshold)
@@ -270,8 +384,12 @@ class Count(Step):
         return cell_bc, threshold
 
     @utils.add_log
-    def cellranger3_cell(self, df_sum):
-        cell_bc, initial_cell_num = cell_calling_3(self.raw_matrix_10X_dir, self.expected_cell_num)
+    def cellranger3_cell(self, df_sum, raw_matrix):
+        _gene_ids, barcodes, mtx = raw_matrix
+        # UMI counts of matrix columns
+        umis_per_bc = df_sum['UMI'].reindex(barcodes).values
+        cell_bc, initial_cell_num = cell_calling_3(
+            mtx, barcodes, self.expected_cell_num, thread=int(self.thread), umis_per_bc=umis_per_bc)
         threshold = Count.find_threshold(df_sum, initial_cell_num)
         return cell_bc, threshold
 
@@ -295,20 +413,6 @@ class Count(Step):
 
         return cell_bc, threshold
 
-    @staticmethod
-    def get_df_sum(df, col='UMI'):
-        def num_gt2(x):
-            return pd.Series.sum(x[x > 1])
-
-        df_sum = df.groupby('Barcode').agg({
-            'count': ['sum', num_gt2],
-            'UMI': 'count',
-            'geneID': 'nunique'
-        })
-        df_sum.columns = ['readcount', 'UMI2', 'UMI', 'geneID']
-        df_sum = df_sum.sort_values(col, ascending=False)
-        return df_sum
-
     '''
     @utils.add_log
     def plot_barcode_UMI(df_sum, threshold, expected_cell_num, cell_num, outdir, sample, cell_calling_method, col='UMI'):
@@ -333,31 +437,15 @@ class Count(Step):
         return CB_describe
 
     @utils.add_log
-    def write_matrix_10X(self, df, matrix_dir):
-        if not os.path.exists(matrix_dir):
-            os.mkdir(matrix_dir)
-
-        df_UMI = df.groupby(['geneID', 'Barcode']).agg({'UMI': 'count'})
-        mtx = coo_matrix((df_UMI.UMI, (df_UMI.index.labels[0], df_UMI.index.labels[1])))
-        gene_id = df_UMI.index.levels[0].to_series()
-        # add gene symbol
-        gene_name = gene_id.apply(lambda x: self.id_name[x])
-        genes = pd.concat([gene_id, gene_name], axis=1)
-        genes.columns = ['gene_id', 'gene_name']
-
-        barcodes = df_UMI.index.levels[1].to_series()
-        genes.to_csv(f'{matrix_dir}/{FEATURE_FILE_NAME}', index=False, sep='\t', header=False)
-        barcodes.to_csv(f'{matrix_dir}/{BARCODE_FILE_NAME}', index=False, sep='\t')
-        mmwrite(f'{matrix_dir}/{MATRIX_FILE_NAME}', mtx)
+    def write_matrix_10X(self, count_table, matrix_dir, write_mtx=True, matrix=None):
+        count_table.write_matrix_10X(matrix_dir, self.id_name, write_mtx=write_mtx, matrix=matrix)
 
     @utils.add_log
-    def cell_summary(self, df, cell_bc):
+    def cell_summary(self, count_table, cell_table):
 
-        df.loc[:, 'mark'] = 'UB'
-        df.loc[df['Barcode'].isin(cell_bc), 'mark'] = 'CB'
-        CB_total_Genes = df.loc[df['mark'] == 'CB', 'geneID'].nunique()
-        CB_reads_count = df.loc[df['mark'] == 'CB', 'count'].sum()
-        reads_mapped_to_transcriptome = df['count'].sum()
+        CB_total_Genes = cell_table.get_gene_number()
+        CB_reads_count = cell_table.get_read_count()
+        reads_mapped_to_transcriptome = count_table.get_read_count()
         return(CB_total_Genes, CB_reads_count, reads_mapped_to_transcriptome)
 
     def get_summary(self, saturation, CB_describe, CB_total_Genes,
@@ -401,9 +489,11 @@ class Count(Step):
             summary[item] = utils.format_number(summary[item])
         summary.to_csv(self.stat_file, header=False, sep=':')
 
-    @staticmethod
-    def sub_sample(fraction, df_cell, cell_read_index):
+    @utils.add_log
+    def downsample(self, cell_table):
         """
+        saturation and median gene of reads downsampled to `downsample_points` fractions.
+
         umi_saturation = 1 - n_deduped_reads / n_umis
         read_saturation = 1 - n_deduped_reads / n_reads
         Currently the html report shows umi_saturation.
@@ -412,37 +502,18 @@ class Count(Step):
         n_umis = Total number of (confidently mapped, valid cell-barcode, valid UMI) UMIs.
         n_reads = Total number of (confidently mapped, valid cell-barcode, valid UMI) reads.
 
-        Args:
-            fration: subsmaple fration
-            df_cell: in cell df with (Barcode geneID UMI count) 
-            cell_read_index: df_cell repeat index
-        """
-        cell_read = df_cell['count'].sum()
-        frac_n_read = int(cell_read * fraction)
-        subsample_read_index = cell_read_index[:frac_n_read]
-        index_dedup, counts = np.unique(subsample_read_index, return_counts=True)
-        n_count_once = np.sum(counts == 1)
-        # total = UMI
-        umi_total = len(index_dedup)
-        umi_saturation = round((1 - n_count_once / umi_total) * 100, 2)
-        read_total = frac_n_read
-        read_saturation = round((1 - n_count_once / read_total) * 100, 2)
-
-        # gene median
-        df_cell_subsample = df_cell.loc[index_dedup, ]
-        geneNum_median = float(df_cell_subsample.groupby(
-            'Barcode').agg({'geneID': 'nunique'}).median())
-
-        return umi_saturation, read_saturation, geneNum_median
-
-    @utils.add_log
-    def downsample(self, df_cell):
-        """saturation and median gene
-        return fraction=1 saturation
+        Returns:
+            fraction=1 umi_saturation, res_dict
         """
-        cell_read_index = np.array(df_cell.index.repeat(df_cell['count']), dtype='int32')
+        cell_read_index = np.array(np.repeat(cell_table.rows, cell_table.count), dtype='int32')
         np.random.shuffle(cell_read_index)
 
+        cell_read = len(cell_read_index)
+        n_point = self.downsample_points
+        n_read_list = [cell_read * i // n_point for i in range(1, n_point + 1)]
+        n_umi_arr, n_umi_once_arr, median_gene_arr = cell_table.downsample(cell_read_index, n_read_list)
+        del cell_read_index
+
         format_str = "%.2f\t%.2f\t%.2f\n"
         res_dict = {
             "fraction": [],
@@ -450,15 +521,18 @@ class Count(Step):
             "read_saturation": [],
             "median_gene": []
         }
+        def format_float(x): return round(x / 100, 4)
         with open(self.downsample_file, 'w') as fh:
             fh.write('percent\tmedian_geneNum\tsaturation\n')
             fh.write(format_str % (0, 0, 0))
-            for fraction in np.arange(0.1, 1.1, 0.1):
-                umi_saturation, read_saturation, geneNum_median = Count.sub_sample(
-                    fraction, df_cell, cell_read_index)
+            for i, frac_n_read in enumerate(n_read_list):
+                fraction = (i + 1) / n_point
+                n_count_once = n_umi_once_arr[i]
+                umi_saturation = round((1 - n_count_once / n_umi_arr[i]) * 100, 2)
+                read_saturation = round((1 - n_count_once / frac_n_read) * 100, 2)
+                geneNum_median = float(median_gene_arr[i])
                 fh.write(format_str % (fraction, geneNum_median, umi_saturation))
-                def format_float(x): return round(x / 100, 4)
-                res_dict["fraction"].append(round(fraction, 1))
+                res_dict["fraction"].append(round(fraction, 4))
                 res_dict["umi_saturation"].append(format_float(umi_saturation))
                 res_dict["read_saturation"].append(format_float(read_saturation))
                 res_dict["median_gene"].append(geneNum_median)
@@ -482,9 +556,39 @@ def get_opts_count(parser, sub_program):
         choices=['auto', 'cellranger3', 'inflection', ], 
         default='auto',
     )
+    parser.add_argument(
+        '--output_count_detail',
+        help='Output `{sample}_count_detail.txt.gz` with barcode, gene ID, UMI and read count of every UMI.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--max_memory',
+        help=(
+            'Default `4`. Memory(GB) to aggregate reads of a BAM not sorted by read name. '
+            'Aggregated reads are spilled to disk when exceeded.'
+        ),
+        default=4,
+    )
+    parser.add_argument(
+        '--skip_all_matrix_mtx',
+        help=(
+            'Do not write `matrix.mtx` in `{sample}_all_matrix`, only `matrix.npz`. '
+            'Ignored if `--cell_calling_method inflection`.'
+        ),
+        action='store_true',
+    )
+    parser.add_argument(
+        '--downsample_points',
+        help='Default `10`. Number of read fractions in `{sample}_downsample.txt` and the saturation curve.',
+        default=10,
+    )
     if sub_program:
         parser = s_common(parser)
-        parser.add_argument('--bam', help='Required. BAM file from featureCounts.', required=True)
+        parser.add_argument(
+            '--bam',
+            help='Required. BAM file from featureCounts, sorted by read name or coordinate.',
+            required=True,
+        )
         parser.add_argument(
             '--force_cell_num', 
             help='Default `None`. Force the cell number to be this value ± 10%.', 
@@ -0,0 +1,741 @@
+"""
+Integer coded UMI count table of the count step.
+"""
+
+import argparse
+import copy
+import os
+import time
+from array import array
+
+import numpy as np
+import pandas as pd
+from scipy.io import mmread, mmwrite
+from scipy.sparse import csc_matrix, load_npz, save_npz
+from xopen import xopen
+
+from celescope.tools.__init__ import (BARCODE_FILE_NAME, FEATURE_FILE_NAME,
+                                      MATRIX_FILE_NAME, MATRIX_NPZ_FILE_NAME)
+
+# UMI is packed 3 bits per base after a leading 1 bit, so the length is kept.
+# 'ACGNT' is in str order, packed UMIs of the same length sort the same as the sequences.
+UMI_TRANS = str.maketrans('ACGNT', '01234')
+UMI_DECODE_TRANS = str.maketrans('01234', 'ACGNT')
+MAX_UMI_LENGTH = 20
+# packed UMIs of length l are in [8 ** l, 8 ** (l + 1))
+UMI_LENGTH_BOUNDS = 8 ** np.arange(MAX_UMI_LENGTH + 1, dtype=np.int64)
+# number of rows written at a time by write_detail
+DETAIL_CHUNK_SIZE = 100000
+# approximate number of rows corrected at a time by CountTable.correct_umi
+CORRECT_CHUNK_SIZE = 200000
+# reads aggregated at a time by ReadAggregator
+AGGREGATE_BUFFER_SIZE = 1 << 21
+# barcode partitions of ReadAggregator spill files
+N_SPILL_PARTITION = 16
+# bytes of an aggregated row: barcode, gene, count(int32), umi, first_read(int64)
+AGGREGATE_ROW_BYTES = 28
+AGGREGATE_COLUMNS = ('barcode', 'gene', 'umi', 'count', 'first_read')
+
+
+def encode_umi(umi):
+    """
+    'ACGTN' -> int('1' + '01234', 8)
+    """
+    if len(umi) > MAX_UMI_LENGTH:
+        raise ValueError(f'UMI longer than {MAX_UMI_LENGTH} bases is not supported: {umi}')
+    return int('1' + umi.translate(UMI_TRANS), 8)
+
+
+def decode_umi(code):
+    return oct(code)[3:].translate(UMI_DECODE_TRANS)
+
+
+def get_umi_length(umi_arr):
+    return np.searchsorted(UMI_LENGTH_BOUNDS, umi_arr, side='right') - 1
+
+
+def get_hamming1_pairs(group_arr, umi_arr):
+    """
+    Find UMI pairs with hamming distance 1 in the same group.
+    Two UMIs with hamming distance 1 are equal after masking the base where they differ, so for each position UMIs are
+    sorted by (group, masked UMI). Equal keys are at most 5 UMIs(ACGNT) in a row, no pairwise comparison is needed.
+
+    Args:
+        group_arr: int array
+        umi_arr: packed UMI array
+    Returns:
+        index1, index2: int arrays of UMI pairs
+    """
+    length_arr = get_umi_length(umi_arr)
+    max_length = int(length_arr.max(initial=0))
+    group_arr = group_arr - group_arr.min(initial=0)
+    # bits of a masked UMI. group and masked UMI are sorted as one int64 if possible
+    umi_bits = 3 * max_length + 1
+    is_packed = int(group_arr.max(initial=0)) < (1 << (63 - umi_bits))
+
+    index1_list, index2_list = [], []
+    for pos in range(max_length):
+        index = np.flatnonzero(length_arr > pos)
+        masked = umi_arr[index] & ~np.int64(7 << (3 * pos))
+        group = group_arr[index]
+        if is_packed:
+            key = (group.astype(np.int64) << umi_bits) | masked
+            order = np.argsort(key)
+            key = key[order]
+        else:
+            order = np.lexsort((masked, group))
+            key = np.rec.fromarrays([group[order], masked[order]])
+        index = index[order]
+        for offset in range(1, 5):
+            same = np.flatnonzero(key[offset:] == key[:-offset])
+            index1_list.append(index[same])
+            index2_list.append(index[same + offset])
+    return np.concatenate(index1_list), np.concatenate(index2_list)
+
+
+def get_umi_targets(group_arr, umi_arr, count_arr, percent=0.1):
+    """
+    Same rule as Count.correct_umi. In each group, UMIs are sorted by (count, sequence). A lower UMI is merged to
+    the highest UMI with hamming distance 1 and low_count / high_count <= percent.
+
+    Returns:
+        target_arr: index of the UMI to merge to, -1 if not merged. The target may be merged again.
+    """
+    n_umi = len(umi_arr)
+    order = np.lexsort((umi_arr, count_arr, group_arr))
+    rank = np.empty(n_umi, dtype=np.int64)
+    rank[order] = np.arange(n_umi)
+
+    index1, index2 = get_hamming1_pairs(group_arr, umi_arr)
+    is_swap = rank[index1] > rank[index2]
+    low = np.where(is_swap, index2, index1)
+    high = np.where(is_swap, index1, index2)
+    is_valid = count_arr[low] / count_arr[high] <= percent
+    low, high = low[is_valid], high[is_valid]
+
+    target_rank = np.full(n_umi, -1, dtype=np.int64)
+    np.maximum.at(target_rank, low, rank[high])
+    target_arr = np.full(n_umi, -1, dtype=np.int64)
+    is_merged = target_rank >= 0
+    target_arr[is_merged] = order[target_rank[is_merged]]
+    return target_arr
+
+
+def sorted_rank(index_arr, name_list):
+    """
+    Args:
+        index_arr: int array of indices into name_list
+        name_list: list of str
+    Returns:
+        names: sorted unique names in index_arr
+        rank_arr: position of each element of index_arr in names
+    """
+    index_unique, inverse = np.unique(index_arr, return_inverse=True)
+    names = np.array(name_list, dtype=object)[index_unique]
+    order = np.argsort(names, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return names[order].tolist(), rank[inverse.ravel()]
+
+
+class CountTable():
+    """
+    One row per (barcode, gene, UMI) with 4 integer columns:
+        - barcode: index into barcode_list
+        - gene: index into gene_list
+        - umi: packed UMI sequence, see encode_umi
+        - count: read count
+
+    Rows are in the order they are added. A CountTable returned by filter_barcodes shares barcode_list and
+    gene_list with the full table, and `rows` keeps the row numbers in the full table.
+    """
+
+    def __init__(self):
+        self.barcode_list = []
+        self.barcode_dict = {}
+        self.gene_list = []
+        self.gene_dict = {}
+        self._barcode = array('i')
+        self._gene = array('i')
+        self._umi = array('q')
+        self._count = array('i')
+        self.barcode = None
+        self.gene = None
+        self.umi = None
+        self.count = None
+        self.rows = None
+
+    def add_barcode(self, barcode, gene_umi_dict):
+        """
+        Append the UMIs of one barcode.
+        Args:
+            gene_umi_dict: {gene_id: {umi: read_count}}
+        """
+        if not gene_umi_dict:
+            return
+        barcode_index = self.get_barcode_index(barcode)
+        for gene_id, umi_dict in gene_umi_dict.items():
+            gene_index = self.get_gene_index(gene_id)
+            n_umi = len(umi_dict)
+            self._barcode.extend([barcode_index] * n_umi)
+            self._gene.extend([gene_index] * n_umi)
+            self._umi.extend([encode_umi(umi) for umi in umi_dict])
+            self._count.extend(umi_dict.values())
+
+    def get_barcode_index(self, barcode):
+        barcode_index = self.barcode_dict.get(barcode)
+        if barcode_index is None:
+            barcode_index = self.barcode_dict[barcode] = len(self.barcode_list)
+            self.barcode_list.append(barcode)
+        return barcode_index
+
+    def get_gene_index(self, gene_id):
+        gene_index = self.gene_dict.get(gene_id)
+        if gene_index is None:
+            gene_index = self.gene_dict[gene_id] = len(self.gene_list)
+            self.gene_list.append(gene_id)
+        return gene_index
+
+    def add_table(self, table):
+        """
+        Append the rows of another CountTable which is not finished.
+        The result is the same as calling add_barcode with the barcodes of table.
+        """
+        barcode_buffer, gene_buffer, umi_buffer, count_buffer = table.get_buffers()
+        barcode_map = np.array([self.get_barcode_index(barcode) for barcode in table.barcode_list], dtype=np.int32)
+        gene_map = np.array([self.get_gene_index(gene_id) for gene_id in table.gene_list], dtype=np.int32)
+        self._barcode.frombytes(barcode_map[np.frombuffer(barcode_buffer, dtype=np.int32)].tobytes())
+        self._gene.frombytes(gene_map[np.frombuffer(gene_buffer, dtype=np.int32)].tobytes())
+        self._umi.extend(umi_buffer)
+        self._count.extend(count_buffer)
+
+    def get_buffers(self):
+        """
+        Returns:
+            barcode, gene, umi and count columns of a table which is not finished, as arrays of add_barcode
+        """
+        return self._barcode, self._gene, self._umi, self._count
+
+    def finish(self):
+        """
+        Convert the columns to numpy arrays. Must be called after the last add_barcode.
+        """
+        self.barcode = np.frombuffer(self._barcode, dtype=np.int32)
+        self.gene = np.frombuffer(self._gene, dtype=np.int32)
+        self.umi = np.frombuffer(self._umi, dtype=np.int64)
+        self.count = np.frombuffer(self._count, dtype=np.int32)
+        self.rows = np.arange(len(self.barcode))
+        return self
+
+    @classmethod
+    def from_columns(cls, barcode_list, gene_list, barcode, gene, umi, count):
+        """
+        Returns:
+            finished CountTable
+        """
+        table = cls()
+        table.barcode_list = list(barcode_list)
+        table.barcode_dict = {barcode: index for index, barcode in enumerate(table.barcode_list)}
+        table.gene_list = list(gene_list)
+        table.gene_dict = {gene_id: index for index, gene_id in enumerate(table.gene_list)}
+        table.barcode = np.asarray(barcode, dtype=np.int32)
+        table.gene = np.asarray(gene, dtype=np.int32)
+        table.umi = np.asarray(umi, dtype=np.int64)
+        table.count = np.asarray(count, dtype=np.int32)
+        table.rows = np.arange(len(table.barcode))
+        return table
+
+    def __len__(self):
+        return len(self.barcode)
+
+    def get_groups(self):
+        """
+        Returns:
+            group id of each row. Rows of the same barcode and gene added by one add_barcode are in one group.
+        """
+        is_start = np.ones(len(self), dtype=bool)
+        is_start[1:] = (self.barcode[1:] != self.barcode[:-1]) | (self.gene[1:] != self.gene[:-1])
+        return np.cumsum(is_start) - 1
+
+    def correct_umi(self, percent=0.1):
+        """
+        Merge UMIs of the same barcode and gene in place, same result as calling Count.correct_umi on every gene.
+        Groups with one UMI are skipped, other groups are corrected CORRECT_CHUNK_SIZE rows at a time.
+        Merged rows are removed and rows are renumbered.
+
+        Returns:
+            n_corrected_umi: int
+            n_corrected_read: int
+        """
+        group_arr = self.get_groups()
+        count_arr = self.count.astype(np.int64)
+        target_arr = np.full(len(self), -1, dtype=np.int64)
+
+        rows = np.flatnonzero(np.bincount(group_arr)[group_arr] > 1)
+        row_group = group_arr[rows]
+        start = 0
+        while start < len(rows):
+            end = min(start + CORRECT_CHUNK_SIZE, len(rows))
+            # do not split a group
+            end = np.searchsorted(row_group, row_group[end - 1], side='right')
+            chunk_rows = rows[start:end]
+            chunk_target = get_umi_targets(
+                row_group[start:end], self.umi[chunk_rows], count_arr[chunk_rows], percent)
+            is_merged = chunk_target >= 0
+            target_arr[chunk_rows[is_merged]] = chunk_rows[chunk_target[is_merged]]
+            start = end
+
+        # a UMI is merged after all UMIs merged to it, like the low to high order of Count.correct_umi
+        merged = np.flatnonzero(target_arr >= 0)
+        n_corrected_umi = len(merged)
+        n_corrected_read = 0
+        while len(merged):
+            n_source = np.bincount(target_arr[merged], minlength=len(self))
+            is_ready = n_source[merged] == 0
+            ready = merged[is_ready]
+            np.add.at(count_arr, target_arr[ready], count_arr[ready])
+            n_corrected_read += int(count_arr[ready].sum())
+            merged = merged[~is_ready]
+
+        self.count = count_arr.astype(np.int32)
+        table = self.subset(target_arr < 0)
+        self.barcode, self.gene, self.umi, self.count = table.barcode, table.gene, table.umi, table.count
+        self.rows = np.arange(len(self.barcode))
+        return n_corrected_umi, n_corrected_read
+
+    def subset(self, mask):
+        table = CountTable()
+        table.barcode_list = self.barcode_list
+        table.barcode_dict = self.barcode_dict
+        table.gene_list = self.gene_list
+        table.gene_dict = self.gene_dict
+        table.barcode = self.barcode[mask]
+        table.gene = self.gene[mask]
+        table.umi = self.umi[mask]
+        table.count = self.count[mask]
+        table.rows = self.rows[mask]
+        return table
+
+    def get_barcode_mask(self, barcodes):
+        barcode_set = set(barcodes)
+        is_selected = np.array([barcode in barcode_set for barcode in self.barcode_list], dtype=bool)
+        return is_selected[self.barcode]
+
+    def filter_barcodes(self, barcodes):
+        return self.subset(self.get_barcode_mask(barcodes))
+
+    def get_read_count(self):
+        return int(self.count.sum(dtype=np.int64))
+
+    def get_gene_number(self):
+        return len(np.unique(self.gene))
+
+    def downsample(self, read_rows, n_read_list):
+        """
+        Downsample reads by keeping the first n reads of shuffled reads, for every n in n_read_list.
+        All sampling points are computed from the first read position of each UMI and each (barcode, gene).
+
+        Args:
+            read_rows: shuffled rows of all reads, a permutation of np.repeat(self.rows, self.count)
+            n_read_list: ascending read numbers to keep
+        Returns:
+            n_umi_arr: UMI number of each sampling point
+            n_umi_once_arr: number of UMIs with only one read of each sampling point
+            median_gene_arr: median gene number per barcode of each sampling point
+        """
+        n_point = len(n_read_list)
+        n_read_arr = np.asarray(n_read_list, dtype=np.int64)
+
+        def get_point(positions):
+            # index of the first sampling point that contains the read at positions
+            # n_point if the read is not sampled at all
+            return np.searchsorted(n_read_arr, positions, side='right')
+
+        def cumulative_count(points):
+            return np.cumsum(np.bincount(points, minlength=n_point + 1)[:n_point])
+
+        # sort reads by (row, position). rows are ascending, so reads of a row start at the cumsum of counts
+        keys = read_rows.astype(np.int64) << 32
+        keys |= np.arange(len(read_rows), dtype=np.int64)
+        keys.sort()
+        positions = keys & 0xFFFFFFFF
+        del keys
+        starts = np.cumsum(self.count, dtype=np.int64) - self.count
+        first_positions = positions[starts]
+        second_positions = positions[starts[self.count > 1] + 1]
+        del positions
+
+        n_umi_arr = cumulative_count(get_point(first_positions))
+        n_umi_once_arr = n_umi_arr - cumulative_count(get_point(second_positions))
+
+        # first read position of each (barcode, gene)
+        n_gene = len(self.gene_list)
+        barcode_gene = self.barcode.astype(np.int64) * n_gene + self.gene
+        order = np.lexsort((first_positions, barcode_gene))
+        barcode_gene = barcode_gene[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = barcode_gene[1:] != barcode_gene[:-1]
+        gene_points = get_point(first_positions[order[is_first]])
+        _barcodes, barcode_index = np.unique(barcode_gene[is_first] // n_gene, return_inverse=True)
+
+        # gene number of each (barcode, sampling point)
+        n_barcode = len(_barcodes)
+        gene_num = np.bincount(
+            barcode_index * (n_point + 1) + gene_points,
+            minlength=n_barcode * (n_point + 1),
+        ).reshape(n_barcode, n_point + 1)[:, :n_point].cumsum(axis=1)
+        median_gene_arr = np.zeros(n_point)
+        for point in range(n_point):
+            point_gene_num = gene_num[:, point]
+            point_gene_num = point_gene_num[point_gene_num > 0]
+            if len(point_gene_num):
+                median_gene_arr[point] = np.median(point_gene_num)
+
+        return n_umi_arr, n_umi_once_arr, median_gene_arr
+
+    def get_df_sum(self, col='UMI'):
+        """
+        Same as grouping the detail table by barcode.
+        Returns:
+            DataFrame indexed by Barcode with columns readcount, UMI2, UMI, geneID. Sorted by col.
+        """
+        n_barcode = len(self.barcode_list)
+        n_gene = max(len(self.gene_list), 1)
+        count = self.count.astype(np.int64)
+        readcount = np.bincount(self.barcode, weights=count, minlength=n_barcode)
+        umi2 = np.bincount(self.barcode, weights=np.where(count > 1, count, 0), minlength=n_barcode)
+        umi = np.bincount(self.barcode, minlength=n_barcode)
+        barcode_gene = np.unique(self.barcode.astype(np.int64) * n_gene + self.gene)
+        gene_num = np.bincount(barcode_gene // n_gene, minlength=n_barcode)
+
+        present = np.flatnonzero(umi)
+        df_sum = pd.DataFrame({
+            'readcount': readcount[present].astype(np.int64),
+            'UMI2': umi2[present].astype(np.int64),
+            'UMI': umi[present].astype(np.int64),
+            'geneID': gene_num[present].astype(np.int64),
+        }, index=pd.Index(np.array(self.barcode_list, dtype=object)[present], name='Barcode'))
+        df_sum = df_sum.sort_index()
+        df_sum = df_sum.sort_values(col, ascending=False)
+        return df_sum
+
+    def get_matrix(self):
+        """
+        Returns:
+            gene_ids: sorted gene IDs
+            barcodes: sorted barcodes
+            mtx: gene x barcode UMI count csc_matrix
+        """
+        gene_ids, gene_rank = sorted_rank(self.gene, self.gene_list)
+        barcodes, barcode_rank = sorted_rank(self.barcode, self.barcode_list)
+        n_gene = len(gene_ids)
+        # keys are sorted by barcode, then gene
+        keys, umi_count = np.unique(barcode_rank * n_gene + gene_rank, return_counts=True)
+        barcode_rank = keys // n_gene
+        indptr = np.zeros(len(barcodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(barcode_rank, minlength=len(barcodes)), out=indptr[1:])
+        mtx = csc_matrix(
+            (umi_count.astype(np.int32), keys - barcode_rank * n_gene, indptr),
+            shape=(n_gene, len(barcodes)),
+        )
+        return gene_ids, barcodes, mtx
+
+    def write_matrix_10X(self, matrix_dir, id_name, write_mtx=True, matrix=None):
+        """
+        Write genes.tsv, barcodes.tsv and matrix.npz. matrix.mtx is written if write_mtx.
+
+        Args:
+            matrix: (gene_ids, barcodes, mtx) returned by get_matrix. Built from the table if None.
+        """
+        if not os.path.exists(matrix_dir):
+            os.mkdir(matrix_dir)
+
+        if matrix is None:
+            matrix = self.get_matrix()
+        gene_ids, barcodes, mtx = matrix
+        genes = pd.DataFrame({
+            'gene_id': gene_ids,
+            'gene_name': [id_name[gene_id] for gene_id in gene_ids],
+        }, columns=['gene_id', 'gene_name'])
+        genes.to_csv(f'{matrix_dir}/{FEATURE_FILE_NAME}', index=False, sep='\t', header=False)
+        pd.Series(barcodes).to_csv(f'{matrix_dir}/{BARCODE_FILE_NAME}', index=False, sep='\t', header=False)
+        # zlib compression of the index arrays takes longer than writing matrix.mtx
+        save_npz(f'{matrix_dir}/{MATRIX_NPZ_FILE_NAME}', mtx, compressed=False)
+        mtx_file = f'{matrix_dir}/{MATRIX_FILE_NAME}'
+        if write_mtx:
+            # entries are written gene by gene
+            mmwrite(mtx_file, mtx.tocsr())
+        elif os.path.exists(mtx_file):
+            # do not leave a matrix.mtx of a previous run
+            os.remove(mtx_file)
+
+    def write_detail(self, detail_file):
+        """
+        Write the table as text with 4 columns: Barcode, geneID, UMI, count.
+        Rows are formatted and written DETAIL_CHUNK_SIZE at a time.
+        """
+        with xopen(detail_file, 'w') as fh:
+            fh.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
+            for start in range(0, len(self), DETAIL_CHUNK_SIZE):
+                end = start + DETAIL_CHUNK_SIZE
+                lines = []
+                for barcode_index, gene_index, umi_code, count in zip(
+                    self.barcode[start:end].tolist(), self.gene[start:end].tolist(),
+                    self.umi[start:end].tolist(), self.count[start:end].tolist(),
+                ):
+                    lines.append(
+                        f'{self.barcode_list[barcode_index]}\t{self.gene_list[gene_index]}\t'
+                        f'{decode_umi(umi_code)}\t{count}\n'
+                    )
+                fh.write(''.join(lines))
+
+
+def read_matrix_10X(matrix_dir):
+    """
+    Read a matrix directory written by CountTable.write_matrix_10X.
+    matrix.npz is read if it exists, otherwise matrix.mtx.
+
+    Returns:
+        features_df: DataFrame with columns id and name
+        barcodes: list of barcodes
+        mtx: gene x barcode csc_matrix
+    """
+    npz_file = f'{matrix_dir}/{MATRIX_NPZ_FILE_NAME}'
+    if os.path.exists(npz_file):
+        mtx = load_npz(npz_file).tocsc()
+    else:
+        mtx = csc_matrix(mmread(f'{matrix_dir}/{MATRIX_FILE_NAME}'))
+    features_df = pd.read_csv(
+        f'{matrix_dir}/{FEATURE_FILE_NAME}', sep='\t', header=None, names=['id', 'name'], usecols=[0, 1])
+    barcodes = pd.read_csv(
+        f'{matrix_dir}/{BARCODE_FILE_NAME}', sep='\t', header=None, names=['barcode'])['barcode'].tolist()
+    return features_df, barcodes, mtx
+
+
+def concat_columns(columns_list):
+    return {col: np.concatenate([columns[col] for columns in columns_list]) for col in AGGREGATE_COLUMNS}
+
+
+def aggregate_columns(columns):
+    """
+    Merge rows with the same (barcode, gene, umi). count is summed and first_read is the minimum.
+    Returns:
+        columns sorted by (barcode, gene, umi)
+    """
+    if len(columns['umi']) == 0:
+        return columns
+    barcode_gene = (columns['barcode'].astype(np.int64) << 32) | columns['gene']
+    order = np.lexsort((columns['umi'], barcode_gene))
+    barcode_gene, umi = barcode_gene[order], columns['umi'][order]
+    is_start = np.ones(len(umi), dtype=bool)
+    is_start[1:] = (barcode_gene[1:] != barcode_gene[:-1]) | (umi[1:] != umi[:-1])
+    starts = np.flatnonzero(is_start)
+    return {
+        'barcode': columns['barcode'][order][starts],
+        'gene': columns['gene'][order][starts],
+        'umi': umi[starts],
+        'count': np.add.reduceat(columns['count'][order], starts),
+        'first_read': np.minimum.reduceat(columns['first_read'][order], starts),
+    }
+
+
+class ReadAggregator():
+    """
+    Count reads of (barcode, gene, UMI) from a bam in any order, e.g. the coordinate sorted featureCounts bam.
+
+    Reads are buffered as integer codes and aggregated buffer_size reads at a time. Aggregated parts are
+    merged when a part is as large as the previous one. When the parts exceed max_memory, they are spilled to
+    tmp_dir in N_SPILL_PARTITION files by barcode, and every barcode partition is aggregated separately at the end.
+
+    The read ID(the number after UMI in read name) of the first read is kept, so the rows of the CountTable are in the same
+    order as reading the name sorted bam.
+    """
+
+    def __init__(self, max_memory, tmp_dir, buffer_size=AGGREGATE_BUFFER_SIZE):
+        """
+        Args:
+            max_memory: bytes of aggregated parts kept in memory
+        """
+        self.buffer_size = buffer_size
+        self.max_rows = max(int(max_memory / AGGREGATE_ROW_BYTES), buffer_size)
+        self.tmp_dir = tmp_dir
+        self.names = CountTable()
+        self._barcode = array('i')
+        self._gene = array('i')
+        self._umi = array('q')
+        self._first_read = array('q')
+        self.parts = []
+        self.n_spill = 0
+
+    def add_read(self, barcode, gene_id, umi, read_id):
+        names = self.names
+        barcode_index = names.barcode_dict.get(barcode)
+        if barcode_index is None:
+            barcode_index = names.get_barcode_index(barcode)
+        gene_index = names.gene_dict.get(gene_id)
+        if gene_index is None:
+            gene_index = names.get_gene_index(gene_id)
+        self._barcode.append(barcode_index)
+        self._gene.append(gene_index)
+        self._umi.append(encode_umi(umi))
+        self._first_read.append(read_id)
+        if len(self._first_read) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        n_read = len(self._first_read)
+        if n_read == 0:
+            return
+        columns = {
+            'barcode': np.frombuffer(self._barcode, dtype=np.int32).copy(),
+            'gene': np.frombuffer(self._gene, dtype=np.int32).copy(),
+            'umi': np.frombuffer(self._umi, dtype=np.int64).copy(),
+            'count': np.ones(n_read, dtype=np.int32),
+            'first_read': np.frombuffer(self._first_read, dtype=np.int64).copy(),
+        }
+        self._barcode, self._gene, self._umi, self._first_read = array('i'), array('i'), array('q'), array('q')
+        self.parts.append(aggregate_columns(columns))
+        while len(self.parts) > 1 and len(self.parts[-1]['umi']) >= len(self.parts[-2]['umi']):
+            self.parts[-2:] = [aggregate_columns(concat_columns(self.parts[-2:]))]
+        if sum(len(part['umi']) for part in self.parts) > self.max_rows:
+            self.spill()
+
+    def spill(self):
+        columns = aggregate_columns(concat_columns(self.parts))
+        self.parts = []
+        partition = columns['barcode'] % N_SPILL_PARTITION
+        for partition_index in range(N_SPILL_PARTITION):
+            is_partition = partition == partition_index
+            np.savez(
+                self.get_spill_file(partition_index, self.n_spill),
+                **{col: columns[col][is_partition] for col in AGGREGATE_COLUMNS}
+            )
+        self.n_spill += 1
+
+    def get_spill_file(self, partition_index, spill_index):
+        return f'{self.tmp_dir}/partition{partition_index}_{spill_index}.npz'
+
+    def get_columns(self):
+        self.flush()
+        if self.n_spill == 0:
+            return aggregate_columns(concat_columns(self.parts)) if self.parts else None
+        if self.parts:
+            self.spill()
+        columns_list = []
+        for partition_index in range(N_SPILL_PARTITION):
+            spill_columns_list = []
+            for spill_index in range(self.n_spill):
+                spill_file = self.get_spill_file(partition_index, spill_index)
+                with np.load(spill_file) as data:
+                    spill_columns_list.append({col: data[col] for col in AGGREGATE_COLUMNS})
+                os.remove(spill_file)
+            columns_list.append(aggregate_columns(concat_columns(spill_columns_list)))
+        return concat_columns(columns_list)
+
+    def to_count_table(self):
+        """
+        Returns:
+            finished CountTable. Rows are in the order of reading the name sorted bam: barcodes are sorted, genes of a
+            barcode are sorted by their first read, UMIs of a gene are sorted.
+        """
+        columns = self.get_columns()
+        if columns is None:
+            return CountTable().finish()
+
+        # read names are sorted as {barcode}_{umi}_{read_id}
+        barcode_rank = np.argsort(np.argsort(np.array([barcode + '_' for barcode in self.names.barcode_list])))
+        row_barcode_rank = barcode_rank[columns['barcode']]
+        # columns are sorted by (barcode, gene, umi), the first row of a gene has its first read
+        barcode_gene = (columns['barcode'].astype(np.int64) << 32) | columns['gene']
+        is_start = np.ones(len(barcode_gene), dtype=bool)
+        is_start[1:] = barcode_gene[1:] != barcode_gene[:-1]
+        group = np.cumsum(is_start) - 1
+        starts = np.flatnonzero(is_start)
+        gene_first_umi = columns['umi'][starts][group]
+        gene_first_read = columns['first_read'][starts][group]
+        order = np.lexsort((columns['umi'], gene_first_read, gene_first_umi, row_barcode_rank))
+
+        barcode_arr, barcode_inverse = np.unique(row_barcode_rank[order], return_inverse=True)
+        barcode_sorted = np.empty(len(barcode_rank), dtype=np.int64)
+        barcode_sorted[barcode_rank] = np.arange(len(barcode_rank))
+        barcode_list = [self.names.barcode_list[i] for i in barcode_sorted[barcode_arr]]
+
+        gene_arr = columns['gene'][order]
+        gene_unique, first_index, gene_inverse = np.unique(gene_arr, return_index=True, return_inverse=True)
+        gene_order = np.argsort(first_index)
+        gene_rank = np.empty(len(gene_order), dtype=np.int64)
+        gene_rank[gene_order] = np.arange(len(gene_order))
+        gene_list = [self.names.gene_list[i] for i in gene_unique[gene_order]]
+
+        return CountTable.from_columns(
+            barcode_list, gene_list, barcode_inverse.ravel(), gene_rank[gene_inverse.ravel()],
+            columns['umi'][order], columns['count'][order],
+        )
+
+
+def simulate_skewed_umis(n_gene, n_umi, umi_length, error_rate=0.05, seed=0):
+    """
+    Returns:
+        {gene_id: {umi: read_count}}. Read counts of true UMIs follow a zipf distribution, UMIs with one sequencing
+        error are added with read count 1.
+    """
+    rng = np.random.RandomState(seed)
+    bases = np.array(list('ACGT'))
+    gene_umi_dict = {}
+    for gene_index in range(n_gene):
+        umi_dict = {}
+        for umi_bases in bases[rng.randint(0, 4, size=(n_umi, umi_length))]:
+            umi = ''.join(umi_bases)
+            read_count = int(min(rng.zipf(1.5), 10000))
+            umi_dict[umi] = umi_dict.get(umi, 0) + read_count
+            for _ in range(rng.binomial(read_count, error_rate)):
+                pos = rng.randint(umi_length)
+                error_umi = umi[:pos] + bases[rng.randint(4)] + umi[pos + 1:]
+                umi_dict[error_umi] = umi_dict.get(error_umi, 0) + 1
+        gene_umi_dict[f'gene{gene_index}'] = umi_dict
+    return gene_umi_dict
+
+
+def benchmark_correct_umi(n_gene, n_umi, umi_length, repeat=3):
+    """
+    Compare Count.correct_umi on every gene with CountTable.correct_umi on one barcode.
+    Returns:
+        {method: best time in seconds}
+    """
+    from celescope.tools.count import Count
+
+    gene_umi_dict = simulate_skewed_umis(n_gene, n_umi, umi_length)
+    time_dict = {'Count.correct_umi': [], 'CountTable.correct_umi': []}
+    for _ in range(repeat):
+        dict_copy = copy.deepcopy(gene_umi_dict)
+        start = time.time()
+        for umi_dict in dict_copy.values():
+            Count.correct_umi(umi_dict)
+        time_dict['Count.correct_umi'].append(time.time() - start)
+
+        count_table = CountTable()
+        count_table.add_barcode('barcode', gene_umi_dict)
+        count_table.finish()
+        start = time.time()
+        count_table.correct_umi()
+        time_dict['CountTable.correct_umi'].append(time.time() - start)
+
+    if len(count_table) != sum(len(umi_dict) for umi_dict in dict_copy.values()):
+        raise Exception('UMI correction results are different')
+    return {method: min(times) for method, times in time_dict.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark UMI correction')
+    parser.add_argument('--n_gene', help='gene number', type=int, default=10)
+    parser.add_argument('--n_umi', help='true UMI number per gene', type=int, default=500)
+    parser.add_argument('--umi_length', help='UMI length', type=int, default=12)
+    parser.add_argument('--repeat', help='repeat times', type=int, default=3)
+    args = parser.parse_args()
+    time_dict = benchmark_correct_umi(args.n_gene, args.n_umi, args.umi_length, args.repeat)
+    for method, seconds in time_dict.items():
+        print(f'{method}\t{seconds:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
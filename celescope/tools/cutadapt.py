@@ -1,14 +1,120 @@
 import re
+import shutil
 import subprocess
 from itertools import islice
 
 import pandas as pd
 import pysam
+from cutadapt.adapters import AdapterParser
+from cutadapt.modifiers import AdapterCutter, NextseqQualityTrimmer, Shortener
+from cutadapt.seqio import Sequence
 
-from celescope.tools.step import Step, s_common
+from celescope.tools.step import Step, s_common, s_compress
 import celescope.tools.utils as utils
 
 ADAPTER = ['polyT=A{18}', 'p5=AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC']
+# cutadapt default
+ERROR_RATE = 0.1
+QUALITY_BASE = 33
+
+
+class AdapterTrimmer():
+    """
+    Trim R2 reads in process with the cutadapt API. Reads are modified in the same order as `Cutadapt.run`:
+    nextseq quality trimming, adapter trimming(`-n {adapter number}`), shorten to `--insert`, 
+    discard reads shorter than `--minimum_length`.
+
+    cutadapt objects are created lazily, so a trimmer can be pickled to worker processes.
+    """
+
+    def __init__(self, adapter_args, minimum_length, nextseq_trim, overlap, insert):
+        self.adapter_args = adapter_args
+        self.minimum_length = int(minimum_length)
+        self.nextseq_trim = int(nextseq_trim)
+        self.overlap = int(overlap)
+        self.insert = int(insert)
+        self.modifiers = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['modifiers'] = None
+        return state
+
+    def get_modifiers(self):
+        if self.modifiers is None:
+            parser = AdapterParser(
+                colorspace=False,
+                max_error_rate=ERROR_RATE,
+                min_overlap=self.overlap,
+                read_wildcards=False,
+                adapter_wildcards=True,
+                indels=True,
+            )
+            adapters = parser.parse_multi(self.adapter_args, [], [])
+            self.modifiers = (
+                NextseqQualityTrimmer(self.nextseq_trim, QUALITY_BASE),
+                AdapterCutter(adapters, times=len(adapters), action='trim'),
+                Shortener(self.insert),
+            )
+        return self.modifiers
+
+    def trim(self, seq, qual, metrics):
+        """
+        Args:
+            metrics: Counter. Keys are the counter names used by `get_stat_list`.
+        Returns:
+            trimmed (seq, qual). (None, None) if the read is too short.
+        """
+        nextseq_trimmer, adapter_cutter, shortener = self.get_modifiers()
+        metrics['reads'] += 1
+        metrics['bp'] += len(seq)
+
+        read = Sequence('', seq, qual)
+        trimmed_bases = nextseq_trimmer.trimmed_bases
+        read = nextseq_trimmer(read)
+        metrics['quality_trimmed_bp'] += nextseq_trimmer.trimmed_bases - trimmed_bases
+        read = adapter_cutter(read)
+        if read.match is not None:
+            metrics['with_adapters'] += 1
+        read = shortener(read)
+
+        if len(read) < self.minimum_length:
+            metrics['too_short'] += 1
+            return None, None
+        metrics['written'] += 1
+        metrics['written_bp'] += len(read)
+        return read.sequence, read.qualities
+
+    @staticmethod
+    def get_stat_list(metrics):
+        """
+        Same items and format as `Cutadapt.format_and_write_stat`.
+        Returns:
+            list of (item, value)
+        """
+
+        def fraction(numerator, denominator):
+            if not denominator:
+                return 0.0
+            return numerator / denominator
+
+        reads = metrics['reads']
+        bp = metrics['bp']
+        return [
+            ('Reads with Adapters', f"{metrics['with_adapters']:,d}({fraction(metrics['with_adapters'], reads):.1%})"),
+            ('Reads too Short', f"{metrics['too_short']:,d}({fraction(metrics['too_short'], reads):.1%})"),
+            ('Reads Written', f"{metrics['written']:,d}({fraction(metrics['written'], reads):.1%})"),
+            ('Base Pairs Processed', f"{bp:,d}"),
+            ('Base Pairs Quality-Trimmed',
+                f"{metrics['quality_trimmed_bp']:,d}({fraction(metrics['quality_trimmed_bp'], bp):.1%})"),
+            ('Base Pairs Written', f"{metrics['written_bp']:,d}({fraction(metrics['written_bp'], bp):.1%})"),
+        ]
+
+    @staticmethod
+    def write_stat(metrics, stat_file):
+        with open(stat_file, 'w') as fh:
+            for item, value in AdapterTrimmer.get_stat_list(metrics):
+                fh.write(f'{item}:{value}\n')
 
 
 class Cutadapt(Step):
@@ -82,6 +188,27 @@ class Cutadapt(Step):
         p_df.iloc[5, 0] = 'Base Pairs Written'
         p_df.to_csv(self.stat_file, sep=':', index=False, header=None)
 
+    @utils.add_log
+    def run_compress(self, cmd):
+        """
+        cutadapt writes reads to stdout, which are compressed with the compression arguments. 
+        The cutadapt log goes to stderr in this case.
+        Returns:
+            cutadapt log
+        """
+        Cutadapt.run_compress.logger.info(cmd)
+        args = self.args
+        with open(self.cutadapt_log_file, 'w') as log_fh, utils.open_fastq_writer(
+            self.out_fq2, 'wb', compress_level=args.compress_level, threads=args.compress_threads, bgzf=args.bgzf,
+        ) as writer:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log_fh, shell=True)
+            shutil.copyfileobj(process.stdout, writer)
+            returncode = process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        with open(self.cutadapt_log_file) as log_fh:
+            return log_fh.read()
+
     @utils.add_log
     def run(self):
         adapter_args_str = " ".join(['-a ' + adapter for adapter in self.adapter_args])
@@ -94,18 +221,24 @@ class Cutadapt(Step):
             f'--nextseq-trim={self.args.nextseq_trim} '
             f'--overlap {self.args.overlap} '
             f'-l {self.args.insert} '
-            f'-o {self.out_fq2} '
-            f'{self.args.fq} '
         )
-        Cutadapt.run.logger.info(cmd)
-        # need encoding argument to return str
-        results = subprocess.run(
-            cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, 
-            encoding='utf-8', check=True, shell=True
-        )
-        cutadapt_log = results.stdout
-        with open(self.cutadapt_log_file, 'w') as f:
-            f.write(cutadapt_log)
+        args = self.args
+        if args.gzip and (args.bgzf or args.compress_level or args.compress_threads):
+            cutadapt_log = self.run_compress(cmd + f'{args.fq} ')
+        else:
+            cmd += (
+                f'-o {self.out_fq2} '
+                f'{args.fq} '
+            )
+            Cutadapt.run.logger.info(cmd)
+            # need encoding argument to return str
+            results = subprocess.run(
+                cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, 
+                encoding='utf-8', check=True, shell=True
+            )
+            cutadapt_log = results.stdout
+            with open(self.cutadapt_log_file, 'w') as f:
+                f.write(cutadapt_log)
         self.format_and_write_stat(cutadapt_log)
         self.clean_up()
 
@@ -149,6 +282,7 @@ at least {overlap} bases match between adapter and read. """,
         help="Default `150`. Read2 insert length.", 
         default=150
     )
+    parser = s_compress(parser)
     if sub_program:
         parser.add_argument('--fq', help='Required. R2 reads from step Barcode.', required=True)
         parser.add_argument('--gzip', help="Output gzipped fastq", action='store_true')
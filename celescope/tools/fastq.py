@@ -0,0 +1,281 @@
+"""
+Chunked fastq reader.
+
+Fastq files are read in large blocks(mmap for uncompressed files, big reads through xopen for compressed files).
+Every block contains only complete records and is split into lines at once, so no Python object is created
+per record until a field is accessed.
+"""
+
+import argparse
+import mmap
+import re
+import time
+
+import numpy as np
+import pysam
+from xopen import xopen
+
+BLOCK_SIZE = 1 << 22
+COMPRESSED_SUFFIX = ('.gz', '.bz2', '.xz')
+COMMENT_RE = re.compile(r'[ \t][^\n]*')
+
+
+def record_end(block):
+    """
+    Returns:
+        end position of the last complete record in block. 0 if there is no complete record.
+    """
+    n_line = block.count(b'\n')
+    end = len(block)
+    for _ in range(n_line % 4 + 1):
+        end = block.rfind(b'\n', 0, end)
+    return end + 1
+
+
+def read_buffers(file_name, block_size=BLOCK_SIZE):
+    """
+    Yield buffers(bytes or memoryview) of complete fastq records.
+    """
+    is_mmap = not file_name.endswith(COMPRESSED_SUFFIX)
+    if is_mmap:
+        raw_fh = open(file_name, 'rb')
+        try:
+            fh = mmap.mmap(raw_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            raw_fh.close()
+            return
+    else:
+        fh = xopen(file_name, 'rb')
+
+    try:
+        carry = b''
+        size = block_size
+        while True:
+            data = fh.read(size)
+            block = carry + data if carry else data
+            if len(data) < size:
+                # end of file. allow missing or extra newlines at the end
+                if not block.strip():
+                    return
+                if not block.endswith(b'\n'):
+                    block += b'\n'
+                while block.count(b'\n') % 4 != 0 and block.endswith(b'\n\n'):
+                    block = block[:-1]
+                if block.count(b'\n') % 4 != 0:
+                    raise Exception(f"FASTQ file ended prematurely: {file_name}")
+                yield block
+                return
+            end = record_end(block)
+            if end == 0:
+                # a record is longer than the block
+                carry = block
+                size *= 2
+                continue
+            yield memoryview(block)[:end]
+            if is_mmap:
+                fh.seek(end - len(block), 1)
+                carry = b''
+            else:
+                carry = block[end:]
+    finally:
+        fh.close()
+        if is_mmap:
+            raw_fh.close()
+
+
+class FastqBlock():
+    """
+    Complete fastq records in one buffer.
+
+    Fields can be accessed as lists of str(names, sequences, qualities) or as memoryview slices of the buffer
+    (iter_views), which do not copy any data.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._lines = None
+        self._newlines = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            text = str(self.buffer, 'ascii')
+            if '\r' in text:
+                text = text.replace('\r\n', '\n')
+            self._lines = text.split('\n')
+            # buffer ends with a newline
+            self._lines.pop()
+            self.check()
+        return self._lines
+
+    def __len__(self):
+        return len(self.lines) // 4
+
+    def check(self):
+        headers = '\n'.join(self._lines[0::4])
+        pluses = '\n'.join(self._lines[2::4])
+        n_record = len(self._lines) // 4
+        if n_record == 0:
+            return
+        if not headers.startswith('@') or headers.count('\n@') != n_record - 1:
+            raise Exception("FASTQ record is expected to start with '@'")
+        if not pluses.startswith('+') or pluses.count('\n+') != n_record - 1:
+            raise Exception("Line 3 of FASTQ record is expected to start with '+'")
+        if list(map(len, self._lines[1::4])) != list(map(len, self._lines[3::4])):
+            raise Exception("Length of sequence and quality are not equal in FASTQ record")
+
+    @property
+    def headers(self):
+        """
+        header lines without '@', including comments
+        """
+        return '\n'.join(self.lines[0::4])[1:].replace('\n@', '\n').split('\n')
+
+    @property
+    def names(self):
+        """
+        read names. Same as pysam.FastxFile entry.name, the comment after the first whitespace is removed.
+        """
+        headers = '\n'.join(self.lines[0::4])[1:].replace('\n@', '\n')
+        if ' ' not in headers and '\t' not in headers:
+            return headers.split('\n')
+        return COMMENT_RE.sub('', headers).split('\n')
+
+    @property
+    def sequences(self):
+        return self.lines[1::4]
+
+    @property
+    def qualities(self):
+        return self.lines[3::4]
+
+    def iter_views(self):
+        """
+        Yield (header, sequence, quality) memoryview slices of the buffer. Header does not contain '@'.
+        """
+        view = memoryview(self.buffer)
+        if self._newlines is None:
+            self._newlines = np.flatnonzero(np.frombuffer(view, dtype=np.uint8) == ord('\n'))
+        starts = np.concatenate(([0], self._newlines[:-1] + 1)).tolist()
+        ends = self._newlines.tolist()
+        for i in range(0, len(ends), 4):
+            yield view[starts[i] + 1: ends[i]], view[starts[i + 1]: ends[i + 1]], view[starts[i + 3]: ends[i + 3]]
+
+
+def read_fastq_blocks(file_name, block_size=BLOCK_SIZE):
+    for buffer in read_buffers(file_name, block_size):
+        yield FastqBlock(buffer)
+
+
+def read_fastq_records(file_name, block_size=BLOCK_SIZE):
+    """
+    Faster replacement of pysam.FastxFile for fastq files.
+    Yield (name, sequence, quality) tuples of str.
+    """
+    for block in read_fastq_blocks(file_name, block_size):
+        yield from zip(block.names, block.sequences, block.qualities)
+
+
+def strip_mate(name):
+    """
+    remove mate suffix. `read/1` (old Illumina) and `read.1` (fastq-dump --readids)
+    """
+    if name.endswith(('/1', '/2', '.1', '.2')):
+        return name[:-2]
+    return name
+
+
+def check_pair_names(names1, names2):
+    if names1 == names2:
+        return
+    for name1, name2 in zip(names1, names2):
+        if strip_mate(name1) != strip_mate(name2):
+            raise Exception(f'Read names in R1 and R2 do not match: {name1} {name2}')
+
+
+def read_fastq_pairs(fq1_file, fq2_file, block_size=BLOCK_SIZE, check_name=True):
+    """
+    Yield (names1, seqs1, quals1, names2, seqs2, quals2), each is a list of str with the same number of read pairs.
+    Raise an exception if R1 and R2 have different read numbers, or if check_name and read names do not match.
+    """
+    blocks1 = read_fastq_blocks(fq1_file, block_size)
+    blocks2 = read_fastq_blocks(fq2_file, block_size)
+    fields1, fields2 = [[]], [[]]
+    while True:
+        if not fields1[0]:
+            block = next(blocks1, None)
+            fields1 = None if block is None else [block.names, block.sequences, block.qualities]
+        if not fields2[0]:
+            block = next(blocks2, None)
+            fields2 = None if block is None else [block.names, block.sequences, block.qualities]
+        if fields1 is None or fields2 is None:
+            if fields1 or fields2:
+                raise Exception(f'{fq1_file} and {fq2_file} have different read numbers')
+            return
+        n_pair = min(len(fields1[0]), len(fields2[0]))
+        pair_fields = [field[:n_pair] for field in fields1 + fields2]
+        if check_name:
+            check_pair_names(pair_fields[0], pair_fields[3])
+        fields1 = [field[n_pair:] for field in fields1]
+        fields2 = [field[n_pair:] for field in fields2]
+        yield tuple(pair_fields)
+
+
+def deprecated_read_fastq(fq):
+    from celescope.tools.barcode import read_fastq
+    with xopen(fq, 'r') as fh:
+        for _name, _seq, _qual in read_fastq(fh):
+            pass
+
+
+def pysam_read_fastq(fq):
+    with pysam.FastxFile(fq, persist=False) as fh:
+        for entry in fh:
+            _name, _seq, _qual = entry.name, entry.sequence, entry.quality
+
+
+def chunked_read_fastq(fq):
+    for _name, _seq, _qual in read_fastq_records(fq):
+        pass
+
+
+def chunked_read_views(fq):
+    for block in read_fastq_blocks(fq):
+        for _header, _seq, _qual in block.iter_views():
+            pass
+
+
+def benchmark(fq, repeat=3):
+    """
+    Returns:
+        {reader name: best time in seconds}
+    """
+    reader_dict = {
+        'read_fastq(deprecated)': deprecated_read_fastq,
+        'pysam.FastxFile': pysam_read_fastq,
+        'read_fastq_records': chunked_read_fastq,
+        'FastqBlock.iter_views': chunked_read_views,
+    }
+    time_dict = {}
+    for reader_name, reader in reader_dict.items():
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            reader(fq)
+            times.append(time.time() - start)
+        time_dict[reader_name] = min(times)
+    return time_dict
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark fastq readers')
+    parser.add_argument('--fq', help='fastq file', required=True)
+    parser.add_argument('--repeat', help='repeat times', type=int, default=3)
+    args = parser.parse_args()
+    for reader_name, seconds in benchmark(args.fq, args.repeat).items():
+        print(f'{reader_name}\t{seconds:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
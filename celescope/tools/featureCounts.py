@@ -29,7 +29,10 @@ class FeatureCounts(Step):
         - GN gene name
         - GX gene id
 
-    - `{sample}_name_sorted.bam` featureCounts output BAM, sorted by read name.
+    - `{sample}_name_sorted.bam` featureCounts output BAM, sorted by read name. Not generated with `--skip_name_sort`.
+
+    - `{sample}_Aligned.sortedByCoord.out.bam.featureCounts.bam.bai` Index of the coordinate sorted BAM. Only generated 
+    with `--index_bam`.
     """
 
     def __init__(self, args, step_name):
@@ -41,6 +44,9 @@ class FeatureCounts(Step):
         # out files
         input_basename = os.path.basename(self.args.input)
         self.featureCounts_bam = f'{self.outdir}/{input_basename}.featureCounts.bam'
+        # featureCounts writes the untagged BAM here with --stream_tag
+        self.raw_dir = f'{self.outdir}/featureCounts_raw'
+        self.raw_bam = f'{self.raw_dir}/{input_basename}.featureCounts.bam'
         self.name_sorted_bam = f'{self.out_prefix}_name_sorted.bam'
         self.featureCount_log_file = f'{self.out_prefix}.summary'
 
@@ -86,8 +92,11 @@ class FeatureCounts(Step):
             '-R BAM '
             f'-T {self.thread} '
             f'-t {self.args.gtf_type} '
-            f'{self.args.input} '
         )
+        if self.args.stream_tag:
+            os.makedirs(self.raw_dir, exist_ok=True)
+            cmd += f'--Rpath {self.raw_dir} '
+        cmd += f'{self.args.input} '
         FeatureCounts.run_featureCounts.logger.info(cmd)
         subprocess.check_call(cmd, shell=True)
     
@@ -102,15 +111,48 @@ class FeatureCounts(Step):
         FeatureCounts.name_sort_bam.logger.info(cmd)
         subprocess.check_call(cmd, shell=True)
 
+    @add_log
+    def stream_tag(self):
+        name_sorted_bam = None
+        if not self.args.skip_name_sort:
+            name_sorted_bam = self.name_sorted_bam
+        stream_tag(self.raw_bam, self.gtf, self.featureCounts_bam, self.thread, name_sorted_bam)
+        os.remove(self.raw_bam)
+        os.rmdir(self.raw_dir)
+
+    @add_log
+    def index_bam(self):
+        cmd = f'samtools index {self.featureCounts_bam}'
+        FeatureCounts.index_bam.logger.info(cmd)
+        subprocess.check_call(cmd, shell=True)
 
     def run(self):
         self.run_featureCounts()
-        add_tag(self.featureCounts_bam, self.gtf)
-        self.name_sort_bam()
+        if self.args.stream_tag:
+            self.stream_tag()
+        else:
+            add_tag(self.featureCounts_bam, self.gtf)
+            if not self.args.skip_name_sort:
+                self.name_sort_bam()
+        if self.args.index_bam:
+            self.index_bam()
         self.format_stat()
         self.clean_up()
 
 
+def set_read_tags(read, id_name):
+    attr = read.query_name.split('_')
+    barcode = attr[0]
+    umi = attr[1]
+    read.set_tag(tag='CB', value=barcode, value_type='Z')
+    read.set_tag(tag='UB', value=umi, value_type='Z')
+    if read.has_tag('XT'):
+        gene_id = read.get_tag('XT')
+        gene_name = id_name[gene_id]
+        read.set_tag(tag='GN', value=gene_name, value_type='Z')
+        read.set_tag(tag='GX', value=gene_id, value_type='Z')
+
+
 @add_log
 def add_tag(bam, gtf):
     id_name = get_id_name_dict(gtf)
@@ -119,22 +161,44 @@ def add_tag(bam, gtf):
     new_bam = pysam.AlignmentFile(
         bam + ".temp", "wb", header=header)
     for read in samfile:
-        attr = read.query_name.split('_')
-        barcode = attr[0]
-        umi = attr[1]
-        read.set_tag(tag='CB', value=barcode, value_type='Z')
-        read.set_tag(tag='UB', value=umi, value_type='Z')
-        if read.has_tag('XT'):
-            gene_id = read.get_tag('XT')
-            gene_name = id_name[gene_id]
-            read.set_tag(tag='GN', value=gene_name, value_type='Z')
-            read.set_tag(tag='GX', value=gene_id, value_type='Z')
+        set_read_tags(read, id_name)
         new_bam.write(read)
     new_bam.close()
     cmd = f'mv {bam}.temp {bam}'
     subprocess.check_call(cmd, shell=True)
 
 
+@add_log
+def stream_tag(in_bam, gtf, out_bam, thread=1, name_sorted_bam=None):
+    """
+    Read in_bam once and write tagged reads to out_bam with `thread` BGZF threads.
+    If name_sorted_bam, tagged reads are also piped to `samtools sort -n` as uncompressed BAM,
+    so no intermediate BAM is written or read again.
+    """
+    id_name = get_id_name_dict(gtf)
+    thread = int(thread)
+    sort_proc = None
+    with pysam.AlignmentFile(in_bam, "rb", threads=thread) as samfile:
+        out_files = [pysam.AlignmentFile(out_bam, "wb", template=samfile, threads=thread)]
+        if name_sorted_bam:
+            cmd = ['samtools', 'sort', '-n', '-@', str(thread), '-o', name_sorted_bam, '-']
+            stream_tag.logger.info(' '.join(cmd))
+            sort_proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            out_files.append(pysam.AlignmentFile(sort_proc.stdin, "wbu", template=samfile))
+        try:
+            for read in samfile:
+                set_read_tags(read, id_name)
+                for out_file in out_files:
+                    out_file.write(read)
+        finally:
+            for out_file in out_files:
+                out_file.close()
+            if sort_proc:
+                sort_proc.stdin.close()
+    if sort_proc and sort_proc.wait() != 0:
+        raise subprocess.CalledProcessError(sort_proc.returncode, cmd)
+
+
 @add_log
 def featureCounts(args):
     step_name = "featureCounts"
@@ -149,6 +213,30 @@ def get_opts_featureCounts(parser, sub_program):
         default='exon'
     )
     parser.add_argument('--genomeDir', help='Required. Genome directory.')
+    parser.add_argument(
+        '--skip_name_sort',
+        help=(
+            'Do not sort featureCounts output BAM by read name. '
+            '`count` step reads the coordinate sorted `*.featureCounts.bam` directly. '
+            'Not supported in `multi_capture_rna`.'
+        ),
+        action='store_true',
+    )
+    parser.add_argument(
+        '--stream_tag',
+        help=(
+            'Add tags while reading featureCounts output BAM once. Tagged reads are written to the coordinate sorted '
+            '`*.featureCounts.bam` with `--thread` threads and piped to `samtools sort -n` at the same time, '
+            'so the BAM is not read again to sort. It saves time, not disk: the untagged featureCounts BAM, '
+            'the tagged BAM and the sort temp files exist at the same time, so peak disk use is about the same.'
+        ),
+        action='store_true',
+    )
+    parser.add_argument(
+        '--index_bam',
+        help='Index the coordinate sorted `*.featureCounts.bam` with `samtools index`.',
+        action='store_true',
+    )
     if sub_program:
         parser.add_argument('--input', help='Required. BAM file path.', required=True)
         parser = s_common(parser)
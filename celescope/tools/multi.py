@@ -9,6 +9,8 @@ from celescope.tools.utils import find_assay_init, find_step_module
 from celescope.celescope import ArgFormatter
 
 TOOLS_DIR = os.path.dirname(celescope.tools.__file__)
+# assays whose steps after barcode read R2 reads only through `Multi.star`, which accepts the unaligned BAM
+OUTPUT_BAM_ASSAYS = ['rna']
 
 
 class Multi():
@@ -66,6 +68,17 @@ class Multi():
         parser.add_argument('--outdir', help='output dir', default="./")
         parser.add_argument('--debug', help='debug or not', action='store_true')
         parser.add_argument('--thread', help='thread', default=4)
+        parser.add_argument(
+            '--shared_genome',
+            help=(
+                'Load the STAR genome of `--genomeDir` into shared memory once. `star` jobs of all samples attach to it '
+                'with `--genomeLoad LoadAndKeep`. The genome is removed after the `star` jobs of all samples exit '
+                'or a step before `star` fails. Shared memory is local to a node, so all `star` jobs should run on '
+                'the same node. In sjm mode, `star` jobs still request `--starMem` memory because a job on a node '
+                'without the shared genome loads its own copy.'
+            ),
+            action='store_true',
+        )
         self.parser = parser
         return parser
 
@@ -121,6 +134,15 @@ class Multi():
         """
         parse_mapfile, link data, make log dir, init script variables, init outdir_dic
         """
+        if getattr(self.args, 'output_bam', False):
+            if self.__ASSAY__ not in OUTPUT_BAM_ASSAYS:
+                raise ValueError(
+                    f'--output_bam is not supported in multi_{self.__ASSAY__}, '
+                    'steps after barcode read fastq files. Only supported in multi_rna.'
+                )
+            if not getattr(self.args, 'fused_cutadapt', False):
+                raise ValueError('--output_bam must be used with --fused_cutadapt, step cutadapt can not read BAM.')
+
         # parse_mapfile
         self.fq_dict, self.col4_dict = self.parse_map_col4(self.args.mapfile, self.col4_default)
 
@@ -145,6 +167,52 @@ class Multi():
                 step_outdir = f"{self.args.outdir}/{sample}/{index:02d}.{step}"
                 self.outdir_dic[sample].update({step: step_outdir})
                 index += 1
+
+        # barcode step outputs the clean fastq. Steps after cutadapt read it from the barcode outdir.
+        if getattr(self.args, 'fused_cutadapt', False) and 'cutadapt' in self.__STEPS__:
+            self.steps_not_run.append('cutadapt')
+            for sample in self.fq_dict:
+                self.outdir_dic[sample]['cutadapt'] = self.outdir_dic[sample]['barcode']
+
+        # STAR genome in shared memory
+        self.genome_server_dir = None
+        if self.args.shared_genome and 'star' in self.steps_run and 'star' not in self.steps_not_run:
+            self.genome_server_dir = f'{self.logdir}/genome_server'
+            # done files of the last run
+            os.system('rm -rf %s' % (self.genome_server_dir))
+            os.system('mkdir -p %s' % (self.genome_server_dir))
+
+    def get_genome_server_cmd(self, action, sample=None):
+        cmd = (
+            f'python -m celescope.tools.star_mixin {action} '
+            f'--genomeDir {self.args.genomeDir} '
+            f'--server_dir {self.genome_server_dir}'
+        )
+        if action == 'release':
+            samples = ','.join(self.fq_dict.keys())
+            cmd += f' --sample {sample} --samples {samples}'
+        return cmd
+
+    def add_genome_server(self, cmd, step, sample):
+        """
+        star attaches to the shared genome and releases it when it exits. 
+        Steps before star release it if they fail, so the genome is always removed after the last sample.
+        """
+        release_cmd = self.get_genome_server_cmd('release', sample)
+        if step == 'star':
+            return f'{cmd} --genomeLoad LoadAndKeep || {{ {release_cmd}; exit 1; }}; {release_cmd}'
+        if step in self.__STEPS__[:self.__STEPS__.index('star')]:
+            return f'{cmd} || {{ {release_cmd}; exit 1; }}'
+        return cmd
+
+    def genome_load(self):
+        """
+        sjm job to load the genome. star jobs of all samples run after it.
+        In shell mode, each sample loads the genome before star. STAR waits if the genome is being loaded by 
+        another sample and does not load it again.
+        """
+        cmd = self.get_genome_server_cmd('load')
+        self.generate_cmd(cmd, 'genome_load', sample='', m=self.args.starMem, x=1)
     
     def generate_cmd(self, cmd, step, sample, m=1, x=1):
         if sample:
@@ -158,6 +226,13 @@ job_end
 '''
 
     def process_cmd(self, cmd, step, sample, m=1, x=1):
+        if self.genome_server_dir:
+            cmd = self.add_genome_server(cmd, step, sample)
+            if step == 'star':
+                release_cmd = self.get_genome_server_cmd('release', sample)
+                load_cmd = self.get_genome_server_cmd('load')
+                self.shell_dict[sample] += f'{load_cmd} || {{ {release_cmd}; exit 1; }}\n'
+                self.sjm_order += f'order {step}_{sample} after genome_load\n'
         self.generate_cmd(cmd, step, sample, m=m, x=x)
         self.shell_dict[sample] += cmd + '\n'
         if self.last_step:
@@ -191,6 +266,9 @@ job_end
         for arg in args_dict:
             if args_dict[arg] is False:
                 continue
+            # star attaches to the shared genome with `--genomeLoad LoadAndKeep` added by add_genome_server
+            if arg == 'genomeLoad' and step == 'star' and self.genome_server_dir:
+                continue
             if args_dict[arg] is True:
                 cmd_line += f'--{arg} '
             else:
@@ -222,7 +300,7 @@ job_end
             f'{cmd_line} '
             f'--fq1 {arr[0]} --fq2 {arr[1]} '
         )
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
 
     def cutadapt(self, sample):
         step = "cutadapt"
@@ -237,6 +315,8 @@ job_end
     def star(self, sample):
         step = 'star'
         fq = f'{self.outdir_dic[sample]["cutadapt"]}/{sample}_clean_2.fq{self.fq_suffix}'
+        if getattr(self.args, 'output_bam', False):
+            fq = f'{self.outdir_dic[sample]["cutadapt"]}/{sample}_clean_2.bam'
         cmd_line = self.get_cmd_line(step, sample)
         cmd = (
             f'{cmd_line} '
@@ -257,6 +337,11 @@ job_end
     def count(self, sample):
         step = 'count'
         bam = f'{self.outdir_dic[sample]["featureCounts"]}/{sample}_name_sorted.bam'
+        if getattr(self.args, 'skip_name_sort', False):
+            bam = (
+                f'{self.outdir_dic[sample]["featureCounts"]}/'
+                f'{sample}_Aligned.sortedByCoord.out.bam.featureCounts.bam'
+            )
         cmd_line = self.get_cmd_line(step, sample)
         cmd = (
             f'{cmd_line} '
@@ -264,7 +349,7 @@ job_end
             f'--force_cell_num {self.col4_dict[sample]} '
         )
 
-        self.process_cmd(cmd, step, sample, m=10, x=1)
+        self.process_cmd(cmd, step, sample, m=10, x=self.args.thread)
 
     def analysis(self, sample):
         step = 'analysis'
@@ -289,6 +374,8 @@ job_end
         return outfile
 
     def run_steps(self):
+        if self.genome_server_dir:
+            self.genome_load()
         for sample in self.fq_dict:
             self.last_step = ''
             for step in self.steps_run:
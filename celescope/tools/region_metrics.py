@@ -0,0 +1,292 @@
+"""
+Region metrics of aligned bases, a replacement of Picard CollectRnaSeqMetrics(STRAND=NONE).
+
+Every aligned base(cigar M/=/X) of a mapped primary read is assigned to one region class, in the same way as Picard:
+    - CODING: in a coding exon of any transcript
+    - UTR: in an exon of any transcript, but not coding
+    - INTRONIC: in the span of any transcript, but not in an exon
+    - INTERGENIC: others
+Genes are transcripts with the same name in the refFlat file. As in Picard, genes with transcripts on different
+chromosomes or strands are skipped.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+from array import array
+
+import numpy as np
+import pysam
+
+import celescope.tools.utils as utils
+from celescope.tools.__init__ import REGION_INDEX_SUFFIX
+
+REGION_CLASSES = ('INTERGENIC', 'INTRONIC', 'UTR', 'CODING')
+N_CLASS = len(REGION_CLASSES)
+# unmapped, secondary, qc fail, supplementary
+READ_FILTER_FLAG = 0x4 | 0x100 | 0x200 | 0x800
+# aligned blocks classified at a time
+BLOCK_BUFFER_SIZE = 1 << 20
+METRICS_CLASS = 'celescope.tools.region_metrics.RegionMetrics'
+
+
+def merge_intervals(starts, ends):
+    """
+    Returns:
+        starts and ends of sorted disjoint intervals covering the same bases. Intervals are half-open.
+    """
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    max_ends = np.maximum.accumulate(ends)
+    is_new = np.concatenate(([True], starts[1:] > max_ends[:-1]))
+    group_index = np.flatnonzero(is_new)
+    return starts[group_index], np.maximum.reduceat(ends, group_index)
+
+
+def in_intervals(positions, starts, ends):
+    index = np.searchsorted(starts, positions, side='right') - 1
+    return (index >= 0) & (positions < ends[np.maximum(index, 0)])
+
+
+class RegionIndex():
+    """
+    Region classes of each chromosome as sorted segment bounds.
+    Segment i of a chromosome is [bounds[i], bounds[i + 1]) and has class classes[i]. The last segment is intergenic.
+    cum_bases[i, c] is the number of bases of class c before bounds[i].
+
+    Arrays of all chromosomes are concatenated, chromosome j is in [offsets[j], offsets[j + 1]).
+    The index is saved next to the refFlat file({refFlat}.celescope_region_index.npz).
+    """
+
+    def __init__(self, chroms, offsets, bounds, classes, cum_bases, meta):
+        self.chroms = chroms
+        self.offsets = offsets
+        self.bounds = bounds
+        self.classes = classes
+        self.cum_bases = cum_bases
+        self.meta = meta
+        self.chrom_index = {chrom: i for i, chrom in enumerate(chroms)}
+
+    @staticmethod
+    def get_file_name(refflat):
+        return f'{refflat}{REGION_INDEX_SUFFIX}'
+
+    @staticmethod
+    def get_meta(refflat):
+        return {'md5': utils.get_file_md5(refflat)}
+
+    @staticmethod
+    @utils.add_log
+    def read_refflat(refflat):
+        """
+        Returns:
+            {chrom: [(tx_start, tx_end, cds_start, cds_end, exon_starts, exon_ends)]}. 0-based, half-open.
+        """
+        gene_dict = {}
+        with open(refflat) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                items = line.rstrip('\n').split('\t')
+                gene_name, chrom, strand = items[0], items[2], items[3]
+                tx_start, tx_end, cds_start, cds_end = (int(item) for item in items[4:8])
+                exon_starts = [int(start) for start in items[9].strip(',').split(',')]
+                exon_ends = [int(end) for end in items[10].strip(',').split(',')]
+                gene_dict.setdefault(gene_name, []).append(
+                    (chrom, strand, tx_start, tx_end, cds_start, cds_end, exon_starts, exon_ends))
+
+        chrom_dict = {}
+        n_skip = 0
+        for transcripts in gene_dict.values():
+            if len(set((transcript[0], transcript[1]) for transcript in transcripts)) > 1:
+                n_skip += 1
+                continue
+            chrom = transcripts[0][0]
+            chrom_dict.setdefault(chrom, []).extend(transcript[2:] for transcript in transcripts)
+        if n_skip:
+            RegionIndex.read_refflat.logger.warning(
+                f'{n_skip} genes with transcripts on different chromosomes or strands are skipped.')
+        return chrom_dict
+
+    @staticmethod
+    def get_chrom_segments(transcripts):
+        tx_starts, tx_ends, exon_starts, exon_ends, coding_starts, coding_ends = ([] for _ in range(6))
+        for tx_start, tx_end, cds_start, cds_end, tx_exon_starts, tx_exon_ends in transcripts:
+            tx_starts.append(tx_start)
+            tx_ends.append(tx_end)
+            for exon_start, exon_end in zip(tx_exon_starts, tx_exon_ends):
+                # exons are clipped to the transcript span
+                exon_start, exon_end = max(exon_start, tx_start), min(exon_end, tx_end)
+                exon_starts.append(exon_start)
+                exon_ends.append(exon_end)
+                coding_starts.append(max(exon_start, cds_start))
+                coding_ends.append(min(exon_end, cds_end))
+        class_intervals = [
+            merge_intervals(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+            for starts, ends in ((tx_starts, tx_ends), (exon_starts, exon_ends), (coding_starts, coding_ends))
+        ]
+        bounds = np.unique(np.concatenate([[0]] + [arr for interval in class_intervals for arr in interval]))
+        classes = np.zeros(len(bounds), dtype=np.int8)
+        for region_class, (starts, ends) in enumerate(class_intervals, start=1):
+            classes[in_intervals(bounds, starts, ends)] = region_class
+        seg_bases = np.zeros((len(bounds), N_CLASS), dtype=np.int64)
+        seg_bases[np.arange(len(bounds) - 1), classes[:-1]] = np.diff(bounds)
+        cum_bases = np.zeros_like(seg_bases)
+        cum_bases[1:] = np.cumsum(seg_bases[:-1], axis=0)
+        return bounds, classes, cum_bases
+
+    @classmethod
+    def build(cls, refflat):
+        chrom_dict = cls.read_refflat(refflat)
+        chroms = sorted(chrom_dict)
+        segments = [cls.get_chrom_segments(chrom_dict[chrom]) for chrom in chroms]
+        offsets = np.cumsum([0] + [len(bounds) for bounds, _, _ in segments]).astype(np.int64)
+        if segments:
+            bounds, classes, cum_bases = (np.concatenate(arrs) for arrs in zip(*segments))
+        else:
+            bounds = np.zeros(0, dtype=np.int64)
+            classes = np.zeros(0, dtype=np.int8)
+            cum_bases = np.zeros((0, N_CLASS), dtype=np.int64)
+        return cls(np.array(chroms, dtype=str), offsets, bounds, classes, cum_bases, cls.get_meta(refflat))
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as npz:
+            meta = json.loads(str(npz['meta']))
+            return cls(npz['chroms'], npz['offsets'], npz['bounds'], npz['classes'], npz['cum_bases'], meta)
+
+    def save(self, file_name):
+        """
+        write to a temp file then rename, so samples running at the same time never read a partial file
+        """
+        tmp_file = f'{file_name}.{os.getpid()}.tmp.npz'
+        np.savez(
+            tmp_file, chroms=self.chroms, offsets=self.offsets, bounds=self.bounds, classes=self.classes,
+            cum_bases=self.cum_bases, meta=np.array(json.dumps(self.meta)),
+        )
+        os.replace(tmp_file, file_name)
+
+    @classmethod
+    @utils.add_log
+    def from_refflat(cls, refflat):
+        """
+        Load the index saved by mkref. Build it again if it does not exist or the refFlat file changed.
+        """
+        file_name = cls.get_file_name(refflat)
+        if os.path.exists(file_name):
+            region_index = cls.load(file_name)
+            if region_index.meta == cls.get_meta(refflat):
+                return region_index
+            cls.from_refflat.logger.warning(f'{refflat} changed. region index is outdated.')
+        region_index = cls.build(refflat)
+        try:
+            region_index.save(file_name)
+        except OSError as error:
+            cls.from_refflat.logger.warning(f'can not write region index: {error}')
+        return region_index
+
+    def get_chrom_index(self, chrom):
+        """
+        Returns:
+            bounds, classes and cum_bases of chrom. A chromosome without genes is one intergenic segment.
+        """
+        if chrom not in self.chrom_index:
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int8), np.zeros((1, N_CLASS), dtype=np.int64)
+        i = self.chrom_index[chrom]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.bounds[start:end], self.classes[start:end], self.cum_bases[start:end]
+
+
+def get_bases_before(positions, bounds, classes, cum_bases):
+    """
+    Returns:
+        array of shape (len(positions), N_CLASS). Number of bases of each class before each position.
+    """
+    index = np.searchsorted(bounds, positions, side='right') - 1
+    bases = cum_bases[index]
+    bases[np.arange(len(positions)), classes[index]] += positions - bounds[index]
+    return bases
+
+
+def count_block_bases(starts, ends, chrom_index):
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.frombuffer(ends, dtype=np.int64)
+    return (get_bases_before(ends, *chrom_index) - get_bases_before(starts, *chrom_index)).sum(axis=0)
+
+
+def count_contig_bases(args):
+    """
+    Returns:
+        bases of each region class of aligned blocks on contig.
+    """
+    bam, contig, chrom_index = args
+    bases = np.zeros(N_CLASS, dtype=np.int64)
+    starts, ends = array('q'), array('q')
+    with pysam.AlignmentFile(bam, 'rb') as samfile:
+        for read in samfile.fetch(contig):
+            if read.flag & READ_FILTER_FLAG:
+                continue
+            for start, end in read.get_blocks():
+                starts.append(start)
+                ends.append(end)
+            if len(starts) >= BLOCK_BUFFER_SIZE:
+                bases += count_block_bases(starts, ends, chrom_index)
+                starts, ends = array('q'), array('q')
+    if starts:
+        bases += count_block_bases(starts, ends, chrom_index)
+    return bases
+
+
+@utils.add_log
+def get_region_metrics(bam, region_index, thread=1):
+    """
+    Read contigs of the indexed bam with `thread` processes.
+
+    Returns:
+        {'PF_ALIGNED_BASES': int, 'CODING_BASES': int, 'UTR_BASES': int, 'INTRONIC_BASES': int, 'INTERGENIC_BASES': int}
+    """
+    with pysam.AlignmentFile(bam, 'rb') as samfile:
+        index_stats = sorted(samfile.get_index_statistics(), key=lambda stat: stat.mapped, reverse=True)
+    tasks = [(bam, stat.contig, region_index.get_chrom_index(stat.contig)) for stat in index_stats if stat.mapped]
+    thread = min(int(thread), len(tasks))
+    if thread > 1:
+        with multiprocessing.Pool(thread) as pool:
+            contig_bases = pool.map(count_contig_bases, tasks, chunksize=1)
+    else:
+        contig_bases = [count_contig_bases(task) for task in tasks]
+    bases = np.sum(contig_bases, axis=0, dtype=np.int64) if contig_bases else np.zeros(N_CLASS, dtype=np.int64)
+
+    metrics = {'PF_ALIGNED_BASES': int(bases.sum())}
+    for region_class in reversed(REGION_CLASSES):
+        metrics[f'{region_class}_BASES'] = int(bases[REGION_CLASSES.index(region_class)])
+    return metrics
+
+
+def write_region_metrics(metrics, out_file):
+    """
+    Same layout as the metrics section of Picard output.
+    """
+    with open(out_file, 'w') as f:
+        f.write(f'## METRICS CLASS\t{METRICS_CLASS}\n')
+        f.write('\t'.join(metrics) + '\n')
+        f.write('\t'.join(str(value) for value in metrics.values()) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser('region metrics of aligned bases')
+    parser.add_argument('--bam', help='coordinate sorted and indexed bam', required=True)
+    parser.add_argument('--refflat', help='refFlat file', required=True)
+    parser.add_argument('--thread', help='processes to use', type=int, default=1)
+    args = parser.parse_args()
+    region_index = RegionIndex.from_refflat(args.refflat)
+    for name, value in get_region_metrics(args.bam, region_index, args.thread).items():
+        print(f'{name}\t{value}')
+
+
+if __name__ == '__main__':
+    main()
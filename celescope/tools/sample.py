@@ -25,9 +25,12 @@ def sample(args):
     # get chemistry
     if chemistry == 'auto':
         fq1 = args.fq1
-        ch = Chemistry(fq1)
-        chemistry = ch.check_chemistry()
+        # step barcode reads this cache instead of detecting again
+        chemistry_cache = step.content_dict['data'].get('chemistry_cache', {})
+        ch = Chemistry(fq1, thread=args.thread)
+        chemistry = ch.check_chemistry(cache=chemistry_cache)
         chemistry = ",".join(set(chemistry))
+        step.add_data_item(chemistry_cache=chemistry_cache)
     else:
         chemistry = args.chemistry
     
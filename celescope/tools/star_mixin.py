@@ -1,3 +1,5 @@
+import argparse
+import os
 import re
 import subprocess
 
@@ -19,6 +21,7 @@ class StarMixin():
         self.multi_max = int(args.outFilterMultimapNmax)
         self.STAR_param = args.STAR_param
         self.consensus_fq = args.consensus_fq
+        self.genomeLoad = args.genomeLoad
 
         # parse
         self.genome = parse_genomeDir(self.genomeDir)
@@ -31,11 +34,14 @@ class StarMixin():
         if add_prefix:
             self.outPrefix += add_prefix + '_'
         self.STAR_map_log = f'{self.outPrefix}Log.final.out'
-        self.unsort_STAR_bam = f'{self.outPrefix}Aligned.out.bam'
         self.STAR_bam = f'{self.outPrefix}Aligned.sortedByCoord.out.bam'
     
     @utils.add_log
     def STAR(self):
+        """
+        STAR writes the unsorted BAM to stdout, which is piped to `samtools sort`. 
+        Sorting runs at the same time as mapping and no unsorted BAM is written to disk.
+        """
         cmd = [
             'STAR',
             '--runThreadN', str(self.thread),
@@ -44,34 +50,44 @@ class StarMixin():
             '--outFilterMultimapNmax', str(self.multi_max),
             '--outFileNamePrefix', self.outPrefix,
             '--outSAMtype', 'BAM', 'Unsorted', # controls sort by Coordinate or not
+            '--outStd', 'BAM_Unsorted',
             '--outFilterMatchNmin', str(self.outFilterMatchNmin)
         ]
+        if self.genomeLoad != 'NoSharedMemory':
+            cmd += ['--genomeLoad', self.genomeLoad]
         if self.out_unmapped:
             cmd += ['--outReadsUnmapped', 'Fastx']
-        if self.fq[-3:] == ".gz":
+        if self.fq[-4:] == ".bam":
+            # unaligned BAM from step barcode
+            cmd += ['--readFilesType', 'SAM', 'SE', '--readFilesCommand', 'samtools', 'view', '-F', '0x100']
+        elif self.fq[-3:] == ".gz":
             cmd += ['--readFilesCommand', 'zcat']
         cmd = ' '.join(cmd)
         if self.STAR_param:
             cmd += (" " + self.STAR_param)
-        StarMixin.STAR.logger.info(cmd)
-        subprocess.check_call(cmd, shell=True)
+        sort_cmd = (
+            'samtools sort '
+            f'-o {self.STAR_bam} '
+            f'--threads {self.thread} '
+            '-'
+        )
+        StarMixin.STAR.logger.info(f'{cmd} | {sort_cmd}')
+        star_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        sort_proc = subprocess.Popen(sort_cmd, shell=True, stdin=star_proc.stdout)
+        # only samtools reads the pipe, so STAR gets SIGPIPE if samtools exits early
+        star_proc.stdout.close()
+        sort_returncode = sort_proc.wait()
+        star_returncode = star_proc.wait()
+        if star_returncode != 0:
+            raise subprocess.CalledProcessError(star_returncode, cmd)
+        if sort_returncode != 0:
+            raise subprocess.CalledProcessError(sort_returncode, sort_cmd)
 
     def run_star(self):
         self.STAR()
         self.get_star_metrics()
-        self.sort_bam()
         self.index_bam()
 
-    @utils.add_log
-    def sort_bam(self):
-        cmd = (
-            f'samtools sort {self.unsort_STAR_bam} '
-            f'-o {self.STAR_bam} '
-            f'--threads {self.thread} '
-        )
-        StarMixin.sort_bam.logger.info(cmd)
-        subprocess.check_call(cmd, shell=True)
-
     @utils.add_log
     def index_bam(self):
         cmd = f"samtools index {self.STAR_bam}"
@@ -143,7 +159,78 @@ is higher than or equal to this value.""",
         help='Default `30`. Maximum memory that STAR can use.', 
         default=30
     )
+    parser.add_argument(
+        '--genomeLoad',
+        help=(
+            'Default `NoSharedMemory`. STAR `--genomeLoad` option. With `LoadAndKeep`, STAR attaches to the genome '
+            'in shared memory loaded by `python -m celescope.tools.star_mixin load`. '
+            'See `--shared_genome` of `multi_{assay}`.'
+        ),
+        choices=['NoSharedMemory', 'LoadAndKeep', 'LoadAndRemove'],
+        default='NoSharedMemory',
+    )
     if sub_program:
-        parser.add_argument('--fq', help="Required. R2 fastq file.", required=True)
+        parser.add_argument(
+            '--fq', help="Required. R2 fastq file or unaligned BAM file from step barcode.", required=True)
         parser.add_argument("--consensus_fq", action='store_true', help="Input fastq has been consensused")
         parser = s_common(parser)
+
+
+def get_genome_load_cmd(genomeDir, genomeLoad, server_dir):
+    return (
+        'STAR '
+        f'--genomeDir {genomeDir} '
+        f'--genomeLoad {genomeLoad} '
+        f'--outFileNamePrefix {server_dir}/{genomeLoad}_ '
+    )
+
+
+@utils.add_log
+def load_genome(genomeDir, server_dir):
+    """
+    Load the genome index into shared memory and exit. STAR jobs with `--genomeLoad LoadAndKeep` attach to it.
+    """
+    os.makedirs(server_dir, exist_ok=True)
+    cmd = get_genome_load_cmd(genomeDir, 'LoadAndExit', server_dir)
+    load_genome.logger.info(cmd)
+    subprocess.check_call(cmd, shell=True)
+
+
+@utils.add_log
+def release_genome(genomeDir, server_dir, sample, samples):
+    """
+    Mark sample as done. sample is done when its STAR job exits or a step before STAR fails.
+    The genome is removed from shared memory after all samples are done, only by the process 
+    which creates `{server_dir}/removed`.
+    """
+    os.makedirs(server_dir, exist_ok=True)
+    open(f'{server_dir}/{sample}.done', 'w').close()
+    not_done = [s for s in samples if not os.path.exists(f'{server_dir}/{s}.done')]
+    if not_done:
+        release_genome.logger.info(f'{len(not_done)} samples are not done. Keep the genome in shared memory.')
+        return
+    try:
+        os.close(os.open(f'{server_dir}/removed', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+    cmd = get_genome_load_cmd(genomeDir, 'Remove', server_dir)
+    release_genome.logger.info(cmd)
+    subprocess.check_call(cmd, shell=True)
+
+
+def main():
+    parser = argparse.ArgumentParser('STAR genome in shared memory')
+    parser.add_argument('action', choices=['load', 'release'])
+    parser.add_argument('--genomeDir', help='Genome directory.', required=True)
+    parser.add_argument('--server_dir', help='Directory of STAR logs and sample done files.', required=True)
+    parser.add_argument('--sample', help='Sample name. Required for release.')
+    parser.add_argument('--samples', help='Comma separated names of all samples. Required for release.')
+    args = parser.parse_args()
+    if args.action == 'load':
+        load_genome(args.genomeDir, args.server_dir)
+    else:
+        release_genome(args.genomeDir, args.server_dir, args.sample, args.samples.split(','))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,25 @@ def s_common(parser):
     return parser
 
 
+def s_compress(parser):
+    """compression arguments of output fastq.gz files
+    """
+    parser.add_argument(
+        '--compress_level',
+        help='Gzip compression level(0-9) of output fastq files. Default level of xopen or bgzip is used if not set.',
+    )
+    parser.add_argument(
+        '--compress_threads',
+        help='Threads to compress output fastq files. Default threads of xopen or bgzip are used if not set.',
+    )
+    parser.add_argument(
+        '--bgzf',
+        help='Compress output fastq files to BGZF blocks with bgzip and write a `.gzi` index alongside.',
+        action='store_true',
+    )
+    return parser
+
+
 class Step:
     """
     Step class
@@ -128,19 +147,25 @@ class Step:
             html = template.render(self.content_dict['data'])
             f.write(html)
 
-    def stat_to_data(self):
-        df = pd.read_table(self.stat_file, header=None, sep=':', dtype=str)
-        self.content_dict['data'][self.step_name + '_summary'] = df.values.tolist()
+    def stat_to_data(self, stat_file=None, step_name=None):
+        stat_file = stat_file or self.stat_file
+        step_name = step_name or self.step_name
+        df = pd.read_table(stat_file, header=None, sep=':', dtype=str)
+        self.content_dict['data'][step_name + '_summary'] = df.values.tolist()
 
-    def stat_to_metric(self):
+    def stat_to_metric(self, stat_file=None, step_name=None):
         '''
         can be:
         1. value
         2. value(fraction%)
         3. fraction%
-        '''
 
-        df = pd.read_table(self.stat_file, header=None, sep=':', dtype=str)
+        stat_file and step_name default to this step. Steps which do the work of another step use them to 
+        add the summary of that step.
+        '''
+        stat_file = stat_file or self.stat_file
+        step_name = step_name or self.step_name
+        df = pd.read_table(stat_file, header=None, sep=':', dtype=str)
         dic = dict(zip(df.iloc[:, 0], df.iloc[:, 1].str.strip()))
         metrics = dict()
         for metric_name, string in dic.items():
@@ -177,7 +202,7 @@ class Step:
                         pass
                 metrics[metric_name] = value
 
-        self.content_dict['metric'][self.step_name + '_summary'] = metrics
+        self.content_dict['metric'][step_name + '_summary'] = metrics
 
     def add_content_item(self, slot, **kwargs):
         for key, value in kwargs.items():
@@ -1,17 +1,49 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
 import unittest
-from collections import namedtuple
+from collections import Counter, namedtuple
+from unittest import mock
 
+import numpy as np
+import pysam
+import scipy.sparse
+import scipy.stats
+
+import celescope.tools.cellranger3.stats as cr_stats
+import celescope.tools.utils as utils
+from celescope.tools.cellranger3 import get_plot_elements
+from celescope.capture_rna.multi_capture_rna import Multi_capture_rna
+from celescope.tools.barcode import (BarcodeSketch, MismatchIndex, ReadFilter,
+                                     get_all_mismatch,
+                                     parse_pattern)
 from celescope.tools.consensus import dumb_consensus, get_read_length
-from celescope.tools.count import Count
+from celescope.tools.cutadapt import ADAPTER, AdapterTrimmer
+from celescope.tools.fastq import read_fastq_pairs, read_fastq_records
+from celescope.tools.featureCounts import add_tag, stream_tag
+from celescope.tools.count import Count, bam2table, get_bam_chunks
+from celescope.tools.count_table import (CountTable, ReadAggregator, decode_umi,
+                                         encode_umi, read_matrix_10X,
+                                         simulate_skewed_umis)
+from celescope.tools.region_metrics import RegionIndex, get_region_metrics
+from celescope.tools.star_mixin import release_genome
 from celescope.tools.step import Step
 
 
 class Tests(unittest.TestCase):
     """
-    Run this test under a temp folder as it will generate some files.
+    Each test runs in its own temp folder as it will generate some files.
     """
     def setUp(self):
-        pass
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
 
     def test_Step(self):
         Args = namedtuple("Args", 'sample outdir assay debug thread')
@@ -58,6 +90,399 @@ class Tests(unittest.TestCase):
         assert n_corrected_umi == 3
         assert n_corrected_read == 2 + 5 + 10  
 
+    def test_filter_chunk(self):
+        pattern_dict = parse_pattern('C4L2U4T10')
+        read_filter = ReadFilter(
+            pattern_dict=pattern_dict, lowQual=0, lowNum=2, allowNoPolyT=False, allowNoLinker=True,
+            output_nopolyT=False, output_noLinker=False,
+        )
+        seq1_list = ['AAAACCGGGGTTTTTTTTTT', 'AAAACCGGGGACGTACGTAC', 'CCCCGGTTTTTTTTTTTTTT']
+        chunk = [(f'r{i}', seq1, 'F' * 20, f'r{i}', 'ACGT', 'FFFF') for i, seq1 in enumerate(seq1_list)]
+
+        whole = read_filter.filter_chunk(chunk, 0)
+        first = read_filter.filter_chunk(chunk[:2], 0)
+        second = read_filter.filter_chunk(chunk[2:], 2)
+        assert whole.out_fq2 == first.out_fq2 + second.out_fq2
+        assert whole.out_fq2.split('\n')[0] == '@AAAA_GGGG_1'
+        assert whole.out_fq2.split('\n')[4] == '@CCCC_TTTT_3'
+        assert whole.metrics == first.metrics + second.metrics
+        assert whole.metrics['no_polyT_num'] == 1
+
+        read_filter.batch = True
+        batch = read_filter.filter_chunk(chunk, 0)
+        assert batch.out_fq2 == whole.out_fq2
+        assert batch.metrics == whole.metrics
+        assert batch.barcode_qual_Counter == whole.barcode_qual_Counter
+
+        read_filter.output_bam = True
+        for res in (read_filter.filter_chunk(chunk, 0), read_filter.filter_chunk_by_read(chunk, 0)):
+            assert res.out_fq2 == ''
+            assert [record[0] for record in res.out_bam_records] == ['AAAA_GGGG_1', 'CCCC_TTTT_3']
+            assert res.out_bam_records[1][3:] == ('CCCC', 'CCCC', 'TTTT')
+
+    def test_mismatch_index(self):
+        seq_list = ['AACCGGTT', 'AACCGGTA', 'TTGGCCAA']
+        _correct_set, mismatch_dict = get_all_mismatch(seq_list, n_mismatch=2)
+        mismatch_index = MismatchIndex.build(seq_list, n_mismatch=2)
+        assert len(mismatch_index) == len(mismatch_dict)
+        for seq in mismatch_dict:
+            assert mismatch_index[seq] == mismatch_dict[seq]
+        for seq in ('AACCGGTT'[:7], 'GGGGGGGG', 'AACCGGTX'):
+            assert seq not in mismatch_index
+
+    def test_adapter_trimmer(self):
+        trimmer = AdapterTrimmer(ADAPTER, minimum_length=20, nextseq_trim=20, overlap=10, insert=150)
+        metrics = Counter()
+        seq = 'ACGTACGTTGCAACGTACGTTGCC'
+        assert trimmer.trim(seq + 'A' * 20, 'F' * 44, metrics) == (seq, 'F' * 24)
+        assert trimmer.trim('ACGT' + 'A' * 20, 'F' * 24, metrics) == (None, None)
+        assert trimmer.trim(seq + 'GGGG', 'F' * 24 + '####', metrics) == (seq, 'F' * 24)
+        assert metrics['with_adapters'] == 2
+        assert metrics['too_short'] == 1
+        assert dict(AdapterTrimmer.get_stat_list(metrics))['Base Pairs Written'] == '48(50.0%)'
+
+    def test_read_fastq(self):
+        with open('test_1.fq', 'w') as fh:
+            fh.write('@r1 1:N\nACGT\n+\nFFFF\n@r2 1:N\nACG\n+\nFF:\n@r3/1\nA\n+\nF')
+        with open('test_2.fq', 'w') as fh:
+            fh.write('@r1 2:N\nTTTTTTTT\n+\nFFFFFFFF\n@r2\nT\n+\nF\n@r3/2\nTT\n+\nFF\n')
+        assert list(read_fastq_records('test_1.fq', block_size=10)) == [
+            ('r1', 'ACGT', 'FFFF'), ('r2', 'ACG', 'FF:'), ('r3/1', 'A', 'F')]
+        pair_fields = list(read_fastq_pairs('test_1.fq', 'test_2.fq', block_size=16))
+        assert [name for fields in pair_fields for name in fields[3]] == ['r1', 'r2', 'r3/2']
+        with open('test_2.fq', 'w') as fh:
+            fh.write('@r1\nT\n+\nF\n@r3\nT\n+\nF\n@r2\nT\n+\nF\n')
+        with self.assertRaises(Exception):
+            list(read_fastq_pairs('test_1.fq', 'test_2.fq'))
+        # headers with different numbers of comments
+        with open('test_1.fq', 'w') as fh:
+            fh.write('@r1 a b\nA\n+\nF\n@r2\nA\n+\nF\n@r3\ta\nA\n+\nF\n@r4 a\nA\n+\nF\n')
+        names = [name for name, _seq, _qual in read_fastq_records('test_1.fq')]
+        assert names == ['r1', 'r2', 'r3', 'r4']
+        with pysam.FastxFile('test_1.fq') as fh:
+            assert names == [entry.name for entry in fh]
+
+    def test_barcode_sketch(self):
+        barcodes = np.array([b'AAAA'] * 30 + [b'CCCC'] * 3)
+        umis = np.array([f'{i:08d}'.encode() for i in range(20)] + [b'00000000'] * 10 + [b'11111111'] * 3)
+        sketch = BarcodeSketch.from_reads(barcodes[:15], umis[:15])
+        sketch.update(BarcodeSketch.from_reads(barcodes[15:], umis[15:]))
+        df = sketch.to_df()
+        assert df['Barcode'].tolist() == ['AAAA', 'CCCC']
+        assert df['readcount'].tolist() == [30, 3]
+        # HyperLogLog estimate
+        assert abs(df['UMI'].iloc[0] - 20) <= 2
+        assert df['UMI'].iloc[1] == 1
+
+
+    def test_count_table(self):
+        assert decode_umi(encode_umi('AACGTN')) == 'AACGTN'
+        assert encode_umi('A') != encode_umi('AA')
+        count_table = CountTable()
+        count_table.add_barcode('B', {'g1': {'AAA': 2, 'CCC': 1}, 'g2': {'AAA': 3}})
+        count_table.add_barcode('A', {'g1': {'TTT': 1}})
+        count_table.finish()
+        df_sum = count_table.get_df_sum()
+        assert df_sum.index.tolist() == ['B', 'A']
+        assert df_sum.loc['B'].tolist() == [6, 5, 3, 2]
+        assert count_table.filter_barcodes(['A']).get_read_count() == 1
+        gene_ids, barcodes, mtx = count_table.get_matrix()
+        assert gene_ids == ['g1', 'g2'] and barcodes == ['A', 'B']
+        assert mtx.format == 'csc' and mtx.toarray().tolist() == [[1, 2], [0, 1]]
+
+        count_table.write_matrix_10X('test_matrix', {'g1': 'G1', 'g2': 'G2'})
+        features_df, barcodes, npz_mtx = read_matrix_10X('test_matrix')
+        os.remove('test_matrix/matrix.npz')
+        _, _, mtx_mtx = read_matrix_10X('test_matrix')
+        assert features_df['name'].tolist() == ['G1', 'G2'] and barcodes == ['A', 'B']
+        assert npz_mtx.toarray().tolist() == mtx_mtx.toarray().tolist() == [[1, 2], [0, 1]]
+
+    def test_correct_table_umi(self):
+        gene_umi_dict = simulate_skewed_umis(n_gene=3, n_umi=50, umi_length=4)
+        count_table = CountTable()
+        count_table.add_barcode('A', gene_umi_dict)
+        count_table.add_barcode('B', {'g1': {'AAAA': 1, 'ANAA': 20, 'AAAT': 10}})
+        count_table.finish()
+        n_corrected_umi, n_corrected_read = count_table.correct_umi()
+
+        n_corrected_umi_dict = n_corrected_read_dict = 0
+        for umi_dict in gene_umi_dict.values():
+            n_umi, n_read = Count.correct_umi(umi_dict)
+            n_corrected_umi_dict += n_umi
+            n_corrected_read_dict += n_read
+        assert (n_corrected_umi, n_corrected_read) == (n_corrected_umi_dict + 1, n_corrected_read_dict + 1)
+        corrected_dict = {}
+        for barcode, gene, umi, count in zip(count_table.barcode, count_table.gene, count_table.umi, count_table.count):
+            gene_dict = corrected_dict.setdefault(count_table.barcode_list[barcode], {})
+            gene_dict.setdefault(count_table.gene_list[gene], {})[decode_umi(umi)] = count
+        assert corrected_dict['A'] == gene_umi_dict
+        assert corrected_dict['B'] == {'g1': {'ANAA': 21, 'AAAT': 10}}
+
+    def test_count_table_downsample(self):
+        count_table = CountTable()
+        for barcode, seed in (('A', 0), ('B', 1), ('C', 2)):
+            count_table.add_barcode(barcode, simulate_skewed_umis(n_gene=5, n_umi=20, umi_length=4, seed=seed))
+        count_table.finish()
+        cell_table = count_table.filter_barcodes(['A', 'C'])
+        read_rows = np.repeat(cell_table.rows, cell_table.count)
+        np.random.RandomState(0).shuffle(read_rows)
+        n_read_list = [len(read_rows) * i // 7 for i in range(1, 8)]
+        n_umi_arr, n_umi_once_arr, median_gene_arr = cell_table.downsample(read_rows, n_read_list)
+
+        row_index = {row: i for i, row in enumerate(cell_table.rows)}
+        for i, n_read in enumerate(n_read_list):
+            row_counter = Counter(read_rows[:n_read])
+            assert n_umi_arr[i] == len(row_counter)
+            assert n_umi_once_arr[i] == sum(count == 1 for count in row_counter.values())
+            barcode_genes = {}
+            for row in row_counter:
+                index = row_index[row]
+                barcode_genes.setdefault(cell_table.barcode[index], set()).add(cell_table.gene[index])
+            assert median_gene_arr[i] == np.median([len(genes) for genes in barcode_genes.values()])
+
+    def test_bam2table_chunks(self):
+        header = {'HD': {'VN': '1.6', 'SO': 'queryname'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}]}
+        with pysam.AlignmentFile('test_count.bam', 'wb', header=header) as samfile:
+            for barcode_index in range(300):
+                for read_index in range(barcode_index % 7 + 1):
+                    seg = pysam.AlignedSegment()
+                    seg.query_name = f'B{barcode_index:04d}_{"ACG"[read_index % 3] * 4}_{read_index}'
+                    seg.query_sequence = 'ACGT' * 20
+                    seg.flag = 4
+                    if read_index % 4:
+                        seg.set_tag('XT', f'gene{read_index % 2}')
+                    samfile.write(seg)
+        count_table = bam2table('test_count.bam').finish()
+        chunks = get_bam_chunks('test_count.bam', 5)
+        assert len(chunks) > 1
+        chunk_table = CountTable()
+        for chunk in chunks:
+            chunk_table.add_table(bam2table('test_count.bam', *chunk))
+        chunk_table.finish()
+        assert chunk_table.barcode_list == count_table.barcode_list
+        assert chunk_table.gene_list == count_table.gene_list
+        for col in ('barcode', 'gene', 'umi', 'count'):
+            assert np.array_equal(getattr(chunk_table, col), getattr(count_table, col))
+
+    def test_stream_tag(self):
+        with open('test_tag.gtf', 'w') as gtf:
+            for i in range(2):
+                gtf.write(f'chr1\ttest\tgene\t1\t100\t.\t+\t.\tgene_id "id{i}"; gene_name "gene{i}";\n')
+        header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}]}
+        with pysam.AlignmentFile('test_tag.bam', 'wb', header=header) as samfile:
+            for read_index in range(50):
+                seg = pysam.AlignedSegment()
+                seg.query_name = f'B{read_index % 7:04d}_{"ACG"[read_index % 3] * 4}_{read_index}'
+                seg.query_sequence = 'ACGT' * 20
+                seg.flag = 4
+                if read_index % 4:
+                    seg.set_tag('XT', f'id{read_index % 2}')
+                samfile.write(seg)
+        stream_tag('test_tag.bam', 'test_tag.gtf', 'test_tag.stream.bam', thread=2)
+        add_tag('test_tag.bam', 'test_tag.gtf')
+        with pysam.AlignmentFile('test_tag.bam') as f1, pysam.AlignmentFile('test_tag.stream.bam') as f2:
+            reads = [read.to_string() for read in f1]
+            assert reads == [read.to_string() for read in f2]
+        assert 'CB:Z:B0001\tUB:Z:CCCC' in reads[1]
+        assert 'GN:Z:gene1\tGX:Z:id1' in reads[1]
+
+    @unittest.skipIf(shutil.which('samtools') is None, 'samtools is not installed')
+    def test_stream_tag_name_sorted(self):
+        with open('test_tag_sort.gtf', 'w') as gtf:
+            gtf.write('chr1\ttest\tgene\t1\t100\t.\t+\t.\tgene_id "id0"; gene_name "gene0";\n')
+        header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}]}
+        with pysam.AlignmentFile('test_tag_sort.bam', 'wb', header=header) as samfile:
+            for read_index in range(50):
+                seg = pysam.AlignedSegment()
+                seg.query_name = f'B{(read_index * 17) % 7:04d}_ACGT_{read_index}'
+                seg.query_sequence = 'ACGT' * 20
+                seg.flag = 4
+                if read_index % 4:
+                    seg.set_tag('XT', 'id0')
+                samfile.write(seg)
+        stream_tag(
+            'test_tag_sort.bam', 'test_tag_sort.gtf', 'test_tag_sort.stream.bam',
+            thread=2, name_sorted_bam='test_tag_sort.name_sorted.bam',
+        )
+        add_tag('test_tag_sort.bam', 'test_tag_sort.gtf')
+        pysam.sort('-n', '-o', 'test_tag_sort.expected.bam', 'test_tag_sort.bam')
+        with pysam.AlignmentFile('test_tag_sort.expected.bam') as f1, \
+                pysam.AlignmentFile('test_tag_sort.name_sorted.bam') as f2:
+            reads = [read.to_string() for read in f1]
+            assert reads == [read.to_string() for read in f2]
+        assert len(reads) == 50
+
+    def test_gene_annotation(self):
+        with open('test_annotation.gtf', 'w') as gtf:
+            for i, name in enumerate(['A', 'B', 'A', 'A']):
+                gtf.write(f'chr1\ttest\tgene\t{i * 100 + 1}\t{i * 100 + 90}\t.\t+\t.\tgene_id "id{i}"; gene_name "{name}"; gene_biotype "lncRNA";\n')
+                gtf.write(f'chr1\ttest\texon\t{i * 100 + 11}\t{i * 100 + 20}\t.\t+\t.\tgene_id "id{i}"; gene_name "{name}";\n')
+            gtf.write('chr1\ttest\texon\t401\t410\t.\t+\t.\ttranscript_id "t0";\n')
+        prefix = utils.GeneAnnotation.get_prefix('test_annotation.gtf')
+        utils.clear_gene_annotation_memo()
+        id_name = utils.get_id_name_dict('test_annotation.gtf')
+        assert id_name == {'id0': 'A', 'id1': 'B', 'id2': 'A_2', 'id3': 'A_3'}
+        assert os.path.exists(f'{prefix}.json')
+        annotation = utils.GeneAnnotation.load(prefix)
+        assert annotation.is_valid('test_annotation.gtf')
+        assert annotation.genes['gene_type'][0] == 'lncRNA'
+        assert annotation.exons['gene'].tolist() == [0, 1, 2, 3]
+        assert annotation.exons['start'].tolist() == [11, 111, 211, 311]
+        # touched gtf file: md5 is the same and the new mtime is saved
+        mtime_ns = os.stat('test_annotation.gtf').st_mtime_ns + 10 ** 9
+        os.utime('test_annotation.gtf', ns=(mtime_ns, mtime_ns))
+        utils.clear_gene_annotation_memo()
+        assert utils.get_id_name_dict('test_annotation.gtf') == id_name
+        assert utils.GeneAnnotation.load(prefix).meta['mtime_ns'] == mtime_ns
+        with open('test_annotation.gtf', 'a') as gtf:
+            gtf.write('chr1\ttest\tgene\t501\t590\t.\t+\t.\tgene_id "id4";\n')
+        assert not annotation.is_valid('test_annotation.gtf')
+        utils.clear_gene_annotation_memo()
+        assert utils.get_id_name_dict('test_annotation.gtf')['id4'] == 'id4'
+
+    def test_multi_capture_rna_skip_name_sort(self):
+        os.mkdir('data')
+        for read in ('1', '2'):
+            with open(f'data/lib_R{read}.fq.gz', 'w'):
+                pass
+        with open('map.tsv', 'w') as fh:
+            fh.write('lib\tdata\ts1\n')
+        argv = ['multi_capture_rna', '--mapfile', 'map.tsv', '--mod', 'shell', '--genomeDir', 'genome']
+        with mock.patch.dict(os.environ, {'CONDA_DEFAULT_ENV': 'celescope'}):
+            with mock.patch.object(sys, 'argv', argv):
+                Multi_capture_rna('capture_rna').run()
+            with open('shell/s1.sh') as fh:
+                script = fh.read()
+            assert '--skip_name_sort' not in script
+            assert '--bam .//s1/04.featureCounts/s1_name_sorted.bam' in script
+            with mock.patch.object(sys, 'argv', argv + ['--skip_name_sort']):
+                with self.assertRaises(ValueError):
+                    Multi_capture_rna('capture_rna')
+
+    def test_release_genome(self):
+        server_dir = 'test_genome_server'
+        os.makedirs(server_dir, exist_ok=True)
+        for file_name in os.listdir(server_dir):
+            os.remove(f'{server_dir}/{file_name}')
+        # STAR is not run before all samples are done, or after the genome is removed by another sample
+        release_genome('genomeDir', server_dir, 'a', ['a', 'b'])
+        assert os.path.exists(f'{server_dir}/a.done')
+        assert not os.path.exists(f'{server_dir}/removed')
+        open(f'{server_dir}/removed', 'w').close()
+        release_genome('genomeDir', server_dir, 'b', ['a', 'b'])
+        assert os.path.exists(f'{server_dir}/b.done')
+
+    def test_region_metrics(self):
+        with open('test_region.refFlat', 'w') as refflat:
+            # exons [100, 200) [300, 400), coding [150, 350)
+            refflat.write('A\tA-1\tchr1\t+\t100\t400\t150\t350\t2\t100,300,\t200,400,\n')
+            # skipped, transcripts on different chromosomes
+            refflat.write('B\tB-1\tchr1\t+\t500\t600\t500\t500\t1\t500,\t600,\n')
+            refflat.write('B\tB-2\tchr2\t+\t500\t600\t500\t500\t1\t500,\t600,\n')
+        header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        with pysam.AlignmentFile('test_region.bam', 'wb', header=header) as samfile:
+            for reference_id, reference_start, cigar, flag in (
+                (0, 90, '20M100N20M', 0), (0, 390, '20M', 0), (0, 390, '20M', 256), (1, 500, '10M', 0)):
+                seg = pysam.AlignedSegment()
+                seg.query_name = 'read'
+                seg.reference_id = reference_id
+                seg.reference_start = reference_start
+                seg.cigarstring = cigar
+                seg.query_sequence = 'A' * seg.query_alignment_length
+                seg.flag = flag
+                samfile.write(seg)
+        pysam.index('test_region.bam')
+        region_index = RegionIndex.build('test_region.refFlat')
+        metrics = get_region_metrics('test_region.bam', region_index)
+        assert metrics == {
+            'PF_ALIGNED_BASES': 70, 'CODING_BASES': 0, 'UTR_BASES': 20, 'INTRONIC_BASES': 20, 'INTERGENIC_BASES': 30,
+        }
+
+    def test_read_aggregator(self):
+        random.seed(0)
+        reads = [
+            (f'B{random.randrange(20)}', f'gene{random.randrange(5)}', random.choice(['AAA', 'ACG', 'TTT']), read_id)
+            for read_id in range(1, 2000)
+        ]
+        # name sorted order
+        count_table = CountTable()
+        for barcode in sorted(set(read[0] for read in reads), key=lambda x: x + '_'):
+            gene_umi_dict = {}
+            for _, gene_id, umi, _ in sorted((read for read in reads if read[0] == barcode), key=lambda x: x[2:]):
+                umi_dict = gene_umi_dict.setdefault(gene_id, {})
+                umi_dict[umi] = umi_dict.get(umi, 0) + 1
+            count_table.add_barcode(barcode, gene_umi_dict)
+        count_table.finish()
+
+        os.makedirs('aggregator', exist_ok=True)
+        random.shuffle(reads)
+        aggregator = ReadAggregator(max_memory=0, tmp_dir='aggregator', buffer_size=100)
+        for read in reads:
+            aggregator.add_read(*read)
+        aggregated_table = aggregator.to_count_table()
+        assert aggregator.n_spill > 1
+        assert aggregated_table.barcode_list == count_table.barcode_list
+        assert aggregated_table.gene_list == count_table.gene_list
+        for col in ('barcode', 'gene', 'umi', 'count'):
+            assert np.array_equal(getattr(aggregated_table, col), getattr(count_table, col))
+
+    def test_ambient_pvalues(self):
+        rng = np.random.RandomState(0)
+        profile_p = rng.dirichlet(np.ones(50))
+        matrix = scipy.sparse.random(50, 30, density=0.2, format='csc', random_state=rng)
+        matrix.data = np.ceil(matrix.data * 5)
+        dense = matrix.T.toarray()
+        umis_per_bc = dense.sum(1).astype(int)
+        obs_loglk = cr_stats.eval_multinomial_loglikelihoods(matrix, profile_p)
+        assert np.allclose(obs_loglk, scipy.stats.multinomial.logpmf(dense, umis_per_bc, p=profile_p))
+
+        sim_n = np.unique(umis_per_bc)
+        sim_loglk = rng.normal(obs_loglk.mean(), 10, size=(len(sim_n), 100))
+        sim_loglk[0, :10] = obs_loglk[umis_per_bc == sim_n[0]][0]
+        pvalues = cr_stats.compute_ambient_pvalues(umis_per_bc, obs_loglk, sim_n, sim_loglk)
+        sim_n_idx = np.searchsorted(sim_n, umis_per_bc)
+        for i, obs in enumerate(obs_loglk):
+            assert pvalues[i] == (1 + np.sum(sim_loglk[sim_n_idx[i]] < obs)) / 101.0
+
+    def test_simulate_loglk_batch(self):
+        profile_p = np.random.RandomState(0).dirichlet(np.ones(20))
+        alias_table = cr_stats.get_alias_table(profile_p)
+        distinct_n = np.array([30, 35, 80])
+        loglk = cr_stats.simulate_loglk_batch(profile_p, alias_table, distinct_n, num_sims=4, jump=40, seed=1)
+
+        # draw the same features and counts
+        rng = np.random.RandomState(1)
+        counts = np.zeros((4, 20), dtype=int)
+        for i, step in enumerate(np.diff(distinct_n, prepend=0)):
+            if step >= 40:
+                counts += rng.multinomial(step, profile_p, size=4)
+            else:
+                for sim, features in enumerate(cr_stats.draw_features(rng, alias_table, (4, step))):
+                    counts[sim] += np.bincount(features, minlength=20)
+            assert np.allclose(loglk[i], scipy.stats.multinomial.logpmf(counts, distinct_n[i], p=profile_p))
+
+    def test_barcode_rank_plot_data(self):
+        umis = np.repeat(np.arange(2000, 0, -1), 5)
+        marks = np.where(np.arange(len(umis)) < 1000, 'CB', 'UB')
+        marks[[1100, 1200]] = 'CB'
+        with open('test_counts.txt', 'w') as fh:
+            fh.write('Barcode\tUMI\tmark\n')
+            for i, (umi, mark) in enumerate(zip(umis, marks)):
+                fh.write(f'bc{i}\t{umi}\t{mark}\n')
+        counts, plot_segments, cell_nums = get_plot_elements.counter_barcode_rank_plot_data('test_counts.txt')
+        assert cell_nums == 1002
+        assert plot_segments[0].end == 1000 and plot_segments[1].start == 1201
+        mixed_segments = plot_segments[2:]
+        assert mixed_segments[0].start == 1000 and mixed_segments[-1].end == 1201
+        assert sum(segment.cell_density * (segment.end - segment.start) for segment in mixed_segments) == 2
+
+        assert get_plot_elements.convert_numpy_array_to_line_chart(np.array([5, 4, 4, 3, 3, 3, 1]), int) == [
+            [0, 5], [1, 4], [2, 4], [3, 3], [6, 1]]
+        plot_data = get_plot_elements.get_plot_data(plot_segments, counts, max_points=100)
+        full_plot_data = get_plot_elements.get_plot_data(plot_segments, counts)
+        assert sum(len(data['x']) for data in plot_data) <= 100 + 2 * len(plot_segments)
+        for data, full_data in zip(plot_data, full_plot_data):
+            assert data['x'][0] == full_data['x'][0] and data['x'][-1] == full_data['x'][-1]
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,9 @@
 import argparse
 import glob
 import gzip
+import hashlib
 import importlib
+import io
 import itertools
 import json
 import logging
@@ -21,7 +23,7 @@ import pysam
 import xopen
 
 import celescope.tools
-from celescope.tools.__init__ import __PATTERN_DICT__
+from celescope.tools.__init__ import GENE_ANNOTATION_SUFFIX, __PATTERN_DICT__
 
 tools_dir = os.path.dirname(celescope.tools.__file__)
 
@@ -201,6 +203,280 @@ def generic_open(file_name, mode='rt'):
         file_obj = open(file_name, mode)
     return file_obj
 
+
+class BgzipWriter():
+    """
+    Write a BGZF file with `bgzip`. A `.gzi` index is written alongside, so the file can be 
+    read from any uncompressed offset with `bgzip -b {offset} -s {size}`.
+    """
+
+    def __init__(self, file_name, mode='w', compress_level=None, threads=None):
+        self.cmd = ['bgzip', '-c', '-i', '-I', f'{file_name}.gzi']
+        if compress_level is not None:
+            self.cmd += ['-l', str(compress_level)]
+        if threads is not None:
+            self.cmd += ['-@', str(threads)]
+        self.out_handle = open(file_name, 'wb')
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=self.out_handle)
+        if 'b' in mode:
+            self.handle = self.process.stdin
+        else:
+            self.handle = io.TextIOWrapper(self.process.stdin, encoding='utf-8')
+
+    def write(self, content):
+        return self.handle.write(content)
+
+    def close(self):
+        self.handle.close()
+        returncode = self.process.wait()
+        self.out_handle.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ' '.join(self.cmd))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_fastq_writer(file_name, mode='w', compress_level=None, threads=None, bgzf=False):
+    """
+    Open a fastq file for writing. Files ending with `.gz` are compressed.
+    Args:
+        compress_level: gzip compression level. None uses the default level.
+        threads: compression threads. None uses the default of xopen or bgzip.
+        bgzf: write BGZF blocks and a `.gzi` index instead of a single gzip stream.
+    """
+    if bgzf and file_name.endswith('.gz'):
+        return BgzipWriter(file_name, mode, compress_level=compress_level, threads=threads)
+    kwargs = {}
+    if compress_level is not None:
+        kwargs['compresslevel'] = int(compress_level)
+    if threads is not None:
+        kwargs['threads'] = int(threads)
+    return xopen.xopen(file_name, mode, **kwargs)
+
+def get_file_md5(file_name, block_size=1 << 22):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class GeneAnnotation():
+    """
+    Genes and exons of a gtf file in numpy structured arrays.
+        - genes: gene_id, gene_name, gene_type, chrom, start, end, strand. 
+            gene_name is made unique in the same way as get_id_name_dict.
+        - exons: gene(index in genes), start, end.
+    Coordinates are 1-based and closed as in the gtf file.
+
+    The arrays are saved next to the gtf file({gtf}.celescope_annotation.*) and loaded with mmap. 
+    The size, mtime and md5 of the gtf file are saved in the json file to check if the cache is outdated.
+    """
+    VERSION = 1
+    GENE_ID_PATTERN = re.compile(r'gene_id "(\S+)";')
+    GENE_NAME_PATTERN = re.compile(r'gene_name "(\S+)"')
+    GENE_TYPE_PATTERN = re.compile(r'gene_(?:bio)?type "(\S+)"')
+
+    def __init__(self, genes, exons, meta):
+        self.genes = genes
+        self.exons = exons
+        self.meta = meta
+        self._id_name = None
+
+    @staticmethod
+    def get_prefix(gtf_file):
+        return f'{gtf_file}{GENE_ANNOTATION_SUFFIX}'
+
+    @staticmethod
+    def get_meta(gtf_file, md5=None):
+        stat = os.stat(gtf_file)
+        if md5 is None:
+            md5 = get_file_md5(gtf_file)
+        return {
+            'version': GeneAnnotation.VERSION,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'md5': md5,
+        }
+
+    @classmethod
+    @add_log
+    def parse(cls, gtf_file):
+        """
+        - one gene_name with multiple gene_id: "_{count}" will be added to gene_name.
+        - one gene_id with multiple gene_name: error.
+        - duplicated (gene_name, gene_id): ignore duplicated records and print a warning.
+        """
+        id_index = {}
+        gene_records = []
+        exon_records = []
+        c = Counter()
+        with generic_open(gtf_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if line.startswith('#'):
+                    continue
+                tabs = line.split('\t')
+                gtf_type, attributes = tabs[2], tabs[-1]
+                if gtf_type == 'exon':
+                    gene_ids = cls.GENE_ID_PATTERN.findall(attributes)
+                    if not gene_ids:
+                        continue
+                    exon_records.append((gene_ids[-1], int(tabs[3]), int(tabs[4])))
+                elif gtf_type == 'gene':
+                    gene_id = cls.GENE_ID_PATTERN.findall(attributes)[-1]
+                    gene_names = cls.GENE_NAME_PATTERN.findall(attributes)
+                    if not gene_names:
+                        gene_name = gene_id 
+                    else:
+                        gene_name = gene_names[-1]
+                    c[gene_name] += 1
+                    if c[gene_name] > 1:
+                        if gene_id in id_index:
+                            previous_name = gene_records[id_index[gene_id]][1]
+                            assert previous_name == gene_name, (
+                                    'one gene_id with multiple gene_name '
+                                    f'gene_id: {gene_id}, '
+                                    f'gene_name this line: {gene_name}'
+                                    f'gene_name previous line: {previous_name}'
+                                )
+                            GeneAnnotation.parse.logger.warning(
+                                    'duplicated (gene_id, gene_name)'
+                                    f'gene_id: {gene_id}, '
+                                    f'gene_name {gene_name}'
+                                )
+                            c[gene_name] -= 1
+                        else:
+                            gene_name = f'{gene_name}_{c[gene_name]}'
+                    if gene_id in id_index:
+                        # keep the position and coordinates of the first record
+                        index = id_index[gene_id]
+                        gene_records[index] = (gene_id, gene_name) + gene_records[index][2:]
+                    else:
+                        gene_types = cls.GENE_TYPE_PATTERN.findall(attributes)
+                        gene_type = gene_types[-1] if gene_types else ''
+                        id_index[gene_id] = len(gene_records)
+                        gene_records.append((gene_id, gene_name, gene_type, tabs[0], int(tabs[3]), int(tabs[4]), tabs[6]))
+
+        str_width = [max([1] + [len(record[i]) for record in gene_records]) for i in range(4)]
+        gene_dtype = [
+            ('gene_id', f'U{str_width[0]}'),
+            ('gene_name', f'U{str_width[1]}'),
+            ('gene_type', f'U{str_width[2]}'),
+            ('chrom', f'U{str_width[3]}'),
+            ('start', np.int64),
+            ('end', np.int64),
+            ('strand', 'U1'),
+        ]
+        genes = np.array(gene_records, dtype=gene_dtype)
+        # exons of genes without a gene record are not kept
+        exon_records = [
+            (id_index[gene_id], start, end) for gene_id, start, end in exon_records if gene_id in id_index
+        ]
+        exons = np.array(exon_records, dtype=[('gene', np.int32), ('start', np.int64), ('end', np.int64)])
+        return cls(genes, exons, cls.get_meta(gtf_file))
+
+    @classmethod
+    def load(cls, prefix):
+        with open(f'{prefix}.json') as f:
+            meta = json.load(f)
+        genes = np.load(f'{prefix}.genes.npy', mmap_mode='r')
+        exons = np.load(f'{prefix}.exons.npy', mmap_mode='r')
+        return cls(genes, exons, meta)
+
+    def save(self, prefix):
+        """
+        write to temp files then rename, so samples running at the same time never read a partial file. 
+        The json file is written last.
+        """
+        pid = os.getpid()
+        for suffix, arr in (('genes', self.genes), ('exons', self.exons)):
+            tmp_file = f'{prefix}.{pid}.tmp.{suffix}.npy'
+            np.save(tmp_file, arr)
+            os.replace(tmp_file, f'{prefix}.{suffix}.npy')
+        self.save_meta(prefix)
+
+    def save_meta(self, prefix):
+        tmp_file = f'{prefix}.{os.getpid()}.tmp.json'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, f'{prefix}.json')
+
+    def is_valid(self, gtf_file):
+        """
+        The md5 of the gtf file is only computed if its size or mtime changed. 
+        If the md5 is the same, the new mtime is set in self.meta.
+        """
+        if self.meta.get('version') != GeneAnnotation.VERSION:
+            return False
+        stat = os.stat(gtf_file)
+        if stat.st_size != self.meta['size']:
+            return False
+        if stat.st_mtime_ns == self.meta['mtime_ns']:
+            return True
+        if get_file_md5(gtf_file) != self.meta['md5']:
+            return False
+        self.meta['mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    @property
+    def id_name(self):
+        if self._id_name is None:
+            self._id_name = dict(zip(self.genes['gene_id'].tolist(), self.genes['gene_name'].tolist()))
+        return self._id_name
+
+
+_gene_annotation_memo = {}
+
+
+def clear_gene_annotation_memo():
+    _gene_annotation_memo.clear()
+
+
+@add_log
+def get_gene_annotation(gtf_file):
+    """
+    Load GeneAnnotation of gtf_file from the cache. If the cache does not exist or the gtf file changed,
+    parse the gtf file and write the cache again. Results are kept in memory for the process.
+    """
+    key = os.path.realpath(gtf_file)
+    if key in _gene_annotation_memo:
+        return _gene_annotation_memo[key]
+
+    prefix = GeneAnnotation.get_prefix(gtf_file)
+    annotation = None
+    if os.path.exists(f'{prefix}.json'):
+        annotation = GeneAnnotation.load(prefix)
+        mtime_ns = annotation.meta['mtime_ns']
+        if annotation.is_valid(gtf_file):
+            get_gene_annotation.logger.info(f'load gene annotation from {prefix}')
+            if annotation.meta['mtime_ns'] != mtime_ns:
+                # gtf file is touched or copied, save the new mtime to avoid computing the md5 again
+                try:
+                    annotation.save_meta(prefix)
+                except OSError as error:
+                    get_gene_annotation.logger.warning(f'can not write gene annotation cache: {error}')
+        else:
+            get_gene_annotation.logger.warning(f'{gtf_file} changed. gene annotation cache is outdated.')
+            annotation = None
+
+    if annotation is None:
+        annotation = GeneAnnotation.parse(gtf_file)
+        try:
+            annotation.save(prefix)
+            get_gene_annotation.logger.info(f'gene annotation saved to {prefix}')
+        except OSError as error:
+            get_gene_annotation.logger.warning(f'can not write gene annotation cache: {error}')
+
+    _gene_annotation_memo[key] = annotation
+    return annotation
+
+
 @add_log
 def get_id_name_dict(gtf_file):
     """
@@ -208,49 +484,12 @@ def get_id_name_dict(gtf_file):
         - one gene_name with multiple gene_id: "_{count}" will be added to gene_name.
         - one gene_id with multiple gene_name: error.
         - duplicated (gene_name, gene_id): ignore duplicated records and print a warning.
+    The gtf file is only parsed if the gene annotation cache is missing or outdated(see get_gene_annotation).
 
     Returns:
         {gene_id: gene_name} dict
     """
-
-    gene_id_pattern = re.compile(r'gene_id "(\S+)";')
-    gene_name_pattern = re.compile(r'gene_name "(\S+)"')
-    id_name = {}
-    c = Counter()
-    with generic_open(gtf_file) as f:
-        for line in f:
-            if not line.strip():
-                continue
-            if line.startswith('#'):
-                continue
-            tabs = line.split('\t')
-            gtf_type, attributes = tabs[2], tabs[-1]
-            if gtf_type == 'gene':
-                gene_id = gene_id_pattern.findall(attributes)[-1]
-                gene_names = gene_name_pattern.findall(attributes)
-                if not gene_names:
-                    gene_name = gene_id 
-                else:
-                    gene_name = gene_names[-1]
-                c[gene_name] += 1
-                if c[gene_name] > 1:
-                    if gene_id in id_name:
-                        assert id_name[gene_id] == gene_name, (
-                                'one gene_id with multiple gene_name '
-                                f'gene_id: {gene_id}, '
-                                f'gene_name this line: {gene_name}'
-                                f'gene_name previous line: {id_name[gene_id]}'
-                            )
-                        get_id_name_dict.logger.warning(
-                                'duplicated (gene_id, gene_name)'
-                                f'gene_id: {gene_id}, '
-                                f'gene_name {gene_name}'
-                            )
-                        c[gene_name] -= 1
-                    else:
-                        gene_name = f'{gene_name}_{c[gene_name]}'
-                id_name[gene_id] = gene_name
-    return id_name
+    return dict(get_gene_annotation(gtf_file).id_name)
 
 
 @add_log
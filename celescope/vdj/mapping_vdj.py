@@ -5,9 +5,9 @@ vdj mapping
 import subprocess
 
 import pandas as pd
-import pysam
 
 import celescope.tools.utils as utils
+from celescope.tools.fastq import read_fastq_records
 from celescope.tools.step import Step, s_common
 from celescope.vdj.__init__ import CHAINS
 
@@ -167,17 +167,16 @@ class Mapping_vdj(Step):
     @utils.add_log
     def fastq_to_dataframe(self):
         # read input_file
-        with pysam.FastxFile(self.args.fq) as fh:
-            index = 0
-            read_row_list = []
-            for entry in fh:
-                attr = entry.name.split("_")
-                barcode = attr[0]
-                umi = attr[1]
-                dic = {"readId": index, "barcode": barcode, "UMI": umi}
-                read_row_list.append(dic)
-                index += 1
-            df_fastq = pd.DataFrame(read_row_list, columns=["readId", "barcode", "UMI"])
+        index = 0
+        read_row_list = []
+        for name, _seq, _qual in read_fastq_records(self.args.fq):
+            attr = name.split("_")
+            barcode = attr[0]
+            umi = attr[1]
+            dic = {"readId": index, "barcode": barcode, "UMI": umi}
+            read_row_list.append(dic)
+            index += 1
+        df_fastq = pd.DataFrame(read_row_list, columns=["readId", "barcode", "UMI"])
         return df_fastq
 
     def get_df_align(self, df_fastq):